@@ -0,0 +1,92 @@
+import csv
+import io
+import json
+import struct
+
+import numpy as np
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class NDJSONRenderer(BaseRenderer):
+    """ Renders a list as newline delimited JSON, one item per line """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return ''.join(self.render_lines(data if isinstance(data, list) else [data])).encode(self.charset)
+
+    @classmethod
+    def render_lines(cls, items):
+        """ Renders the items as they are yielded, to stream them """
+        for item in items:
+            yield json.dumps(item) + '\n'
+
+
+class CSVRenderer(BaseRenderer):
+    """ Renders currency rates as CSV, one valuation date per row and one column for each currency """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, list):
+            return ''.join(self.render_lines(data)).encode(self.charset)
+        # Errors are rendered as a single row with their fields
+        return ''.join(self.get_line(line) for line in (list(data), list(data.values()))).encode(self.charset)
+
+    @classmethod
+    def get_line(cls, values):
+        line = io.StringIO()
+        csv.writer(line).writerow(values)
+        return line.getvalue()
+
+    @classmethod
+    def render_lines(cls, currency_rates):
+        """ Renders the currency rates of each date as they are yielded, to stream them. The columns are the ones of
+        the first date """
+        symbols = None
+        for day_rates in currency_rates:
+            if symbols is None:
+                symbols = list(day_rates['rates'])
+                yield cls.get_line(['source_currency', 'valuation_date', *symbols])
+            yield cls.get_line([day_rates['source_currency'], day_rates['valuation_date'],
+                                *(day_rates['rates'].get(symbol) for symbol in symbols)])
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """ Renders columnar currency rates as JSON, missing rates as null """
+    media_type = 'application/vnd.nucoro.columnar+json'
+    format = 'columnar'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict) and isinstance(data.get('rates'), np.ndarray):
+            rates = data['rates']
+            data = dict(data, rates=np.where(np.isnan(rates), None, rates).tolist())
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class ColumnarBinaryRenderer(BaseRenderer):
+    """ Renders columnar currency rates as a magic string, the length of a JSON header with the source currency, the
+    dates, the currencies and the matrix shape, and the header padded to 8 bytes, followed by the dates x currencies
+    matrix of rates as little endian float64, missing rates as NaN. Errors are rendered as JSON.
+    A client reads it with numpy.frombuffer(content, dtype='<f8', offset=12 + header_length).reshape(shape).
+    """
+    media_type = 'application/vnd.nucoro.columnar+octet-stream'
+    format = 'binary'
+    charset = None
+    render_style = 'binary'
+    MAGIC = b'RATECOLS'
+    ALIGNMENT = 8
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, dict) or not isinstance(data.get('rates'), np.ndarray):
+            return JSONRenderer().render(data)
+        rates = data['rates']
+        header = json.dumps({'source_currency': data['source_currency'], 'dates': data['dates'],
+                             'currencies': data['currencies'], 'shape': list(rates.shape)}).encode()
+        prefix_size = len(self.MAGIC) + 4
+        header += b' ' * (-(prefix_size + len(header)) % self.ALIGNMENT)
+        return self.MAGIC + struct.pack('<I', len(header)) + header + \
+            np.ascontiguousarray(rates, dtype='<f8').tobytes()
@@ -1,7 +1,95 @@
+import json
+import math
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from contextlib import contextmanager
+from datetime import date, timedelta
+from unittest import mock
+
+from fixerio.exceptions import FixerioException
+from django.conf import settings
+from django.test import override_settings
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from exchange_rate.models import Provider
+from exchange_rate.adapters import FixerAdapter
+from exchange_rate.breakers import provider_breakers
+from exchange_rate.cache import rate_cache
+from exchange_rate.currencies import currency_registry
+from exchange_rate.metrics import metrics
+from exchange_rate.models import Currency, CurrencyExchangeRate, Provider
+from exchange_rate.providers import adapter_registry
+from exchange_rate.returns import return_index
+from exchange_rate.utils import get_stored_exchange_rates_batch
+
+
+@contextmanager
+def fixer_backend(backend):
+    """ Replaces the Fixer client of the adapters used inside the context, with the provider breakers closed """
+    adapter_registry.invalidate()
+    provider_breakers.reset()
+    try:
+        with mock.patch.object(FixerAdapter, 'connect_to_fixer', return_value=backend):
+            yield backend
+    finally:
+        adapter_registry.invalidate()
+        provider_breakers.reset()
+
+
+class FakeFixer(object):
+    """ Stand-in for the Fixer client, returning EUR based rates for any date and counting the requests """
+    rates = {'USD': 1.2, 'GBP': 0.9, 'CHF': 1.1, 'EUR': 1.}
+
+    def __init__(self):
+        self.requests = []
+
+    def historical_rates(self, date, symbols=None):
+        self.requests.append(date)
+        return {'success': True, 'historical': True, 'date': date, 'base': 'EUR', 'rates': dict(self.rates)}
+
+
+class TrendFixer(FakeFixer):
+    """ Stand-in for the Fixer client, returning EUR based rates rising a 1% a day since 2021-01-01 """
+
+    def historical_rates(self, date, symbols=None):
+        exchange_values = super().historical_rates(date, symbols)
+        growth = 1.01 ** (int(date[-2:]) - 1)
+        exchange_values['rates'] = {symbol: rate if symbol == 'EUR' else round(rate * growth, 6)
+                                    for symbol, rate in exchange_values['rates'].items()}
+        return exchange_values
+
+
+class SlowFixer(FakeFixer):
+    """ Stand-in for a slow Fixer, keeping track of the maximum number of requests running at the same time """
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def historical_rates(self, date, symbols=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return super().historical_rates(date, symbols)
+
+
+class FailingFixer(FakeFixer):
+    """ Stand-in for an unavailable Fixer, counting the requests """
+
+    def historical_rates(self, date, symbols=None):
+        self.requests.append(date)
+        raise FixerioException('Fixer is not available')
 
 
 class CurrencyRatesTestCase(APITestCase):
@@ -39,6 +127,132 @@ class CurrencyRatesTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.json()), 28)
 
+    def test_currency_rates_stored_range_queries(self):
+        """
+        Ensure a range fully stored in db is loaded with a constant number of queries
+        """
+        source_currency = Currency.objects.get(symbol='EUR')
+        start_date = date(2021, 3, 1)
+        CurrencyExchangeRate.objects.bulk_create([
+            CurrencyExchangeRate(source_currency=source_currency, exchanged_currency=exchanged_currency,
+                                 valuation_date=start_date + timedelta(days=day), rate_value=1.5)
+            for day in range(30) for exchanged_currency in Currency.objects.exclude(pk=source_currency.pk)])
+
+        currency_registry.load()
+        url = 'http://127.0.0.1:8000/api/currency_rates?source_currency=EUR&date_from=2021-03-01&date_to=2021-03-30'
+        # The version of the stored rates for the ETag, and the rates
+        with self.assertNumQueries(2):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 30)
+        self.assertEqual(response.json()[0], {'source_currency': 'EUR', 'valuation_date': '2021-03-01',
+                                              'rates': {'USD': 1.5, 'GBP': 1.5, 'CHF': 1.5, 'EUR': 1.0}})
+
+    def test_currency_rates_provider_request_per_date(self):
+        """
+        Ensure missing rates are requested to fixer once per date
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        fake_fixer = FakeFixer()
+        url = 'http://127.0.0.1:8000/api/currency_rates?source_currency=GBP&date_from=2021-01-04&date_to=2021-01-06'
+        with fixer_backend(fake_fixer):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(fake_fixer.requests, ['2021-01-04', '2021-01-05', '2021-01-06'])
+        self.assertAlmostEqual(response.json()[0]['rates']['USD'], 1.2 / 0.9)
+
+    @override_settings(RATES_STREAM_CHUNK_DAYS=7)
+    def test_currency_rates_streaming(self):
+        """
+        Ensure currency rates are streamed a date per line in ndjson and csv formats, reading the range in chunks
+        """
+        source_currency = Currency.objects.get(symbol='EUR')
+        start_date = date(2021, 3, 1)
+        CurrencyExchangeRate.objects.bulk_create([
+            CurrencyExchangeRate(source_currency=source_currency, exchanged_currency=exchanged_currency,
+                                 valuation_date=start_date + timedelta(days=day), rate_value=1.5)
+            for day in range(30) for exchanged_currency in Currency.objects.exclude(pk=source_currency.pk)])
+        currency_registry.load()
+        rate_cache.clear()
+
+        url = 'http://127.0.0.1:8000/api/currency_rates?source_currency=EUR&date_from=2021-03-01&date_to=2021-03-30'
+        with self.assertNumQueries(6):
+            response = self.client.get(url + '&format=ndjson')
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(json.loads(lines[0]), {'source_currency': 'EUR', 'valuation_date': '2021-03-01',
+                                                'rates': {'USD': 1.5, 'GBP': 1.5, 'CHF': 1.5, 'EUR': 1.0}})
+
+        response = self.client.get(url, HTTP_ACCEPT='text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(lines[:2], ['source_currency,valuation_date,USD,GBP,CHF,EUR',
+                                     'EUR,2021-03-01,1.5,1.5,1.5,1.0'])
+        self.assertEqual(len(lines), 31)
+
+    def test_currency_rates_columnar(self):
+        """
+        Ensure currency rates are returned as columns in columnar and binary formats
+        """
+        source_currency = Currency.objects.get(symbol='EUR')
+        CurrencyExchangeRate.objects.bulk_create([
+            CurrencyExchangeRate(source_currency=source_currency, exchanged_currency=exchanged_currency,
+                                 valuation_date=date(2021, 3, 1) + timedelta(days=day), rate_value=1.5)
+            for day in range(2) for exchanged_currency in Currency.objects.exclude(pk=source_currency.pk)])
+        currency_registry.load()
+        rate_cache.clear()
+
+        url = 'http://127.0.0.1:8000/api/currency_rates?source_currency=EUR&date_from=2021-03-01&date_to=2021-03-02'
+        response = self.client.get(url + '&format=columnar')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'source_currency': 'EUR', 'dates': ['2021-03-01', '2021-03-02'],
+                                           'currencies': ['USD', 'GBP', 'CHF', 'EUR'],
+                                           'rates': [[1.5, 1.5, 1.5, 1.], [1.5, 1.5, 1.5, 1.]]})
+
+        response = self.client.get(url, HTTP_ACCEPT='application/vnd.nucoro.columnar+octet-stream')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content[:8], b'RATECOLS')
+        header_length, = struct.unpack('<I', response.content[8:12])
+        header = json.loads(response.content[12:12 + header_length])
+        self.assertEqual(header['currencies'], ['USD', 'GBP', 'CHF', 'EUR'])
+        rates = np.frombuffer(response.content, dtype='<f8', offset=12 + header_length).reshape(header['shape'])
+        self.assertEqual(rates.tolist(), [[1.5, 1.5, 1.5, 1.], [1.5, 1.5, 1.5, 1.]])
+
+    def test_currency_rates_conditional(self):
+        """
+        Ensure past rates are cached for long once they are all stored, and answered with 304 until rates are stored
+        for the requested dates
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        url = 'http://127.0.0.1:8000/api/currency_rates?source_currency=EUR&date_from=2021-01-04&date_to=2021-01-05'
+        with fixer_backend(FakeFixer()):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Rates were requested to the providers, which could have failed to return them
+        self.assertIn('max-age=%d' % settings.RATES_HTTP_TODAY_MAX_AGE, response['Cache-Control'])
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        # The ETag of the first response covers the rates it stored
+        with fixer_backend(FakeFixer()) as fake_fixer:
+            with self.assertNumQueries(1):
+                not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertIn('max-age=%d' % settings.RATES_HTTP_MAX_AGE, not_modified['Cache-Control'])
+        self.assertEqual(fake_fixer.requests, [])
+
+        # Missing rates are not cached for long
+        with fixer_backend(FailingFixer()):
+            response = self.client.get(url.replace('2021-01-05', '2021-01-06'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('max-age=%d' % settings.RATES_HTTP_TODAY_MAX_AGE, response['Cache-Control'])
+
+        # Other formats have other ETags
+        response = self.client.get(url + '&format=columnar', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_currency_rates_param_errors(self):
         """
         Ensure we get error status on param errors
@@ -69,6 +283,46 @@ class ExchangedCurrencyAmountTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertContains(response, 'rate')
         self.assertContains(response, 'exchanged_amount')
+        self.assertIn('max-age=%d' % settings.RATES_HTTP_TODAY_MAX_AGE, response['Cache-Control'])
+
+    def test_exchanged_currency_amount_latest_rate(self):
+        """
+        Ensure the latest rate stored in the last days is used, and today's rate is requested when it is too old
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        rate_cache.clear()
+        valuation_date = date.today() - timedelta(days=2)
+        CurrencyExchangeRate.objects.create(source_currency=Currency.objects.get(symbol='EUR'),
+                                            exchanged_currency=Currency.objects.get(symbol='GBP'),
+                                            valuation_date=valuation_date, rate_value=0.8)
+        url = 'http://127.0.0.1:8000/api/exchanged_currency_amount?source_currency=EUR&exchanged_currency=GBP&amount=10'
+        with fixer_backend(FakeFixer()) as fake_fixer:
+            response = self.client.get(url)
+            self.assertEqual(response.json()['valuation_date'], valuation_date.strftime('%Y-%m-%d'))
+            self.assertEqual(response.json()['exchanged_amount'], 8.)
+            # The version of the stored rates for the ETag, the latest rate is cached
+            with self.assertNumQueries(1):
+                self.client.get(url)
+            self.assertEqual(fake_fixer.requests, [])
+
+            with override_settings(RATES_LATEST_MAX_STALENESS_DAYS=1):
+                response = self.client.get(url)
+        self.assertEqual(response.json()['valuation_date'], date.today().strftime('%Y-%m-%d'))
+        self.assertEqual(response.json()['exchanged_amount'], 9.)
+        self.assertEqual(fake_fixer.requests, [date.today().strftime('%Y-%m-%d')])
+
+    @override_settings(RATES_REQUEST_PROVIDERS=False)
+    def test_exchanged_currency_amount_not_available(self):
+        """
+        Ensure a rate neither stored nor requested to the providers is not found, synchronously and asynchronously
+        """
+        rate_cache.clear()
+        for url in ('http://127.0.0.1:8000/api/exchanged_currency_amount',
+                    'http://127.0.0.1:8000/api/async/exchanged_currency_amount'):
+            response = self.client.get(url, {'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'amount': 10})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(response.json(), {'detail': 'Exchange rate not available.'})
 
     def test_exchanged_currency_amount_param_errors(self):
         """
@@ -78,6 +332,8 @@ class ExchangedCurrencyAmountTestCase(APITestCase):
         url = 'http://127.0.0.1:8000/api/exchanged_currency_amount?source_currency=EUR&exchanged_currency=GBP&amount=a3'
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url.replace('a3', 'inf'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
         # Invalid currency
         url = 'http://127.0.0.1:8000/api/exchanged_currency_amount?source_currency=EU&exchanged_currency=GBP&amount=1.3'
@@ -90,7 +346,102 @@ class ExchangedCurrencyAmountTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class ExchangedCurrencyAmountsTestCase(APITestCase):
+    url = 'http://127.0.0.1:8000/api/exchanged_currency_amounts'
+
+    def setUp(self):
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        currency_registry.load()
+        rate_cache.clear()
+
+    def test_exchanged_currency_amounts(self):
+        """
+        Ensure a batch of conversions is answered in order, with the stored rates loaded in a single query
+        """
+        with fixer_backend(FakeFixer()):
+            FixerAdapter().get_exchange_rates_data(currency_registry.get('EUR'), [], date(2021, 1, 4))
+        rate_cache.clear()
+        items = [{'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'amount': 10, 'date': '2021-01-04'},
+                 {'source_currency': 'GBP', 'exchanged_currency': 'USD', 'amount': 9, 'date': '2021-01-04'},
+                 {'source_currency': 'USD', 'exchanged_currency': 'USD', 'amount': 2, 'date': '2021-01-04'},
+                 {'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'amount': 20, 'date': '2021-01-04'}]
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([round(item['exchanged_amount'], 4) for item in response.json()], [9., 12., 2., 18.])
+        self.assertEqual(response.json()[1], {'source_currency': 'GBP', 'exchanged_currency': 'USD',
+                                              'valuation_date': '2021-01-04', 'amount': 9.,
+                                              'rate': round(1.2 / 0.9, 6), 'exchanged_amount': 9 * round(1.2 / 0.9, 6)})
+
+    def test_exchanged_currency_amounts_stored_keys(self):
+        """
+        Ensure only the stored rates of the requested conversions are read, in full and pivot storage modes
+        """
+        eur, gbp, usd = (currency_registry.get(symbol) for symbol in ('EUR', 'GBP', 'USD'))
+        rate_keys = {(eur, gbp, date(2021, 1, 4)), (gbp, usd, date(2021, 1, 5))}
+        for storage_mode, read_rates in (('full', 2), ('pivot', 3)):
+            with self.subTest(storage_mode=storage_mode), \
+                    override_settings(RATES_STORAGE_MODE=storage_mode, RATES_PIVOT_CURRENCY='EUR'):
+                CurrencyExchangeRate.objects.all().delete()
+                with fixer_backend(FakeFixer()):
+                    for day in (4, 5):
+                        FixerAdapter().get_exchange_rates_data(eur, [], date(2021, 1, day))
+                with mock.patch.object(CurrencyExchangeRate.objects, 'filter',
+                                       wraps=CurrencyExchangeRate.objects.filter) as rates_filter:
+                    rates = get_stored_exchange_rates_batch(rate_keys)
+                self.assertEqual(rates, {(eur, gbp, date(2021, 1, 4)): 0.9,
+                                         (gbp, usd, date(2021, 1, 5)): round(1.2 / 0.9, 6)})
+                self.assertEqual(CurrencyExchangeRate.objects.filter(*rates_filter.call_args.args,
+                                                                     **rates_filter.call_args.kwargs).count(),
+                                 read_rates)
+
+    def test_exchanged_currency_amounts_many_groups(self):
+        """
+        Ensure a batch with more dates than an expression can hold is read in several bounded queries
+        """
+        eur, gbp = currency_registry.get('EUR'), currency_registry.get('GBP')
+        valuation_dates = [date(2018, 1, 1) + timedelta(days=offset) for offset in range(1200)]
+        CurrencyExchangeRate.objects.bulk_create([
+            CurrencyExchangeRate(source_currency=eur, exchanged_currency=gbp, valuation_date=valuation_date,
+                                 rate_value=0.9) for valuation_date in valuation_dates[::100]])
+        for storage_mode in ('full', 'pivot'):
+            with self.subTest(storage_mode=storage_mode), \
+                    override_settings(RATES_STORAGE_MODE=storage_mode, RATES_PIVOT_CURRENCY='EUR'):
+                with self.assertNumQueries(math.ceil(1200 / settings.RATES_BATCH_QUERY_GROUPS)):
+                    rates = get_stored_exchange_rates_batch({(eur, gbp, valuation_date)
+                                                             for valuation_date in valuation_dates})
+                self.assertEqual(rates, {(eur, gbp, valuation_date): 0.9 for valuation_date in valuation_dates[::100]})
+
+    def test_exchanged_currency_amounts_providers_and_errors(self):
+        """
+        Ensure rates not stored are requested once per source currency and date, and invalid items get their error
+        """
+        items = [{'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'amount': 10, 'date': '2021-01-05'},
+                 {'source_currency': 'EURO', 'exchanged_currency': 'GBP', 'amount': 10},
+                 {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 10, 'date': '2021-01-05'},
+                 {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'date': '2021-01-05'},
+                 {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 1, 'date': '05/01/2021'},
+                 {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 'nan', 'date': '2021-01-05'},
+                 {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': '-inf', 'date': '2021-01-05'}]
+        with fixer_backend(FakeFixer()) as fake_fixer:
+            response = self.client.post(self.url, items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(fake_fixer.requests, ['2021-01-05'])
+        data = response.json()
+        self.assertEqual([item.get('exchanged_amount') and round(item['exchanged_amount'], 4) for item in data],
+                         [9., None, 12., None, None, None, None])
+        self.assertEqual([item.get('status_code') for item in data], [None, 404, None, 400, 400, 400, 400])
+
+        response = self.client.post(self.url, {'source_currency': 'EUR'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class TimeWeightedRateTestCase(APITestCase):
+    def setUp(self):
+        return_index.clear()
+        rate_cache.clear()
+
     def test_time_weight_rate(self):
         """
         Ensure we get error status on param errors
@@ -100,6 +451,32 @@ class TimeWeightedRateTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertContains(response, 'twr')
 
+    def test_time_weight_rate_cash_flows(self):
+        """
+        Ensure the time weighted rate is the product of the sub-periods returns, not affected by cash flows
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        url = 'http://127.0.0.1:8000/api/twr?source_currency=EUR&exchanged_currency=USD&amount=100' \
+              '&date_from=2021-01-04&date_to=2021-01-08'
+        with fixer_backend(TrendFixer()):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            end_rate, initial_rate = round(1.2 * 1.01 ** 7, 6), round(1.2 * 1.01 ** 3, 6)
+            self.assertAlmostEqual(response.json()['twr'], end_rate / initial_rate - 1)
+            self.assertAlmostEqual(response.json()['end_value'], 100 * end_rate)
+
+            response = self.client.get(url + '&cash_flows=2021-01-05:50,2021-01-07:-25')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertAlmostEqual(response.json()['twr'], end_rate / initial_rate - 1)
+            self.assertAlmostEqual(response.json()['end_value'], 125 * end_rate)
+
+            response = self.client.get(url + '&cash_flows=2021-01-05:-150')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            response = self.client.get(url + '&cash_flows=2021-01-05:nan')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_time_weight_rate_param_errors(self):
         """
         Ensure we get error status on param errors
@@ -114,6 +491,15 @@ class TimeWeightedRateTestCase(APITestCase):
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+        # Amount not positive
+        for amount in ('0', '-1.3', 'nan'):
+            url = 'http://127.0.0.1:8000/api/twr?source_currency=EUR&exchanged_currency=GBP&amount=%s' \
+                  '&date_from=2020-05-15' % amount
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.get(url + '&date_to=2020-05-17&cash_flows=2020-05-16:10', format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
         # invalid currency
         url = 'http://127.0.0.1:8000/api/twr?source_currency=EURO&exchanged_currency=GBP&amount=1,3&date_from=2020-05-15'
         response = self.client.get(url, format='json')
@@ -128,3 +514,123 @@ class TimeWeightedRateTestCase(APITestCase):
         url = 'http://127.0.0.1:8000/api/twr?source_currency=EURO&exchanged_currency=GBP&amount=1.3'
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncViewsTestCase(APITestCase):
+    def setUp(self):
+        rate_cache.clear()
+        return_index.clear()
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+
+    def test_async_currency_rates(self):
+        """
+        Ensure the missing dates of a range are requested to fixer concurrently
+        """
+        slow_fixer = SlowFixer(0.1)
+        url = 'http://127.0.0.1:8000/api/async/currency_rates?source_currency=EUR&date_from=2021-01-04&date_to=2021-01-08'
+        with fixer_backend(slow_fixer):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual(response.json()[0]['rates'], {'USD': 1.2, 'GBP': 0.9, 'CHF': 1.1, 'EUR': 1.})
+        self.assertEqual(sorted(slow_fixer.requests), ['2021-01-04', '2021-01-05', '2021-01-06', '2021-01-07',
+                                                       '2021-01-08'])
+        self.assertGreater(slow_fixer.max_running, 1)
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 5 * 12)
+
+    def test_async_currency_rates_long_range(self):
+        """
+        Ensure a range with more missing dates than executor threads is requested without waiting for the leases to
+        time out
+        """
+        slow_fixer = SlowFixer(0.05)
+        # The default executor has at most 32 threads
+        days = 60
+        date_to = date(2021, 1, 1) + timedelta(days=days - 1)
+        url = 'http://127.0.0.1:8000/api/async/currency_rates?source_currency=EUR&date_from=2021-01-01&date_to=%s' \
+              % date_to
+        started_at = time.monotonic()
+        with fixer_backend(slow_fixer):
+            response = self.client.get(url)
+        self.assertLess(time.monotonic() - started_at, 10)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(slow_fixer.requests), days)
+        self.assertTrue(all(None not in item['rates'].values() for item in response.json()))
+
+    def test_async_provider_timeout(self):
+        """
+        Ensure a provider taking longer than its timeout is skipped
+        """
+        Provider.objects.filter(name='Fixer').update(timeout=0.05)
+        timeouts = metrics.get('provider.Fixer.timeouts')
+        url = 'http://127.0.0.1:8000/api/async/exchanged_currency_amount?source_currency=EUR&exchanged_currency=GBP' \
+              '&amount=1.3'
+        with fixer_backend(SlowFixer(0.5)):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'exchanged_amount')
+        self.assertEqual(metrics.get('provider.Fixer.timeouts'), timeouts + 1)
+
+    def test_async_twr(self):
+        """
+        Ensure we can get the time weighted rate asynchronously
+        """
+        url = 'http://127.0.0.1:8000/api/async/twr?source_currency=EUR&exchanged_currency=GBP&amount=1.3' \
+              '&date_from=2020-05-15'
+        with fixer_backend(FakeFixer()):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['twr'], 0.)
+
+    def test_async_conditional(self):
+        """
+        Ensure async responses have ETags, and are answered with 304 until rates are stored for the requested dates
+        """
+        url = 'http://127.0.0.1:8000/api/async/currency_rates?source_currency=EUR&date_from=2021-01-04&date_to=2021-01-05'
+        with fixer_backend(FakeFixer()) as fake_fixer:
+            response = self.client.get(url)
+            self.assertIn('max-age=%d' % settings.RATES_HTTP_TODAY_MAX_AGE, response['Cache-Control'])
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertIn('max-age=%d' % settings.RATES_HTTP_MAX_AGE, not_modified['Cache-Control'])
+
+            url = 'http://127.0.0.1:8000/api/async/twr?source_currency=EUR&exchanged_currency=GBP&amount=1.3' \
+                  '&date_from=2021-01-04&date_to=2021-01-05'
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(fake_fixer.requests), 2)
+
+    def test_async_param_errors(self):
+        """
+        Ensure we get error status on param errors
+        """
+        url = 'http://127.0.0.1:8000/api/async/currency_rates?source_currency=EUR&date_from=2021-05-15'
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        url = 'http://127.0.0.1:8000/api/async/twr?source_currency=EURO&exchanged_currency=GBP&amount=1.3' \
+              '&date_from=2020-05-15'
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        url = 'http://127.0.0.1:8000/api/async/twr?source_currency=EUR&exchanged_currency=GBP&amount=0' \
+              '&date_from=2020-05-15'
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post('http://127.0.0.1:8000/api/async/twr')
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class MetricsTestCase(APITestCase):
+    def test_metrics(self):
+        """
+        Ensure we can get the process counters
+        """
+        url = 'http://127.0.0.1:8000/api/metrics'
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsInstance(response.json(), dict)
@@ -1,9 +1,17 @@
 from django.urls import path
 
-from api.views import currency_rates, exchanged_currency_amount, twr
+from api.views import currency_rates, exchanged_currency_amount, exchanged_currency_amounts, metrics_counters, twr, \
+    async_currency_rates, async_exchanged_currency_amount, async_twr
 
 urlpatterns = [
     path(r'currency_rates', currency_rates),
     path(r'twr', twr),
     path(r'exchanged_currency_amount', exchanged_currency_amount),
+    path(r'exchanged_currency_amounts', exchanged_currency_amounts),
+    path(r'metrics', metrics_counters),
+
+    # Async versions, requesting providers concurrently when served under ASGI
+    path(r'async/currency_rates', async_currency_rates),
+    path(r'async/twr', async_twr),
+    path(r'async/exchanged_currency_amount', async_exchanged_currency_amount),
 ]
@@ -1,9 +1,11 @@
+import math
+
 from datetime import datetime
 
 from django.conf import settings
 from rest_framework.exceptions import ValidationError, NotFound
 
-from exchange_rate.models import Currency
+from exchange_rate.currencies import currency_registry
 
 
 def empty_params_validator(*args):
@@ -15,7 +17,7 @@ def empty_params_validator(*args):
 def currency_available_validator(currency):
     if currency not in settings.AVAILABLE_CURRENCIES:
         raise NotFound('Currency "%s" not found. ' % currency)
-    return Currency.objects.filter(symbol=currency).first()
+    return currency_registry.get(currency)
 
 
 def date_validator(str_date):
@@ -30,3 +32,39 @@ def float_validator(amount):
         return float(amount)
     except Exception as e:
         raise ValidationError('"amount" should be a float: ' + str(e))
+
+
+def finite_amount_validator(amount):
+    if not math.isfinite(amount):
+        raise ValidationError('"amount" should be a finite number.')
+    return amount
+
+
+def positive_amount_validator(amount):
+    if finite_amount_validator(amount) <= 0:
+        raise ValidationError('"amount" should be positive.')
+    return amount
+
+
+def cash_flows_validator(cash_flows, amount, start_date, end_date):
+    """ Parses cash flows given as comma separated YYYY-MM-DD:amount items, checking they are inside the period and the
+    invested amount stays positive """
+    flows = {}
+    try:
+        for cash_flow in cash_flows.split(','):
+            str_date, str_amount = cash_flow.split(':')
+            flow_date = datetime.strptime(str_date.strip(), '%Y-%m-%d').date()
+            flow_amount = float(str_amount)
+            if not math.isfinite(flow_amount):
+                raise ValueError('%s is not a number' % str_amount)
+            flows[flow_date] = flows.get(flow_date, 0.) + flow_amount
+    except Exception as e:
+        raise ValidationError('Invalid cash flows format. Should be YYYY-MM-DD:amount,...: ' + str(e))
+    positive_amount_validator(amount)
+    if any(not start_date <= flow_date < end_date for flow_date in flows):
+        raise ValidationError('Cash flows should be between date_from and the day before date_to.')
+    for flow_date in sorted(flows):
+        amount += flows[flow_date]
+        if amount <= 0:
+            raise ValidationError('The invested amount should stay positive after the cash flows.')
+    return flows
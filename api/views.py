@@ -1,55 +1,275 @@
+import asyncio
+import hashlib
+
+from datetime import date, timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.exceptions import APIException, MethodNotAllowed, NotFound, ValidationError
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from .validators import currency_available_validator, empty_params_validator, date_validator, float_validator
-from exchange_rate.utils import get_currency_rates, get_exchanged_currency_amount, get_time_weighted_rate_return
+from .renderers import ColumnarBinaryRenderer, ColumnarJSONRenderer, CSVRenderer, NDJSONRenderer
+from .validators import currency_available_validator, empty_params_validator, date_validator, float_validator, \
+    cash_flows_validator, finite_amount_validator, positive_amount_validator
+from exchange_rate.metrics import metrics
+from exchange_rate.utils import get_currency_rates, get_exchanged_currency_amount, get_time_weighted_rate_return, \
+    get_exchanged_currency_amounts, get_columnar_currency_rates, get_stored_rates_version, iter_currency_rates, \
+    aget_currency_rates, aget_exchanged_currency_amount, aget_time_weighted_rate_return
 
 
-@api_view(['GET'])
-def currency_rates(request):
-    """ Currency rates for a specific time period
+def async_api_view(view):
+    """ Decorator for async GET views, returning API exceptions as error responses like api_view does """
+    @wraps(view)
+    async def wrapped_view(request, *args, **kwargs):
+        try:
+            if request.method != 'GET':
+                raise MethodNotAllowed(request.method)
+            return await view(request, *args, **kwargs)
+        except APIException as e:
+            data = e.detail if isinstance(e.detail, (list, dict)) else {'detail': e.detail}
+            return JsonResponse(data, status=e.status_code, safe=False)
+    return wrapped_view
+
+
+def conditional_rates_view(rates_slice):
+    """ Decorator for sync and async views whose response only depends on the rates stored for a slice of dates, adding
+    ETag and Cache-Control headers, and answering conditional requests with 304 without running the view.
+    The ETag changes whenever rates are stored or deleted in the slice. If some rates were not stored before the view
+    ran and the view stored some, the ETag of its response is taken afterwards, so it covers them.
+    Responses are cached for settings.RATES_HTTP_MAX_AGE seconds if the slice is in the past and all its rates were
+    stored, or settings.RATES_HTTP_TODAY_MAX_AGE seconds if it includes today or some rates had to be requested to the
+    providers, which may have failed to return them.
+    Rates have no modification time, so there is no Last-Modified header.
+    Parameters: rates_slice: function getting the source currency and the (start_date, end_date) ranges of the slice
+                from the request params
+    """
+    def get_slice_etag(request):
+        """ ETag of the request, whether the rates of its slice are complete and whether its response can be cached for
+        long, or None if its params are invalid """
+        try:
+            source_currency, date_ranges = rates_slice(request.GET)
+        except APIException:
+            # Let the view return the error
+            return None
+        version, complete = get_stored_rates_version(source_currency, *date_ranges)
+        etag = quote_etag(hashlib.md5(repr((request.path, sorted(request.GET.lists()),
+                                            request.META.get('HTTP_ACCEPT'), version)).encode()).hexdigest())
+        return etag, complete, complete and max(end_date for start_date, end_date in date_ranges) < date.today()
+
+    def patch_response(response, etag, cacheable):
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            max_age = settings.RATES_HTTP_MAX_AGE if cacheable else settings.RATES_HTTP_TODAY_MAX_AGE
+            patch_cache_control(response, public=True, max_age=max_age)
+            patch_vary_headers(response, ['Accept'])
+        return response
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapped_view(request, *args, **kwargs):
+                slice_etag = await sync_to_async(get_slice_etag)(request)
+                if slice_etag is None:
+                    return await view(request, *args, **kwargs)
+                etag, complete, cacheable = slice_etag
+                response = get_conditional_response(request, etag=etag)
+                if response is None:
+                    saved = metrics.get('rates.saved')
+                    response = await view(request, *args, **kwargs)
+                    if not complete and response.status_code == status.HTTP_200_OK \
+                            and metrics.get('rates.saved') != saved:
+                        etag = (await sync_to_async(get_slice_etag)(request))[0]
+                return patch_response(response, etag, cacheable)
+            return async_wrapped_view
+
+        @wraps(view)
+        def wrapped_view(request, *args, **kwargs):
+            slice_etag = get_slice_etag(request)
+            if slice_etag is None:
+                return view(request, *args, **kwargs)
+            etag, complete, cacheable = slice_etag
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                saved = metrics.get('rates.saved')
+                response = view(request, *args, **kwargs)
+                # The view stored rates requested to the providers, or another request of the process did
+                if not complete and response.status_code == status.HTTP_200_OK and metrics.get('rates.saved') != saved:
+                    etag = get_slice_etag(request)[0]
+            return patch_response(response, etag, cacheable)
+        return wrapped_view
+    return decorator
+
+
+def currency_rates_slice(params):
+    source_currency, start_date, end_date = currency_rates_params(params)
+    return source_currency, [(start_date, end_date)]
+
+
+def exchanged_currency_amount_slice(params):
+    source_currency, exchanged_currency, amount = exchanged_currency_amount_params(params)
+    return source_currency, [(date.today() - timedelta(days=settings.RATES_LATEST_MAX_STALENESS_DAYS), date.today())]
+
+
+def twr_slice(params):
+    source_currency, exchanged_currency, start_date, amount, end_date, cash_flows = twr_params(params)
+    return source_currency, [(valuation_date, valuation_date) for valuation_date in (start_date, *cash_flows, end_date)]
+
+
+def currency_rates_params(params):
+    """ Validated params of currency rates requests
     Parameters: source_currency: source currency symbol/ date_from / date_to
-    Response: a time series list of rate values for each available Currency
+    Response: source currency, start date and end date
     """
     # Get params
-    currency_symbol = request.GET.get('source_currency')
-    date_from = request.GET.get('date_from')
-    date_to = request.GET.get('date_to')
+    currency_symbol = params.get('source_currency')
+    date_from = params.get('date_from')
+    date_to = params.get('date_to')
 
     # Validate params
     empty_params_validator(currency_symbol, date_from, date_to)
     source_currency = currency_available_validator(currency_symbol)
     start_date = date_validator(date_from)
     end_date = date_validator(date_to)
+    return source_currency, start_date, end_date
+
+
+def exchanged_currency_amount_params(params):
+    """ Validated params of exchanged currency amount requests
+    Parameters: source_currency, amount, exchanged_currency.
+    Response: source currency, exchanged currency and amount
+    """
+    # Get params
+    source_currency_symbol = params.get('source_currency')
+    exchanged_currency_symbol = params.get('exchanged_currency')
+    amount = params.get('amount')
+
+    # Validate params
+    empty_params_validator(source_currency_symbol, exchanged_currency_symbol, amount)
+    source_currency = currency_available_validator(source_currency_symbol)
+    exchanged_currency = currency_available_validator(exchanged_currency_symbol)
+    amount = finite_amount_validator(float_validator(amount))
+    return source_currency, exchanged_currency, amount
+
+
+def exchanged_currency_amounts_item(item):
+    """ Validated item of exchanged currency amounts requests
+    Parameters: item: dict with source_currency, exchanged_currency, amount and, optionally, date
+    Response: source currency, exchanged currency, amount and date, today if not given
+    """
+    if not isinstance(item, dict):
+        raise ValidationError('Each conversion should be an object.')
+    source_currency, exchanged_currency, amount = exchanged_currency_amount_params(item)
+    valuation_date = date_validator(item['date']) if item.get('date') is not None else date.today()
+    return source_currency, exchanged_currency, amount, valuation_date
+
+
+def twr_params(params):
+    """ Validated params of time-weighted rate of return requests
+    Parameters: source_currency, amount, exchanged_currency, start_date, optionally date_to and cash_flows
+    Response: source currency, exchanged currency, start date, amount, end date, today if not given, and cash flows
+    """
+    source_currency_symbol = params.get('source_currency')
+    exchanged_currency_symbol = params.get('exchanged_currency')
+    amount = params.get('amount')
+    date_from = params.get('date_from')
+    date_to = params.get('date_to')
+    cash_flows = params.get('cash_flows')
+
+    # Validate params
+    empty_params_validator(source_currency_symbol, exchanged_currency_symbol, amount, date_from)
+    source_currency = currency_available_validator(source_currency_symbol)
+    exchanged_currency = currency_available_validator(exchanged_currency_symbol)
+    start_date = date_validator(date_from)
+    end_date = date_validator(date_to) if date_to else date.today()
+    if end_date < start_date:
+        raise ValidationError('date_to should not be before date_from.')
+    amount = positive_amount_validator(float_validator(amount))
+    cash_flows = cash_flows_validator(cash_flows, amount, start_date, end_date) if cash_flows else {}
+    return source_currency, exchanged_currency, start_date, amount, end_date, cash_flows
+
+
+@conditional_rates_view(currency_rates_slice)
+@api_view(['GET'])
+@renderer_classes([*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer, CSVRenderer, ColumnarJSONRenderer,
+                   ColumnarBinaryRenderer])
+def currency_rates(request):
+    """ Currency rates for a specific time period
+    Parameters: source_currency: source currency symbol/ date_from / date_to / format: json, ndjson, csv, columnar or
+                binary, also selected with the Accept header
+    Response: a time series list of rate values for each available Currency, streamed a date per line in ndjson and
+              csv formats, or the list of dates, the list of currencies and the matrix of rate values in columnar and
+              binary formats
+    """
+    source_currency, start_date, end_date = currency_rates_params(request.GET)
+
+    renderer = request.accepted_renderer
+    if isinstance(renderer, (NDJSONRenderer, CSVRenderer)):
+        lines = renderer.render_lines(iter_currency_rates(source_currency, start_date, end_date))
+        return StreamingHttpResponse(lines, status=status.HTTP_200_OK,
+                                     content_type='%s; charset=%s' % (renderer.media_type, renderer.charset))
+    if isinstance(renderer, (ColumnarJSONRenderer, ColumnarBinaryRenderer)):
+        data = get_columnar_currency_rates(source_currency, start_date, end_date)
+        return Response(data, status=status.HTTP_200_OK)
 
     # Get data
     data = get_currency_rates(source_currency, start_date, end_date)
     return Response(data, status=status.HTTP_200_OK)
 
 
+@conditional_rates_view(exchanged_currency_amount_slice)
 @api_view(['GET'])
 def exchanged_currency_amount(request):
     """ Calculates (latest) amount in a currency exchanged into a different currency.
     Parameters: source_currency, amount, exchanged_currency.
     Response: an object containing the rate value between source and exchanges currencies, along with the currencies.
     """
-    # Get params
-    source_currency_symbol = request.GET.get('source_currency')
-    exchanged_currency_symbol = request.GET.get('exchanged_currency')
-    amount = request.GET.get('amount')
-
-    # Validate params
-    empty_params_validator(source_currency_symbol, exchanged_currency_symbol, amount)
-    source_currency = currency_available_validator(source_currency_symbol)
-    exchanged_currency = currency_available_validator(exchanged_currency_symbol)
-    amount = float_validator(amount)
+    source_currency, exchanged_currency, amount = exchanged_currency_amount_params(request.GET)
 
     # Get data
     data = get_exchanged_currency_amount(source_currency, exchanged_currency, amount)
+    if data is None:
+        raise NotFound('Exchange rate not available.')
+    return Response(data, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+def exchanged_currency_amounts(request):
+    """ Calculates several amounts in a currency exchanged into a different currency in a date, resolving the rates of
+    all of them at once.
+    Parameters: a list of objects with source_currency, exchanged_currency, amount and, optionally, date (today by
+                default)
+    Response: a list with an object containing the exchanged amount along with the currencies, date and exchange rate
+              for each conversion in the same order, or an error and its status code for the invalid ones
+    """
+    items = request.data
+    if not isinstance(items, list):
+        raise ValidationError('A list of conversions is expected.')
+    if len(items) > settings.RATES_BATCH_MAX_ITEMS:
+        raise ValidationError('At most %d conversions can be requested at once.' % settings.RATES_BATCH_MAX_ITEMS)
+
+    conversions = {}
+    data = [None] * len(items)
+    for index, item in enumerate(items):
+        try:
+            conversions[index] = exchanged_currency_amounts_item(item)
+        except APIException as e:
+            data[index] = {'error': e.detail, 'status_code': e.status_code}
+
+    # Get data
+    unavailable = NotFound('Exchange rate not available.')
+    for index, conversion in zip(conversions, get_exchanged_currency_amounts(list(conversions.values()))):
+        data[index] = conversion or {'error': unavailable.detail, 'status_code': unavailable.status_code}
     return Response(data, status=status.HTTP_200_OK)
 
 
+@conditional_rates_view(twr_slice)
 @api_view(['GET'])
 def twr(request):
     """ time-weighted rate of return for any given amount invested from a currency into another one from given date
@@ -58,18 +278,47 @@ def twr(request):
     Response: an object containing the rate value between source and exchanges currencies along with the currencies and
               start_date
     """
-    source_currency_symbol = request.GET.get('source_currency')
-    exchanged_currency_symbol = request.GET.get('exchanged_currency')
-    amount = request.GET.get('amount')
-    date_from = request.GET.get('date_from')
-
-    # Validate params
-    empty_params_validator(source_currency_symbol, exchanged_currency_symbol, amount, date_from)
-    source_currency = currency_available_validator(source_currency_symbol)
-    exchanged_currency = currency_available_validator(exchanged_currency_symbol)
-    start_date = date_validator(date_from)
-    amount = float_validator(amount)
+    source_currency, exchanged_currency, start_date, amount, end_date, cash_flows = twr_params(request.GET)
 
     # Get data
-    data = get_time_weighted_rate_return(source_currency, exchanged_currency, start_date, amount)
+    data = get_time_weighted_rate_return(source_currency, exchanged_currency, start_date, amount, end_date, cash_flows)
     return Response(data, status=status.HTTP_200_OK)
+
+
+@conditional_rates_view(currency_rates_slice)
+@async_api_view
+async def async_currency_rates(request):
+    """ Async version of currency_rates, requesting the missing dates to the providers concurrently """
+    source_currency, start_date, end_date = await sync_to_async(currency_rates_params)(request.GET)
+    data = await aget_currency_rates(source_currency, start_date, end_date)
+    return JsonResponse(data, status=status.HTTP_200_OK, safe=False)
+
+
+@conditional_rates_view(exchanged_currency_amount_slice)
+@async_api_view
+async def async_exchanged_currency_amount(request):
+    """ Async version of exchanged_currency_amount """
+    source_currency, exchanged_currency, amount = await sync_to_async(exchanged_currency_amount_params)(request.GET)
+    data = await aget_exchanged_currency_amount(source_currency, exchanged_currency, amount)
+    if data is None:
+        raise NotFound('Exchange rate not available.')
+    return JsonResponse(data, status=status.HTTP_200_OK)
+
+
+@conditional_rates_view(twr_slice)
+@async_api_view
+async def async_twr(request):
+    """ Async version of twr """
+    source_currency, exchanged_currency, start_date, amount, end_date, cash_flows = \
+        await sync_to_async(twr_params)(request.GET)
+    data = await aget_time_weighted_rate_return(source_currency, exchanged_currency, start_date, amount, end_date,
+                                                cash_flows)
+    return JsonResponse(data, status=status.HTTP_200_OK, safe=False)
+
+
+@api_view(['GET'])
+def metrics_counters(request):
+    """ Counters of the running process, like cache hits and misses
+    Response: an object containing the value of each counter
+    """
+    return Response(metrics.snapshot(), status=status.HTTP_200_OK)
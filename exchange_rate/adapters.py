@@ -1,17 +1,31 @@
 """
 https://charlesleifer.com/blog/django-patterns-pluggable-backends/
 """
+import numpy as np
+import requests
+
 from datetime import datetime
+from asgiref.sync import sync_to_async
 from fixerio import Fixerio
+from fixerio.client import BASE_URL, LATEST_PATH
 from fixerio.exceptions import FixerioException
+from requests.adapters import HTTPAdapter
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 from random_exchange.client import RandomClient
-from exchange_rate.models import CurrencyExchangeRate, Currency
+from exchange_rate.cache import rate_cache
+from exchange_rate.currencies import currency_registry, get_pivot_currency
+from exchange_rate.metrics import metrics
+from exchange_rate.models import CurrencyExchangeRate
+from exchange_rate.returns import return_index
+from exchange_rate.writebehind import write_behind
 
 
 class BaseAdapter(object):
+    """ Adapter instances are shared by all requests (see exchange_rate.providers), so they have to be thread safe """
+
     def __init__(self):
         self.backend = self.get_backend()
 
@@ -26,6 +40,58 @@ class BaseAdapter(object):
         """
         raise NotImplementedError
 
+    def get_exchange_rates_data(self, source_currency, exchanged_currencies, valuation_date):
+        """ Gets the rates from a source currency into several exchanged currencies for a single date.
+        Adapters whose backend returns a whole day at once should override it to make a single request.
+
+        :param source_currency: source currency.
+        :type source_currency: Currency
+        :param exchanged_currencies: currencies to get the rate for.
+        :type exchanged_currencies: list of Currency
+        :param valuation_date: date of the rates.
+        :type valuation_date: date
+        :return: the rate values found, keyed by exchanged currency symbol
+        :rtype: dict
+        """
+        rates = {}
+        for exchanged_currency in exchanged_currencies:
+            rate_data = self.get_exchange_rate_data(source_currency, exchanged_currency, valuation_date)
+            if rate_data:
+                rates[exchanged_currency.symbol] = rate_data['rate_value']
+        return rates
+
+    async def aget_exchange_rate_data(self, source_currency, exchanged_currency, valuation_date):
+        """ Async version of get_exchange_rate_data. By default the sync version runs in the thread used for database
+        access, adapters doing network requests should override it to run them concurrently.
+        """
+        return await sync_to_async(self.get_exchange_rate_data)(source_currency, exchanged_currency, valuation_date)
+
+    async def aget_exchange_rates_data(self, source_currency, exchanged_currencies, valuation_date):
+        """ Async version of get_exchange_rates_data. By default the sync version runs in the thread used for database
+        access, adapters doing network requests should override it to run them concurrently.
+        """
+        return await sync_to_async(self.get_exchange_rates_data)(source_currency, exchanged_currencies,
+                                                                 valuation_date)
+
+    def get_exchange_values(self, valuation_date):
+        """ Gets the rates of a date from the pivot currency into every currency, without storing them.
+        Adapters whose backend returns a whole day at once should override it to make a single request.
+
+        :param valuation_date: date of the rates.
+        :type valuation_date: date
+        :return: exchange rates for the pivot currency as {'date', 'base', 'rates'}, or None if they are not available
+        :rtype: dict
+        """
+        pivot_currency = currency_registry.get(settings.RATES_PIVOT_CURRENCY)
+        rates = {pivot_currency.symbol: 1.}
+        for exchanged_currency in currency_registry.all():
+            if exchanged_currency != pivot_currency:
+                rate_data = self.get_exchange_rate_data(pivot_currency, exchanged_currency, valuation_date)
+                if not rate_data:
+                    return None
+                rates[exchanged_currency.symbol] = rate_data['rate_value']
+        return {'date': self.date_to_str(valuation_date), 'base': pivot_currency.symbol, 'rates': rates}
+
     @classmethod
     def date_to_str(cls, str_date):
         return datetime.strftime(str_date, "%Y-%m-%d")
@@ -35,58 +101,139 @@ class BaseAdapter(object):
         return datetime.strptime(d_date, "%Y-%m-%d")
 
     @classmethod
-    def convert_exchange_base(cls, exchange_values):
-        """ Creates a list of exchange rates based on each currency in exchange_values['rates']
+    def get_exchange_matrix(cls, exchange_values):
+        """ Computes the exchange rates between every pair of currencies in exchange_values['rates'] with a single
+        outer division
 
         :param exchange_values: exchange rates for a given base currency.
         :type exchange_values: dict
-        :return: a list of based exchange rates
-        :rtype: list of dict
+        :return: the currency symbols, and the matrix whose [i, j] item is the rate from symbols[i] into symbols[j]
+        :rtype: tuple of list and numpy.ndarray
         """
-        bases = exchange_values['rates'].keys()
-        rates = exchange_values['rates']
-        exchange_rates = [{'base': base, 'date': exchange_values['date'],
-                           'rates': {rate: rates[rate] / rates[base] for rate in rates}} for base in bases]
-
-        return exchange_rates
+        symbols = list(exchange_values['rates'])
+        rates = np.fromiter(exchange_values['rates'].values(), dtype=float, count=len(symbols))
+        return symbols, rates[np.newaxis, :] / rates[:, np.newaxis]
 
     @classmethod
     def parse_currency(cls, symbol):
-        return Currency.objects.get(symbol=symbol)
+        return currency_registry.get_currency(symbol)
 
     @classmethod
-    def parse_exchange_rates(cls, exchange_rates):
-        """ Creates a list of CurrencyExchangeRate objects from a list of based exchange rates
+    def parse_exchange_matrix(cls, symbols, exchange_matrix, valuation_date, currencies=None):
+        """ Creates the CurrencyExchangeRate objects of every pair of different currencies in an exchange matrix
 
-        :param exchange_rates: list of based exchange rates.
-        :type exchange_rates: list
+        :param symbols: currency symbols of the matrix rows and columns.
+        :type symbols: list
+        :param exchange_matrix: matrix whose [i, j] item is the rate from symbols[i] into symbols[j].
+        :type exchange_matrix: numpy.ndarray
+        :param valuation_date: date of the rates, as YYYY-MM-DD.
+        :type valuation_date: str
+        :param currencies: Currency of each symbol, looked up in the currency registry if not given.
+        :type currencies: list of Currency
         :return: a list of CurrencyExchangeRate objects
         :rtype: list of CurrencyExchangeRate
         """
-        currency_exchange_rates = []
-        for exchange in exchange_rates:
-            source_currency_symbol = exchange['base']
-            source_currency = cls.parse_currency(source_currency_symbol)
-            for exchanged_currency_symbol in exchange['rates']:
-                if source_currency_symbol != exchanged_currency_symbol:
-                    exchanged_currency = cls.parse_currency(exchanged_currency_symbol)
-                    cur_exchange_rate = CurrencyExchangeRate(source_currency=source_currency,
-                                                             exchanged_currency=exchanged_currency,
-                                                             valuation_date=cls.parse_date(exchange['date']),
-                                                             rate_value=exchange['rates'][exchanged_currency_symbol])
-                    currency_exchange_rates.append(cur_exchange_rate)
-        return currency_exchange_rates
-
-    def store_values(self, exchange_rates):
-        """ Stores in database all rates from source based curency exchange rates
-
-        :param exchange_rates: exchange rates for a given base currency.
-        :type exchange_rates: list
-        :return: a list of CurrencyExchangeRate objects
-        :rtype: created CurrencyExchangeRate objects as a list
+        if currencies is None:
+            currencies = [cls.parse_currency(symbol) for symbol in symbols]
+        currency_ids = np.array([currency.id for currency in currencies])
+        valuation_date = cls.parse_date(valuation_date).date()
+        source_indexes, exchanged_indexes = np.nonzero(~np.eye(len(symbols), dtype=bool))
+        # Positional arguments follow the model fields order: id, source, exchanged, date and rate, and are faster
+        return [CurrencyExchangeRate(None, source_id, exchanged_id, valuation_date, rate_value)
+                for source_id, exchanged_id, rate_value in zip(currency_ids[source_indexes].tolist(),
+                                                               currency_ids[exchanged_indexes].tolist(),
+                                                               exchange_matrix[source_indexes,
+                                                                               exchanged_indexes].tolist())]
+
+    def parse_exchange_values(self, source_currency, exchanged_currencies, exchange_values):
+        """ Stores the rates of a whole day returned by the backend, returning the ones from source currency into
+        exchanged currencies """
+        if exchange_values is None:
+            return {}
+        symbols, exchange_matrix = self.get_exchange_matrix(exchange_values)
+        self.store_matrix(symbols, exchange_matrix, exchange_values['date'])
+
+        if source_currency.symbol not in symbols:
+            return {}
+        rates = dict(zip(symbols, exchange_matrix[symbols.index(source_currency.symbol)].tolist()))
+        return {exchanged_currency.symbol: rates[exchanged_currency.symbol]
+                for exchanged_currency in exchanged_currencies if exchanged_currency.symbol in rates}
+
+    @classmethod
+    def save_rates(cls, currency_exchange_rates):
+        """ Inserts rates in database skipping the ones already stored, or enqueues them in the write behind buffer
+        if settings.RATES_WRITE_BEHIND is set, so the request does not wait for the insert
+
+        :param currency_exchange_rates: rates to store.
+        :type currency_exchange_rates: list of CurrencyExchangeRate
+        :return: created, or enqueued, CurrencyExchangeRate objects as a list
+        :rtype: list of CurrencyExchangeRate
+        """
+        if settings.RATES_WRITE_BEHIND:
+            write_behind.add(currency_exchange_rates)
+            return currency_exchange_rates
+        metrics.increment('rates.saved', len(currency_exchange_rates))
+        return CurrencyExchangeRate.objects.bulk_create(currency_exchange_rates, ignore_conflicts=True)
+
+    def store_matrix(self, symbols, exchange_matrix, valuation_date):
+        """ Stores in database all rates of an exchange matrix, or only the pivot currency row in pivot storage mode.
+        Rates already stored for the same currencies and date are left untouched, so storing a day twice is harmless.
+        All of them are added to the rates cache.
+
+        :param symbols: currency symbols of the matrix rows and columns.
+        :type symbols: list
+        :param exchange_matrix: matrix whose [i, j] item is the rate from symbols[i] into symbols[j].
+        :type exchange_matrix: numpy.ndarray
+        :param valuation_date: date of the rates, as YYYY-MM-DD.
+        :type valuation_date: str
+        :return: created CurrencyExchangeRate objects as a list
+        :rtype: list of CurrencyExchangeRate
         """
-        currency_exchange_rates = self.parse_exchange_rates(exchange_rates)
-        return CurrencyExchangeRate.objects.bulk_create(currency_exchange_rates)
+        currency_exchange_rates = self.parse_exchange_matrix(symbols, exchange_matrix, valuation_date)
+        pivot_currency = get_pivot_currency()
+        if pivot_currency is not None:
+            currency_exchange_rates = [rate for rate in currency_exchange_rates
+                                       if rate.source_currency_id == pivot_currency.id]
+        created_exchange_rates = self.save_rates(currency_exchange_rates)
+        valuation_date = self.parse_date(valuation_date).date()
+        rounded_matrix = exchange_matrix.round(6).tolist()
+        rate_cache.set_many((source_symbol, exchanged_symbol, valuation_date, rate_value)
+                            for source_symbol, rates in zip(symbols, rounded_matrix)
+                            for exchanged_symbol, rate_value in zip(symbols, rates)
+                            if source_symbol != exchanged_symbol)
+        return_index.update_matrix(symbols, exchange_matrix, valuation_date)
+        return created_exchange_rates
+
+
+class FixerClient(Fixerio):
+    """ Fixer client keeping its connections alive in a pooled HTTP session, with request timeouts """
+    base_url = BASE_URL
+
+    def __init__(self, access_key, symbols=None, pool_size=10, timeout=None):
+        super().__init__(access_key, symbols=symbols)
+        self.timeout = timeout
+        self.session = requests.Session()
+        http_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', http_adapter)
+        self.session.mount('https://', http_adapter)
+
+    def request(self, path, symbols=None):
+        try:
+            payload = self._create_payload(symbols or self.symbols)
+            response = self.session.get(self.base_url + path, params=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as ex:
+            raise FixerioException(str(ex))
+
+    def latest(self, symbols=None):
+        return self.request(LATEST_PATH, symbols)
+
+    def historical_rates(self, date, symbols=None):
+        if not isinstance(date, str):
+            # Convert date to ISO 8601 format.
+            date = date.isoformat()
+        return self.request(date, symbols)
 
 
 class FixerAdapter(BaseAdapter):
@@ -95,36 +242,100 @@ class FixerAdapter(BaseAdapter):
         return self.connect_to_fixer()
 
     def get_exchange_rate_data(self, source_currency, exchanged_currency, valuation_date):
+        rates = self.get_exchange_rates_data(source_currency, [exchanged_currency], valuation_date)
+        if exchanged_currency.symbol not in rates:
+            return None
+        return {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
+                'valuation_date': self.date_to_str(valuation_date),
+                'rate_value': rates[exchanged_currency.symbol]}
+
+    async def aget_exchange_rate_data(self, source_currency, exchanged_currency, valuation_date):
+        rates = await self.aget_exchange_rates_data(source_currency, [exchanged_currency], valuation_date)
+        if exchanged_currency.symbol not in rates:
+            return None
+        return {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
+                'valuation_date': self.date_to_str(valuation_date),
+                'rate_value': rates[exchanged_currency.symbol]}
+
+    def get_exchange_rates_data(self, source_currency, exchanged_currencies, valuation_date):
+        # Fixer returns the full rate matrix of a date in a single request
+        exchange_values = self.get_exchange_values(valuation_date)
+        return self.parse_exchange_values(source_currency, exchanged_currencies, exchange_values)
+
+    async def aget_exchange_rates_data(self, source_currency, exchanged_currencies, valuation_date):
+        # The request runs in its own thread, and the rates are stored in the thread used for database access
+        exchange_values = await sync_to_async(self.get_exchange_values, thread_sensitive=False)(valuation_date)
+        return await sync_to_async(self.parse_exchange_values)(source_currency, exchanged_currencies, exchange_values)
+
+    def get_exchange_values(self, valuation_date):
+        """ Requests the rates of a date to Fixer, returning None if they are not available """
         try:
             exchange_values = self.backend.historical_rates(self.date_to_str(valuation_date))
         except FixerioException:
             return None
         if not exchange_values['success']:
             return None
-        full_based_exchange_rates = self.convert_exchange_base(exchange_values)
-        self.store_values(full_based_exchange_rates)
-
-        for exchange_rates in full_based_exchange_rates:
-            if exchange_rates['base'] == source_currency.symbol:
-                return {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
-                        'valuation_date': self.date_to_str(valuation_date),
-                        'rate_value': exchange_rates['rates'][exchanged_currency.symbol]}
-        return None
+        return exchange_values
 
     @classmethod
     def connect_to_fixer(cls):
-        return Fixerio(access_key=settings.FIXER_KEY, symbols=settings.AVAILABLE_CURRENCIES)
+        return FixerClient(access_key=settings.FIXER_KEY, symbols=settings.AVAILABLE_CURRENCIES,
+                           pool_size=settings.PROVIDER_HTTP_POOL_SIZE, timeout=settings.PROVIDER_HTTP_TIMEOUT)
 
 
 class MockAdapter(BaseAdapter):
+    """ Adapter of the random rates client. With settings.RANDOM_EXCHANGE_SEED set, rates are a reproducible random
+    walk generated without database access, and whole days are generated and stored at once as Fixer ones are.
+    """
+
     def get_backend(self):
         return self.connect_to_mock()
 
     def get_exchange_rate_data(self, source_currency, exchanged_currency, valuation_date):
-        rate = self.backend.get_random_exchange(source_currency, exchanged_currency)
+        if self.backend.seeded:
+            _, rates = self.backend.get_rates(source_currency.symbol, [exchanged_currency.symbol], valuation_date,
+                                              valuation_date)
+            rate = float(rates[0, 0])
+        else:
+            rate = self.backend.get_random_exchange(source_currency, exchanged_currency)
         return {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
                 'valuation_date': self.date_to_str(valuation_date), 'rate_value': rate}
 
+    def get_exchange_rates_data(self, source_currency, exchanged_currencies, valuation_date):
+        if not self.backend.seeded:
+            return super().get_exchange_rates_data(source_currency, exchanged_currencies, valuation_date)
+        exchange_values = self.get_exchange_values(valuation_date)
+        return self.parse_exchange_values(source_currency, exchanged_currencies, exchange_values)
+
+    def get_exchange_values(self, valuation_date):
+        if not self.backend.seeded:
+            return super().get_exchange_values(valuation_date)
+        return self.backend.get_exchange_values(settings.RATES_PIVOT_CURRENCY,
+                                                [currency.symbol for currency in currency_registry.all()],
+                                                valuation_date)
+
+    def get_currency_rates(self, source_currency, exchanged_currencies, start_date, end_date):
+        """ Gets the seeded rates from a source currency into several currencies in a time period with a single
+        vectorized call, without storing them
+
+        :param source_currency: currency the rates are from.
+        :type source_currency: Currency
+        :param exchanged_currencies: currencies the rates are into.
+        :type exchanged_currencies: list of Currency
+        :param start_date: first date of the period.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: the dates of the period, and the dates x currencies matrix of rates
+        :rtype: tuple of list and numpy.ndarray
+        :raises ImproperlyConfigured: if settings.RANDOM_EXCHANGE_SEED is not set, as unseeded rates are generated one
+            by one from the last one stored
+        """
+        if not self.backend.seeded:
+            raise ImproperlyConfigured('Periods of rates are only generated with RANDOM_EXCHANGE_SEED set.')
+        return self.backend.get_rates(source_currency.symbol, [currency.symbol for currency in exchanged_currencies],
+                                      start_date, end_date)
+
     @classmethod
     def connect_to_mock(cls):
-        return RandomClient()
+        return RandomClient(seed=settings.RANDOM_EXCHANGE_SEED, volatility=settings.RANDOM_EXCHANGE_VOLATILITY)
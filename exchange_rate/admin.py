@@ -1,7 +1,9 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Provider, CurrencyExchangeRate, Currency
+from .breakers import provider_breakers
+from .quotas import provider_quotas
+from .models import Provider, CurrencyExchangeRate, Currency, IngestionState
 
 
 class CurrencyExchangeRateAdmin(admin.ModelAdmin):
@@ -15,11 +17,30 @@ class CurrencyAdmin(admin.ModelAdmin):
 
 
 class ProviderAdmin(admin.ModelAdmin):
-    fields = ['name', 'priority', 'adapter']
-    list_display = ['name', 'priority', 'adapter']
+    fields = ['name', 'priority', 'adapter', 'timeout', 'hedge_delay', 'failure_threshold', 'reset_timeout',
+              'rate_limit', 'rate_burst', 'monthly_quota', 'quota_usage']
+    readonly_fields = ['quota_usage']
+    list_display = ['name', 'priority', 'adapter', 'timeout', 'breaker_state', 'rate_limit', 'quota_usage']
     ordering = ('priority',)
 
+    @admin.display(description='Breaker')
+    def breaker_state(self, provider):
+        return provider_breakers.get_breaker(provider).state
+
+    @admin.display(description='Requests this month')
+    def quota_usage(self, provider):
+        usage = provider_quotas.get_usage(provider)
+        if provider.monthly_quota is None:
+            return str(usage)
+        return '%d / %d' % (usage, provider.monthly_quota)
+
+
+class IngestionStateAdmin(admin.ModelAdmin):
+    list_display = ['name', 'last_success_date', 'last_success_at', 'failures', 'updated_at']
+    readonly_fields = ['updated_at']
+
 
 admin.site.register(CurrencyExchangeRate, CurrencyExchangeRateAdmin)
 admin.site.register(Currency, CurrencyAdmin)
 admin.site.register(Provider, ProviderAdmin)
+admin.site.register(IngestionState, IngestionStateAdmin)
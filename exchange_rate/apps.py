@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ExchangeRateConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'exchange_rate'
+
+    def ready(self):
+        # Connect signal receivers
+        from exchange_rate import signals  # noqa: F401
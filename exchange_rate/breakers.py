@@ -0,0 +1,87 @@
+import threading
+import time
+
+from exchange_rate.metrics import metrics
+
+
+class CircuitBreaker(object):
+    """ Stops requesting a provider after failure_threshold consecutive failures.
+    After reset_timeout seconds open, a single probe request is let through (half-open): if it succeeds the breaker
+    closes again, otherwise it stays open for another reset_timeout. A probe without outcome after reset_timeout is
+    replaced by a new one.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow_request(self):
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if state == self.HALF_OPEN and (self._probe_started_at is None or
+                                            now - self._probe_started_at >= self.reset_timeout):
+                self._probe_started_at = now
+                return True
+        metrics.increment('breaker.%s.rejected' % self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            probing = self._probe_started_at is not None
+            if probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or probing:
+                    metrics.increment('breaker.%s.opened' % self.name)
+                self._opened_at = time.monotonic()
+                self._probe_started_at = None
+
+
+class BreakerRegistry(object):
+    """ Process wide registry of the circuit breaker of each provider """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get_breaker(self, provider):
+        breaker = self._breakers.get(provider.pk)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(provider.pk, CircuitBreaker(
+                    provider.name, provider.failure_threshold, provider.reset_timeout))
+        # Thresholds may have been changed in the admin
+        breaker.failure_threshold = provider.failure_threshold
+        breaker.reset_timeout = provider.reset_timeout
+        return breaker
+
+    def reset(self):
+        with self._lock:
+            self._breakers = {}
+
+
+provider_breakers = BreakerRegistry()
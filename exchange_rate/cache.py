@@ -0,0 +1,177 @@
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import date, datetime
+
+from django.conf import settings
+from django.core.cache import caches
+
+from exchange_rate.metrics import metrics
+
+
+class LRUCache(object):
+    """ Bounded, thread safe, least recently used cache whose entries can have an expiration time """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RateCache(object):
+    """ Two level cache of exchange rates keyed by (source, exchanged, date).
+    Level one is a per process LRU, level two is a Django cache backend shared between processes. Rates of past dates
+    never change so they never expire, rates of today or later expire after settings.RATES_CACHE_TODAY_TTL seconds.
+    """
+    def __init__(self, max_size, cache_alias):
+        self.local = LRUCache(max_size)
+        self.cache_alias = cache_alias
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    @classmethod
+    def get_key(cls, source_symbol, exchanged_symbol, valuation_date):
+        return 'rate:%s:%s:%s' % (source_symbol, exchanged_symbol, cls.get_date(valuation_date).isoformat())
+
+    @classmethod
+    def get_date(cls, valuation_date):
+        if isinstance(valuation_date, datetime):
+            return valuation_date.date()
+        return valuation_date
+
+    @classmethod
+    def get_timeout(cls, valuation_date):
+        if cls.get_date(valuation_date) < date.today():
+            return None
+        return settings.RATES_CACHE_TODAY_TTL
+
+    def get(self, source_currency, exchanged_currency, valuation_date):
+        """ Gets a cached rate, or None if it is not cached """
+        key = self.get_key(source_currency.symbol, exchanged_currency.symbol, valuation_date)
+        rate = self.local.get(key)
+        if rate is not None:
+            metrics.increment('rate_cache.local.hits')
+            return rate
+        metrics.increment('rate_cache.local.misses')
+
+        rate = self.shared.get(key)
+        if rate is not None:
+            metrics.increment('rate_cache.shared.hits')
+            self.local.set(key, rate, self.get_timeout(valuation_date))
+            return rate
+        metrics.increment('rate_cache.shared.misses')
+        return None
+
+    def set(self, source_currency, exchanged_currency, valuation_date, rate):
+        self.set_many([(source_currency.symbol, exchanged_currency.symbol, valuation_date, rate)])
+
+    def set_many(self, rates):
+        """ Caches several rates in both levels
+
+        :param rates: rates to cache.
+        :type rates: iterable of (source symbol, exchanged symbol, valuation date, rate value) tuples
+        """
+        shared_rates = {}
+        for source_symbol, exchanged_symbol, valuation_date, rate in rates:
+            key = self.get_key(source_symbol, exchanged_symbol, valuation_date)
+            timeout = self.get_timeout(valuation_date)
+            self.local.set(key, rate, timeout)
+            shared_rates.setdefault(timeout, {})[key] = rate
+        for timeout, values in shared_rates.items():
+            self.shared.set_many(values, timeout=timeout)
+
+    def get_latest(self, source_currency, exchanged_currency):
+        """ Gets the cached date and value of the latest rate stored for a pair, or None if it is not cached """
+        key = 'latest:%s:%s' % (source_currency.symbol, exchanged_currency.symbol)
+        latest = self.local.get(key)
+        if latest is None:
+            latest = self.shared.get(key)
+            if latest is not None:
+                self.local.set(key, latest, settings.RATES_CACHE_TODAY_TTL)
+        metrics.increment('rate_cache.latest.hits' if latest is not None else 'rate_cache.latest.misses')
+        return latest
+
+    def set_latest(self, source_currency, exchanged_currency, valuation_date, rate):
+        """ Caches the date and value of the latest rate stored for a pair, for settings.RATES_CACHE_TODAY_TTL seconds
+        as a newer one may be stored meanwhile """
+        key = 'latest:%s:%s' % (source_currency.symbol, exchanged_currency.symbol)
+        latest = (self.get_date(valuation_date), rate)
+        self.local.set(key, latest, settings.RATES_CACHE_TODAY_TTL)
+        self.shared.set(key, latest, settings.RATES_CACHE_TODAY_TTL)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+
+class NegativeCache(object):
+    """ Cache of the rates a provider failed to return, keyed by (provider, source, exchanged, date).
+    Entries expire after settings.RATES_NEGATIVE_CACHE_TTL seconds, so the provider is asked again after a while.
+    """
+
+    def __init__(self, cache_alias):
+        self.cache_alias = cache_alias
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    @classmethod
+    def get_key(cls, provider, source_symbol, exchanged_symbol, valuation_date):
+        return 'miss:%s:%s:%s:%s' % (provider.pk, source_symbol, exchanged_symbol,
+                                     RateCache.get_date(valuation_date).isoformat())
+
+    def get_missing(self, provider, source_currency, exchanged_currencies, valuation_date):
+        """ Gets the symbols of the exchanged currencies whose rate the provider recently failed to return """
+        keys = {self.get_key(provider, source_currency.symbol, exchanged_currency.symbol, valuation_date):
+                exchanged_currency.symbol for exchanged_currency in exchanged_currencies}
+        missing = {keys[key] for key in self.shared.get_many(keys.keys())}
+        metrics.increment('negative_cache.hits', len(missing))
+        metrics.increment('negative_cache.misses', len(keys) - len(missing))
+        return missing
+
+    def set_missing(self, provider, source_currency, exchanged_currencies, valuation_date):
+        """ Records the exchanged currencies whose rate the provider failed to return """
+        keys = {self.get_key(provider, source_currency.symbol, exchanged_currency.symbol, valuation_date): True
+                for exchanged_currency in exchanged_currencies}
+        if keys:
+            self.shared.set_many(keys, timeout=settings.RATES_NEGATIVE_CACHE_TTL)
+            metrics.increment('provider.%s.misses' % provider.name, len(keys))
+
+
+rate_cache = RateCache(settings.RATES_CACHE_MAX_SIZE, settings.RATES_CACHE)
+negative_cache = NegativeCache(settings.RATES_CACHE)
@@ -0,0 +1,183 @@
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from collections import namedtuple
+from datetime import date, datetime
+
+from django.conf import settings
+
+from exchange_rate.metrics import metrics
+
+
+MappedCube = namedtuple('MappedCube', ['pivot_symbol', 'start_date', 'symbols', 'rates'])
+
+
+class RateCube(object):
+    """ Read only view of a file holding the historical rates of a pivot currency as a dense dates x currencies
+    matrix, memory mapped so every process serving requests shares the same pages.
+    The file starts with a magic string, the length of a JSON header with the pivot, the first date and the currency
+    symbols, and the header padded to 64 bytes, followed by the matrix as little endian float64. Rates not stored when
+    the cube was exported are NaN.
+    The file is replaced atomically when new days are published, and processes map the new one the next time they
+    check it, at most every settings.RATES_CUBE_CHECK_INTERVAL seconds.
+    """
+    MAGIC = b'RATECUBE'
+    ALIGNMENT = 64
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file_id = None
+        self._checked_path = None
+        self._checked_at = None
+        self.cube = None
+
+    @classmethod
+    def get_date(cls, valuation_date):
+        if isinstance(valuation_date, datetime):
+            return valuation_date.date()
+        return valuation_date
+
+    @classmethod
+    def write(cls, path, pivot_symbol, start_date, symbols, rates):
+        """ Writes a rate cube to a temporary file, and replaces the one in path with it
+
+        :param path: path of the cube file.
+        :type path: str
+        :param pivot_symbol: symbol of the currency the rates are from.
+        :type pivot_symbol: str
+        :param start_date: date of the first matrix row, rows are consecutive days.
+        :type start_date: date
+        :param symbols: symbols of the currency of each matrix column.
+        :type symbols: list
+        :param rates: matrix whose [i, j] item is the rate from the pivot currency into symbols[j] in the i-th day.
+        :type rates: numpy.ndarray
+        """
+        header = json.dumps({'pivot': pivot_symbol, 'start_date': start_date.isoformat(), 'symbols': list(symbols),
+                             'shape': list(rates.shape)}).encode()
+        prefix_size = len(cls.MAGIC) + 4
+        header += b' ' * (-(prefix_size + len(header)) % cls.ALIGNMENT)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.rates-', suffix='.cube')
+        try:
+            with os.fdopen(fd, 'wb') as cube_file:
+                cube_file.write(cls.MAGIC + struct.pack('<I', len(header)) + header)
+                cube_file.write(np.ascontiguousarray(rates, dtype='<f8').tobytes())
+                cube_file.flush()
+                os.fsync(cube_file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def load(self):
+        """ Maps the cube file if it has been replaced since it was mapped, checking it at most every
+        settings.RATES_CUBE_CHECK_INTERVAL seconds
+
+        :return: the mapped cube, or None if there is no cube file
+        :rtype: MappedCube
+        """
+        path = settings.RATES_CUBE_PATH
+        if not path:
+            self.cube = None
+            return None
+        now = time.monotonic()
+        if self._checked_path == path and now - self._checked_at < settings.RATES_CUBE_CHECK_INTERVAL:
+            return self.cube
+        with self._lock:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self._file_id = self.cube = None
+            else:
+                file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if self._checked_path != path or file_id != self._file_id:
+                    self.cube = self.map(path)
+                    self._file_id = file_id
+            self._checked_path, self._checked_at = path, now
+        return self.cube
+
+    @classmethod
+    def map(cls, path):
+        """ Maps a cube file read only
+
+        :param path: path of the cube file.
+        :type path: str
+        :return: the mapped cube
+        :rtype: MappedCube
+        """
+        with open(path, 'rb') as cube_file:
+            magic = cube_file.read(len(cls.MAGIC))
+            if magic != cls.MAGIC:
+                raise ValueError('%s is not a rate cube' % path)
+            header_size, = struct.unpack('<I', cube_file.read(4))
+            header = json.loads(cube_file.read(header_size))
+        # A previous mapping stays valid while it is used, as replacing the file only unlinks the former one
+        rates = np.memmap(path, dtype='<f8', mode='r', offset=len(cls.MAGIC) + 4 + header_size,
+                          shape=tuple(header['shape']))
+        metrics.increment('rate_cube.loads')
+        return MappedCube(pivot_symbol=header['pivot'], start_date=date.fromisoformat(header['start_date']),
+                          symbols={symbol: index for index, symbol in enumerate(header['symbols'])}, rates=rates)
+
+    def get_rate(self, source_currency, exchanged_currency, valuation_date):
+        """ Gets a rate from the cube, or None if it is not there """
+        cube = self.load()
+        if cube is None:
+            return None
+        rates, symbols = cube.rates, cube.symbols
+        index = (self.get_date(valuation_date) - cube.start_date).days
+        if not 0 <= index < rates.shape[0] or source_currency.symbol not in symbols or \
+                exchanged_currency.symbol not in symbols:
+            metrics.increment('rate_cube.misses')
+            return None
+        rate_value = rates[index, symbols[exchanged_currency.symbol]] / rates[index, symbols[source_currency.symbol]]
+        if not np.isfinite(rate_value):
+            metrics.increment('rate_cube.misses')
+            return None
+        metrics.increment('rate_cube.hits')
+        return round(float(rate_value), 6)
+
+    def get_currency_rates(self, source_currency, dates, currencies):
+        """ Gets from the cube the rates of a source currency into several currencies in several dates, rebasing all
+        of them with a single division
+
+        :param source_currency: currency the rates are from.
+        :type source_currency: Currency
+        :param dates: consecutive dates of the rates.
+        :type dates: list of date
+        :param currencies: currencies the rates are into.
+        :type currencies: list of Currency
+        :return: the rates keyed by date and currency symbol, only for the dates all of them are in the cube
+        :rtype: dict of dicts
+        """
+        cube = self.load()
+        if not dates or cube is None:
+            return {}
+        rates, symbols = cube.rates, cube.symbols
+        if source_currency.symbol not in symbols or any(currency.symbol not in symbols for currency in currencies):
+            metrics.increment('rate_cube.misses')
+            return {}
+        first_index = max((self.get_date(dates[0]) - cube.start_date).days, 0)
+        last_index = min((self.get_date(dates[-1]) - cube.start_date).days, rates.shape[0] - 1)
+        if first_index > last_index:
+            metrics.increment('rate_cube.misses')
+            return {}
+        columns = [symbols[currency.symbol] for currency in currencies]
+        days = rates[first_index:last_index + 1]
+        currency_rates = (days[:, columns] / days[:, [symbols[source_currency.symbol]]]).round(6)
+        complete_days = np.isfinite(currency_rates).all(axis=1)
+        cube_start = cube.start_date.toordinal()
+        currency_symbols = [currency.symbol for currency in currencies]
+        cube_rates = {date.fromordinal(cube_start + first_index + offset): dict(zip(currency_symbols, day_rates))
+                      for offset, day_rates in enumerate(currency_rates.tolist()) if complete_days[offset]}
+        metrics.increment('rate_cube.hits', len(cube_rates))
+        return cube_rates
+
+
+rate_cube = RateCube()
@@ -0,0 +1,55 @@
+import threading
+
+from django.conf import settings
+
+from exchange_rate.models import Currency
+
+
+class CurrencyRegistry(object):
+    """ Process wide registry of the available currencies by symbol.
+    Currencies are loaded from the database on first use and reloaded after being invalidated, which happens every
+    time a Currency is saved or deleted (see exchange_rate.signals).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._currencies = None
+
+    def load(self):
+        with self._lock:
+            self._currencies = {currency.symbol: currency for currency in Currency.objects.all()}
+            return self._currencies
+
+    def invalidate(self):
+        with self._lock:
+            self._currencies = None
+
+    def get_currencies(self):
+        currencies = self._currencies
+        if currencies is None:
+            currencies = self.load()
+        return currencies
+
+    def all(self):
+        return list(self.get_currencies().values())
+
+    def get(self, symbol):
+        """ Gets a currency by its symbol, or None if it is not available """
+        return self.get_currencies().get(symbol)
+
+    def get_currency(self, symbol):
+        """ Gets a currency by its symbol, raising Currency.DoesNotExist if it is not available """
+        currency = self.get(symbol)
+        if currency is None:
+            raise Currency.DoesNotExist('Currency "%s" does not exist.' % symbol)
+        return currency
+
+
+currency_registry = CurrencyRegistry()
+
+
+def get_pivot_currency():
+    """ Gets the currency the rates are stored against in pivot storage mode, or None in full storage mode """
+    if settings.RATES_STORAGE_MODE != 'pivot':
+        return None
+    return currency_registry.get_currency(settings.RATES_PIVOT_CURRENCY)
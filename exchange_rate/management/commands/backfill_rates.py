@@ -0,0 +1,167 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from exchange_rate.adapters import BaseAdapter
+from exchange_rate.breakers import provider_breakers
+from exchange_rate.currencies import currency_registry, get_pivot_currency
+from exchange_rate.models import CurrencyExchangeRate, Provider
+from exchange_rate.providers import adapter_registry
+from exchange_rate.quotas import provider_quotas
+
+
+class Command(BaseCommand):
+    help = 'Fills the gaps of the stored historical rates in a time period, fetching the missing dates from the ' \
+           'providers in parallel and storing them in chunks. Running it again resumes from the dates still missing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start-date', type=date.fromisoformat, required=True,
+                            help='First date to fill as YYYY-MM-DD')
+        parser.add_argument('--end-date', type=date.fromisoformat,
+                            help='Last date to fill as YYYY-MM-DD, yesterday by default as rates of today may change')
+        parser.add_argument('--pivot', default=settings.RATES_PIVOT_CURRENCY,
+                            help='Symbol of the currency whose rates tell whether a date is stored')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of dates requested to the providers at the same time')
+        parser.add_argument('--chunk-days', type=int, default=30,
+                            help='Number of fetched dates stored in each transaction')
+
+    def handle(self, *args, **options):
+        pivot_currency = currency_registry.get(options['pivot'].upper())
+        if pivot_currency is None:
+            raise CommandError('Currency %s does not exist.' % options['pivot'])
+        if options['workers'] < 1 or options['chunk_days'] < 1:
+            raise CommandError('--workers and --chunk-days must be positive.')
+        start_date = options['start_date']
+        end_date = options['end_date'] or date.today() - timedelta(days=1)
+
+        missing_dates = self.get_missing_dates(pivot_currency, start_date, end_date)
+        if not missing_dates:
+            self.stdout.write('No missing dates from %s to %s.' % (start_date, end_date))
+            return
+        self.stdout.write('Fetching %d missing dates from %s to %s.' % (len(missing_dates), start_date, end_date))
+
+        # Providers and their adapters are resolved once, the workers only make the provider requests
+        providers = [(provider, adapter_registry.get_adapter(provider))
+                     for provider in Provider.objects.all().order_by('priority')]
+        started_at = time.monotonic()
+        stored_days = stored_rates = 0
+        failed_dates = []
+        chunk = []
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(self.fetch_date, providers, valuation_date): valuation_date
+                       for valuation_date in missing_dates}
+            for future in as_completed(futures):
+                exchange_values = future.result()
+                if exchange_values is None:
+                    failed_dates.append(futures[future])
+                else:
+                    chunk.append(exchange_values)
+                if len(chunk) >= options['chunk_days']:
+                    stored_rates += self.store_chunk(chunk)
+                    stored_days += len(chunk)
+                    chunk = []
+                    self.write_progress(stored_days, len(missing_dates), stored_rates, started_at)
+        if chunk:
+            stored_rates += self.store_chunk(chunk)
+            stored_days += len(chunk)
+            self.write_progress(stored_days, len(missing_dates), stored_rates, started_at)
+
+        if failed_dates:
+            self.stderr.write('No provider returned the rates of %d dates, from %s to %s. Run the command again to '
+                              'retry them.' % (len(failed_dates), min(failed_dates), max(failed_dates)))
+        self.stdout.write(self.style.SUCCESS('Stored %d dates and %d exchange rates in %.2f s.'
+                                             % (stored_days, stored_rates, time.monotonic() - started_at)))
+
+    def write_progress(self, stored_days, total_days, stored_rates, started_at):
+        elapsed = max(time.monotonic() - started_at, 1e-9)
+        self.stdout.write('Stored %d/%d dates, %d exchange rates (%.1f dates/s, %.0f rates/s).'
+                          % (stored_days, total_days, stored_rates, stored_days / elapsed, stored_rates / elapsed))
+
+    @classmethod
+    def get_missing_dates(cls, pivot_currency, start_date, end_date):
+        """ Gets the dates of a time period without every rate of the pivot currency stored, with a single query
+
+        :param pivot_currency: currency whose rates are checked.
+        :type pivot_currency: Currency
+        :param start_date: first date of the period.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: the missing dates, sorted
+        :rtype: list of date
+        """
+        exchanged_currencies = [currency for currency in currency_registry.all() if currency != pivot_currency]
+        complete_dates = set(
+            CurrencyExchangeRate.objects.filter(source_currency=pivot_currency,
+                                                exchanged_currency__in=exchanged_currencies,
+                                                valuation_date__range=(start_date, end_date))
+            .values('valuation_date').annotate(currencies=Count('exchanged_currency', distinct=True))
+            .filter(currencies=len(exchanged_currencies)).values_list('valuation_date', flat=True))
+        return [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)
+                if start_date + timedelta(days=offset) not in complete_dates]
+
+    @classmethod
+    def fetch_date(cls, providers, valuation_date):
+        """ Requests the rates of a date to the providers in priority order, skipping the ones whose circuit breaker
+        is open or that are over their budget. Runs in a worker thread.
+
+        :param providers: providers and their adapters, in priority order.
+        :type providers: list of (Provider, BaseAdapter)
+        :param valuation_date: date of the rates.
+        :type valuation_date: date
+        :return: the exchange rates of the first provider returning them, or None if none does
+        :rtype: dict
+        """
+        try:
+            for provider, adapter in providers:
+                breaker = provider_breakers.get_breaker(provider)
+                if not breaker.allow_request() or not provider_quotas.acquire(provider):
+                    continue
+                try:
+                    exchange_values = adapter.get_exchange_values(valuation_date)
+                except Exception:
+                    exchange_values = None
+                if exchange_values is None:
+                    breaker.record_failure()
+                    continue
+                breaker.record_success()
+                return exchange_values
+            return None
+        finally:
+            # Adapters may query the database from the worker thread
+            connection.close()
+
+    @classmethod
+    def store_chunk(cls, chunk):
+        """ Stores the rates of several dates in a single transaction, skipping the ones already stored, or only the
+        pivot currency ones in pivot storage mode
+
+        :param chunk: exchange rates of each date, as returned by the adapters.
+        :type chunk: list of dict
+        :return: number of exchange rates inserted, leaving out the ones already stored
+        :rtype: int
+        """
+        pivot_currency = get_pivot_currency()
+        currency_exchange_rates = []
+        for exchange_values in chunk:
+            symbols, exchange_matrix = BaseAdapter.get_exchange_matrix(exchange_values)
+            rates = BaseAdapter.parse_exchange_matrix(symbols, exchange_matrix, exchange_values['date'])
+            if pivot_currency is not None:
+                rates = [rate for rate in rates if rate.source_currency_id == pivot_currency.id]
+            currency_exchange_rates.extend(rates)
+        # The inserts skipped for conflicts are not reported, so the rates of the chunk dates are counted around them
+        chunk_rates = CurrencyExchangeRate.objects.filter(
+            valuation_date__in={rate.valuation_date for rate in currency_exchange_rates})
+        if pivot_currency is not None:
+            chunk_rates = chunk_rates.filter(source_currency=pivot_currency)
+        with transaction.atomic():
+            stored_rates = chunk_rates.count()
+            CurrencyExchangeRate.objects.bulk_create(currency_exchange_rates, batch_size=1000, ignore_conflicts=True)
+            return chunk_rates.count() - stored_rates
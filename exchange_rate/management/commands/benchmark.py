@@ -0,0 +1,229 @@
+import json
+import math
+import statistics
+import time
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from exchange_rate.breakers import provider_breakers
+from exchange_rate.cache import rate_cache
+from exchange_rate.currencies import currency_registry
+from exchange_rate.management.commands.backfill_rates import Command as BackfillCommand
+from exchange_rate.models import Currency, CurrencyExchangeRate, Provider
+from exchange_rate.providers import adapter_registry
+from exchange_rate.returns import return_index
+from exchange_rate.utils import get_exchange_rates_data_providers
+from exchange_rate.views import DASHBOARD_END_DATE, DASHBOARD_START_DATE
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the API endpoints, the dashboard and the ingestion of rates on a seeded synthetic dataset in ' \
+           'a new test database, with the providers faked by the seeded Mock provider. Reports latency, throughput ' \
+           'and queries as JSON, and fails if a query budget is exceeded'
+
+    # Maximum queries of a request with empty caches (cold) and once its rates are cached (warm). Every ingested date
+    # is cold, and its budget also allows one query per insert batch the database backend needs
+    QUERY_BUDGETS = {
+        'currency_rates': {'cold': 2, 'warm': 2},
+        'currency_rates_columnar': {'cold': 2, 'warm': 2},
+        'exchanged_currency_amount': {'cold': 2, 'warm': 1},
+        'twr': {'cold': 2, 'warm': 1},
+        'dashboard': {'cold': 1, 'warm': 1},
+        'ingestion': {'cold': 3},
+    }
+    SYMBOL_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--currencies', type=int, default=20, help='Number of currencies of the dataset')
+        parser.add_argument('--days', type=int, default=90,
+                            help='Number of days of the dataset up to yesterday, the dashboard period is also seeded')
+        parser.add_argument('--seed', type=int, default=7, help='Seed of the random rates')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of requests of each scenario')
+        parser.add_argument('--ingest-days', type=int, default=10, help='Number of days ingested from the provider')
+        parser.add_argument('--output', help='Path of the JSON report, written to stdout by default')
+
+    def handle(self, *args, **options):
+        if options['currencies'] < 2 or options['days'] < 1 or options['repeat'] < 2 or options['ingest_days'] < 1:
+            raise CommandError('--currencies and --repeat must be at least 2, --days and --ingest-days positive.')
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = self.run_benchmarks(options['currencies'], options['days'], options['seed'], options['repeat'],
+                                         options['ingest_days'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            currency_registry.invalidate()
+            adapter_registry.invalidate()
+
+        report_json = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report_json + '\n')
+            self.stdout.write('Report written to %s.' % options['output'])
+        else:
+            self.stdout.write(report_json)
+        exceeded = self.get_exceeded_budgets(report)
+        if exceeded:
+            raise CommandError('Query budgets exceeded: %s' % ', '.join(exceeded))
+        self.stdout.write(self.style.SUCCESS('Query budgets met.'))
+
+    def run_benchmarks(self, currencies, days, seed, repeat, ingest_days):
+        """ Seeds the dataset and runs every scenario in the current database, which is modified
+
+        :return: the report, with the dataset and the results of each scenario
+        :rtype: dict
+        """
+        with override_settings(RANDOM_EXCHANGE_SEED=seed, RATES_REQUEST_PROVIDERS=True, RATES_WRITE_BEHIND=False,
+                               RATES_CUBE_PATH=None):
+            # Only the seeded Mock provider is requested, so no request leaves the process
+            Provider.objects.exclude(adapter='exchange_rate.adapters.MockAdapter').delete()
+            Provider.objects.update(priority=1, rate_limit=None, monthly_quota=None)
+            adapter_registry.invalidate()
+            provider_breakers.reset()
+
+            end_date = date.today() - timedelta(days=1)
+            start_date = end_date - timedelta(days=days - 1)
+            dataset = self.seed_dataset(currencies, seed, [(start_date, end_date),
+                                                           (DASHBOARD_START_DATE, DASHBOARD_END_DATE)])
+            client = Client()
+            rates_url = '/api/currency_rates?source_currency=EUR&date_from=%s&date_to=%s' % (start_date, end_date)
+            scenarios = {
+                'currency_rates': lambda: client.get(rates_url),
+                'currency_rates_columnar': lambda: client.get(rates_url + '&format=columnar'),
+                'exchanged_currency_amount': lambda: client.get('/api/exchanged_currency_amount', {
+                    'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 100}),
+                'twr': lambda: client.get('/api/twr', {
+                    'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 100, 'date_from': start_date,
+                    'date_to': end_date}),
+                'dashboard': lambda: client.get('/dashboard/eur/'),
+            }
+            results = {name: self.run_scenario(request, repeat) for name, request in scenarios.items()}
+            results['ingestion'] = self.run_ingestion(start_date - timedelta(days=ingest_days), ingest_days)
+        return {'dataset': dataset, 'results': results}
+
+    @classmethod
+    def get_symbol(cls, index):
+        high, low = divmod(index, len(cls.SYMBOL_DIGITS))
+        return 'X' + cls.SYMBOL_DIGITS[high] + cls.SYMBOL_DIGITS[low]
+
+    def seed_dataset(self, currencies, seed, periods):
+        """ Creates synthetic currencies up to the number of currencies, and stores the rates of every currency in the
+        periods generated by the seeded Mock provider, as the providers would
+
+        :return: the dataset description
+        :rtype: dict
+        """
+        existing = Currency.objects.count()
+        if currencies - existing > len(self.SYMBOL_DIGITS) ** 2:
+            raise CommandError('At most %d currencies can be seeded.' % (existing + len(self.SYMBOL_DIGITS) ** 2))
+        Currency.objects.bulk_create([Currency(code=self.get_symbol(index), name=self.get_symbol(index),
+                                               symbol=self.get_symbol(index))
+                                      for index in range(currencies - existing)])
+        currency_registry.load()
+        pivot_currency = currency_registry.get_currency(settings.RATES_PIVOT_CURRENCY)
+        dataset_currencies = [pivot_currency, *(currency for currency in currency_registry.all()
+                                                if currency != pivot_currency)]
+        symbols = [currency.symbol for currency in dataset_currencies]
+
+        started_at = time.monotonic()
+        mock_adapter = adapter_registry.get_adapter(Provider.objects.get(adapter='exchange_rate.adapters.MockAdapter'))
+        days = 0
+        for start_date, end_date in periods:
+            # The rates of the whole period are generated at once, and stored in chunks of 30 days
+            dates, rates = mock_adapter.get_currency_rates(pivot_currency, dataset_currencies, start_date, end_date)
+            exchange_values = [{'date': valuation_date.isoformat(), 'base': pivot_currency.symbol,
+                                'rates': dict(zip(symbols, day_rates))}
+                               for valuation_date, day_rates in zip(dates, rates.tolist())]
+            for chunk_start in range(0, len(exchange_values), 30):
+                BackfillCommand.store_chunk(exchange_values[chunk_start:chunk_start + 30])
+            days += len(dates)
+        return {'currencies': len(symbols), 'days': days, 'rates': CurrencyExchangeRate.objects.count(),
+                'storage_mode': settings.RATES_STORAGE_MODE, 'seed': seed,
+                'seconds': round(time.monotonic() - started_at, 3)}
+
+    @classmethod
+    def clear_caches(cls):
+        rate_cache.clear()
+        return_index.clear()
+
+    @classmethod
+    def get_timings(cls, latencies):
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        return {'p50_ms': round(statistics.median(latencies_ms), 3),
+                'p95_ms': round(latencies_ms[min(math.ceil(0.95 * len(latencies_ms)) - 1, len(latencies_ms) - 1)], 3),
+                'max_ms': round(latencies_ms[-1], 3),
+                'throughput_per_s': round(len(latencies) / max(sum(latencies), 1e-9), 1)}
+
+    def run_scenario(self, request, repeat):
+        """ Makes a request with empty caches, and then repeat - 1 more
+
+        :param request: makes the request, returning the response.
+        :type request: callable
+        :param repeat: number of requests.
+        :type repeat: int
+        :return: the cold request latency and queries, and the latency percentiles, throughput and maximum queries of
+            the warm ones
+        :rtype: dict
+        """
+        self.clear_caches()
+        latencies, queries, statuses = [], [], set()
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as captured:
+                started_at = time.perf_counter()
+                response = request()
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                latencies.append(time.perf_counter() - started_at)
+            queries.append(len(captured))
+            statuses.add(response.status_code)
+        return {'cold_ms': round(latencies[0] * 1000, 3), 'cold_queries': queries[0],
+                'warm_queries': max(queries[1:]), **self.get_timings(latencies[1:]),
+                'status_codes': sorted(statuses)}
+
+    def run_ingestion(self, start_date, days):
+        """ Requests the rates of dates not stored to the providers, which store them, as the ingestion does
+
+        :return: the latency percentiles, throughput and maximum queries per date, and the query budget per date
+        :rtype: dict
+        """
+        self.clear_caches()
+        pivot_currency = currency_registry.get_currency(settings.RATES_PIVOT_CURRENCY)
+        exchanged_currencies = [currency for currency in currency_registry.all() if currency != pivot_currency]
+        rows_before = CurrencyExchangeRate.objects.count()
+        latencies, queries = [], []
+        for offset in range(days):
+            with CaptureQueriesContext(connection) as captured:
+                started_at = time.perf_counter()
+                get_exchange_rates_data_providers(pivot_currency, exchanged_currencies,
+                                                  start_date + timedelta(days=offset), on_request=False)
+                latencies.append(time.perf_counter() - started_at)
+            queries.append(len(captured))
+        rows_per_date = (CurrencyExchangeRate.objects.count() - rows_before) // days
+        fields = [field for field in CurrencyExchangeRate._meta.concrete_fields if not field.primary_key]
+        batch_size = max(connection.ops.bulk_batch_size(fields, [None] * rows_per_date), 1)
+        return {'cold_queries': max(queries), 'rates_per_date': rows_per_date,
+                'insert_batches': math.ceil(rows_per_date / batch_size), **self.get_timings(latencies)}
+
+    @classmethod
+    def get_exceeded_budgets(cls, report):
+        """ Gets the scenarios whose queries exceed their budget, or that did not succeed """
+        exceeded = []
+        for name, result in report['results'].items():
+            budget = cls.QUERY_BUDGETS[name]
+            extra_queries = result.get('insert_batches', 0)
+            for phase in budget:
+                if result['%s_queries' % phase] > budget[phase] + extra_queries:
+                    exceeded.append('%s %s (%d > %d)' % (name, phase, result['%s_queries' % phase],
+                                                         budget[phase] + extra_queries))
+            if any(status_code != 200 for status_code in result.get('status_codes', [])):
+                exceeded.append('%s returned %s' % (name, result['status_codes']))
+        return exceeded
@@ -0,0 +1,62 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from exchange_rate.adapters import BaseAdapter
+from exchange_rate.models import Currency, CurrencyExchangeRate
+
+
+def legacy_convert_exchange_base(exchange_values):
+    """ Former BaseAdapter.convert_exchange_base, rebasing with nested dict comprehensions """
+    bases = exchange_values['rates'].keys()
+    rates = exchange_values['rates']
+    return [{'base': base, 'date': exchange_values['date'],
+             'rates': {rate: rates[rate] / rates[base] for rate in rates}} for base in bases]
+
+
+def legacy_parse_exchange_rates(exchange_rates, currencies):
+    """ Former BaseAdapter.parse_exchange_rates, parsing the date of every rate, with in-memory currency lookups """
+    currency_exchange_rates = []
+    for exchange in exchange_rates:
+        source_currency_symbol = exchange['base']
+        source_currency = currencies[source_currency_symbol]
+        for exchanged_currency_symbol in exchange['rates']:
+            if source_currency_symbol != exchanged_currency_symbol:
+                exchanged_currency = currencies[exchanged_currency_symbol]
+                cur_exchange_rate = CurrencyExchangeRate(source_currency=source_currency,
+                                                         exchanged_currency=exchanged_currency,
+                                                         valuation_date=BaseAdapter.parse_date(exchange['date']),
+                                                         rate_value=exchange['rates'][exchanged_currency_symbol])
+                currency_exchange_rates.append(cur_exchange_rate)
+    return currency_exchange_rates
+
+
+class Command(BaseCommand):
+    help = 'Compares the time spent rebasing and parsing a day of rates by the former and the vectorized adapter code'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--currencies', type=int, default=170, help='Number of currencies of the day')
+        parser.add_argument('--repeat', type=int, default=10, help='Number of times each implementation runs')
+
+    def handle(self, *args, **options):
+        symbols = ['C%03d' % index for index in range(options['currencies'])]
+        currencies = {symbol: Currency(id=index + 1, code=symbol, name=symbol, symbol=symbol)
+                      for index, symbol in enumerate(symbols)}
+        exchange_values = {'date': '2021-01-04', 'base': symbols[0],
+                           'rates': {symbol: random.uniform(0.1, 100) for symbol in symbols}}
+
+        def legacy():
+            return legacy_parse_exchange_rates(legacy_convert_exchange_base(exchange_values), currencies)
+
+        def vectorized():
+            day_symbols, exchange_matrix = BaseAdapter.get_exchange_matrix(exchange_values)
+            return BaseAdapter.parse_exchange_matrix(day_symbols, exchange_matrix, exchange_values['date'],
+                                                     [currencies[symbol] for symbol in day_symbols])
+
+        legacy_time = min(timeit.repeat(legacy, number=1, repeat=options['repeat']))
+        vectorized_time = min(timeit.repeat(vectorized, number=1, repeat=options['repeat']))
+        self.stdout.write('Rates per day: %d' % len(vectorized()))
+        self.stdout.write('Former: %.2f ms' % (legacy_time * 1000))
+        self.stdout.write('Vectorized: %.2f ms' % (vectorized_time * 1000))
+        self.stdout.write(self.style.SUCCESS('Speedup: %.1fx' % (legacy_time / vectorized_time)))
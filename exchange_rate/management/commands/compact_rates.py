@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max, Min
+
+from exchange_rate.currencies import currency_registry
+from exchange_rate.models import CurrencyExchangeRate
+
+
+class Command(BaseCommand):
+    help = 'Compacts the stored exchange rates for the pivot storage mode, keeping only the rates from the pivot ' \
+           'currency, from which the rest are derived'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pivot', default=settings.RATES_PIVOT_CURRENCY,
+                            help='Symbol of the currency the rates are kept against')
+        parser.add_argument('--chunk-days', type=int, default=30,
+                            help='Number of valuation dates compacted in each transaction')
+
+    def handle(self, *args, **options):
+        pivot_currency = currency_registry.get(options['pivot'].upper())
+        if pivot_currency is None:
+            raise CommandError('Currency %s does not exist.' % options['pivot'])
+        if settings.RATES_STORAGE_MODE != 'pivot':
+            self.stdout.write(self.style.WARNING('RATES_STORAGE_MODE is not pivot, rates will keep being stored for '
+                                                 'every pair of currencies.'))
+
+        chunk_days = timedelta(days=options['chunk_days'])
+        dates = CurrencyExchangeRate.objects.aggregate(start_date=Min('valuation_date'), end_date=Max('valuation_date'))
+        if dates['start_date'] is None:
+            self.stdout.write('No exchange rates stored.')
+            return
+
+        total_created = total_deleted = 0
+        chunk_start = dates['start_date']
+        while chunk_start <= dates['end_date']:
+            chunk_end = chunk_start + chunk_days - timedelta(days=1)
+            created, deleted = self.compact_rates(pivot_currency, chunk_start, chunk_end)
+            total_created += created
+            total_deleted += deleted
+            chunk_start = chunk_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS('Created %d pivot exchange rates and deleted %d derivable ones.'
+                                             % (total_created, total_deleted)))
+
+    @classmethod
+    def compact_rates(cls, pivot_currency, start_date, end_date):
+        """ Compacts the exchange rates of a time period, in a single transaction.
+        Pivot rates missing for a date are created first as the inverse of the rates into the pivot currency, so no
+        rate that can be derived now is lost.
+
+        :param pivot_currency: currency whose rates are kept.
+        :type pivot_currency: Currency
+        :param start_date: first date of the period.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: number of created and deleted rates
+        :rtype: tuple of int
+        """
+        rates = CurrencyExchangeRate.objects.filter(valuation_date__range=(start_date, end_date))
+        inverse_rates = rates.filter(exchanged_currency=pivot_currency, rate_value__gt=0) \
+            .values_list('source_currency_id', 'valuation_date', 'rate_value')
+        with transaction.atomic():
+            pivot_rates = [CurrencyExchangeRate(None, pivot_currency.id, source_currency_id, valuation_date,
+                                                round(1 / float(rate_value), 6))
+                           for source_currency_id, valuation_date, rate_value in inverse_rates]
+            stored_count = rates.filter(source_currency=pivot_currency).count()
+            CurrencyExchangeRate.objects.bulk_create(pivot_rates, ignore_conflicts=True)
+            created = rates.filter(source_currency=pivot_currency).count() - stored_count
+            deleted, _ = rates.exclude(source_currency=pivot_currency).delete()
+        return created, deleted
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+
+from exchange_rate.models import CurrencyExchangeRate
+
+
+class Command(BaseCommand):
+    help = 'Deletes duplicated exchange rates, keeping the first stored one for each (source, exchanged, date)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-days', type=int, default=30,
+                            help='Number of valuation dates deduplicated in each transaction')
+
+    def handle(self, *args, **options):
+        chunk_days = timedelta(days=options['chunk_days'])
+        dates = CurrencyExchangeRate.objects.aggregate(start_date=Min('valuation_date'), end_date=Max('valuation_date'))
+        if dates['start_date'] is None:
+            self.stdout.write('No exchange rates stored.')
+            return
+
+        total_deleted = 0
+        chunk_start = dates['start_date']
+        while chunk_start <= dates['end_date']:
+            chunk_end = chunk_start + chunk_days - timedelta(days=1)
+            total_deleted += self.delete_duplicated_rates(chunk_start, chunk_end)
+            chunk_start = chunk_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS('Deleted %d duplicated exchange rates.' % total_deleted))
+
+    @classmethod
+    def delete_duplicated_rates(cls, start_date, end_date):
+        """ Deletes the duplicated exchange rates of a time period, in a single transaction
+
+        :param start_date: first date of the period.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: number of deleted rates
+        :rtype: int
+        """
+        rates = CurrencyExchangeRate.objects.filter(valuation_date__range=(start_date, end_date))
+        kept_rates = rates.values('source_currency', 'exchanged_currency', 'valuation_date') \
+            .annotate(kept_id=Min('id')).values('kept_id')
+        with transaction.atomic():
+            deleted, _ = rates.exclude(id__in=kept_rates).delete()
+        return deleted
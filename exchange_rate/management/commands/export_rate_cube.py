@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from exchange_rate.cube import RateCube
+from exchange_rate.currencies import currency_registry
+from exchange_rate.models import CurrencyExchangeRate
+
+
+class Command(BaseCommand):
+    help = 'Exports the stored historical rates of the pivot currency to the rate cube file shared by every process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.RATES_CUBE_PATH,
+                            help='Path of the cube file, settings.RATES_CUBE_PATH by default')
+        parser.add_argument('--pivot', default=settings.RATES_PIVOT_CURRENCY,
+                            help='Symbol of the currency the rates are exported against')
+        parser.add_argument('--start-date', type=date.fromisoformat,
+                            help='First exported date as YYYY-MM-DD, the first stored one by default')
+        parser.add_argument('--end-date', type=date.fromisoformat,
+                            help='Last exported date as YYYY-MM-DD, yesterday by default as rates of today may change')
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            raise CommandError('Set RATES_CUBE_PATH or pass --path.')
+        pivot_currency = currency_registry.get(options['pivot'].upper())
+        if pivot_currency is None:
+            raise CommandError('Currency %s does not exist.' % options['pivot'])
+
+        pivot_rates = CurrencyExchangeRate.objects.filter(source_currency=pivot_currency)
+        dates = pivot_rates.aggregate(start_date=Min('valuation_date'), end_date=Max('valuation_date'))
+        start_date = options['start_date'] or dates['start_date']
+        end_date = options['end_date'] or date.today() - timedelta(days=1)
+        if start_date is None or start_date > end_date:
+            self.stdout.write('No exchange rates to export.')
+            return
+
+        started_at = time.monotonic()
+        currencies = currency_registry.all()
+        rates = self.get_rates_matrix(pivot_currency, currencies, start_date, end_date)
+        RateCube.write(options['path'], pivot_currency.symbol, start_date,
+                       [currency.symbol for currency in currencies], rates)
+        self.stdout.write(self.style.SUCCESS(
+            'Exported %d days x %d currencies from %s to %s in %.2f s.'
+            % (rates.shape[0], rates.shape[1], start_date, end_date, time.monotonic() - started_at)))
+
+    @classmethod
+    def get_rates_matrix(cls, pivot_currency, currencies, start_date, end_date):
+        """ Loads the rates of the pivot currency in a time period with a single query
+
+        :param pivot_currency: currency the rates are from.
+        :type pivot_currency: Currency
+        :param currencies: currencies of the matrix columns.
+        :type currencies: list of Currency
+        :param start_date: first date of the period.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: the dates x currencies matrix of rates, NaN where they are not stored
+        :rtype: numpy.ndarray
+        """
+        columns = {currency.id: index for index, currency in enumerate(currencies)}
+        rates = np.full(((end_date - start_date).days + 1, len(currencies)), np.nan)
+        rates[:, columns[pivot_currency.id]] = 1.
+        stored_rates = CurrencyExchangeRate.objects.filter(source_currency=pivot_currency,
+                                                           valuation_date__range=(start_date, end_date)) \
+            .values_list('valuation_date', 'exchanged_currency_id', 'rate_value')
+        start_ordinal = start_date.toordinal()
+        for valuation_date, exchanged_currency_id, rate_value in stored_rates.iterator():
+            if exchanged_currency_id in columns:
+                rates[valuation_date.toordinal() - start_ordinal, columns[exchanged_currency_id]] = rate_value
+        return rates
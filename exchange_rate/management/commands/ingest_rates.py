@@ -0,0 +1,98 @@
+import time
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from exchange_rate.currencies import currency_registry
+from exchange_rate.metrics import metrics
+from exchange_rate.models import IngestionState
+from exchange_rate.utils import get_exchange_rates_data_providers, get_stored_exchange_rates
+
+
+class Command(BaseCommand):
+    help = 'Ingests the end of day rates of the pivot currency from the providers in the background, so requests ' \
+           'read them from the database instead of waiting for the providers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Ingest the pending dates once and exit, instead of running as a daemon')
+        parser.add_argument('--pivot', default=settings.RATES_PIVOT_CURRENCY,
+                            help='Symbol of the currency the rates are ingested against')
+        parser.add_argument('--start-date', type=date.fromisoformat,
+                            help='First ingested date as YYYY-MM-DD, the day after the last ingested one by default')
+
+    def handle(self, *args, **options):
+        pivot_currency = currency_registry.get(options['pivot'].upper())
+        if pivot_currency is None:
+            raise CommandError('Currency %s does not exist.' % options['pivot'])
+        state, _ = IngestionState.objects.get_or_create(name=pivot_currency.symbol)
+
+        start_date = options['start_date']
+        while True:
+            delay = self.ingest_pending_dates(state, pivot_currency, start_date)
+            start_date = None
+            if options['once']:
+                break
+            time.sleep(delay)
+
+    def ingest_pending_dates(self, state, pivot_currency, start_date=None):
+        """ Ingests the dates from start_date, or the day after the last one ingested, to yesterday, stopping at the
+        first one that fails. Rates of today are not ingested, as they may change until the day ends.
+
+        :param state: ingestion state of the pivot currency, updated after each date.
+        :type state: IngestionState
+        :param pivot_currency: currency the rates are from.
+        :type pivot_currency: Currency
+        :param start_date: first date to ingest.
+        :type start_date: date
+        :return: seconds to wait before the next run
+        :rtype: int
+        """
+        end_date = date.today() - timedelta(days=1)
+        if start_date is None:
+            start_date = state.last_success_date + timedelta(days=1) if state.last_success_date else \
+                end_date - timedelta(days=settings.RATES_INGEST_INITIAL_DAYS - 1)
+        exchanged_currencies = [currency for currency in currency_registry.all() if currency != pivot_currency]
+
+        valuation_date = start_date
+        while valuation_date <= end_date:
+            error = self.ingest_date(pivot_currency, exchanged_currencies, valuation_date)
+            if error:
+                state.failures += 1
+                state.last_error = '%s: %s' % (valuation_date, error)
+                state.save()
+                metrics.increment('ingestion.failures')
+                delay = min(settings.RATES_INGEST_RETRY_DELAY * 2 ** (state.failures - 1),
+                            settings.RATES_INGEST_RETRY_MAX_DELAY)
+                self.stderr.write('Failed to ingest %s, retrying in %d s: %s' % (valuation_date, delay, error))
+                return delay
+            if state.last_success_date is None or valuation_date > state.last_success_date:
+                state.last_success_date = valuation_date
+            state.last_success_at = timezone.now()
+            state.failures = 0
+            state.last_error = ''
+            state.save()
+            metrics.increment('ingestion.dates')
+            self.stdout.write(self.style.SUCCESS('Ingested %s.' % valuation_date))
+            valuation_date += timedelta(days=1)
+        return settings.RATES_INGEST_INTERVAL
+
+    @classmethod
+    def ingest_date(cls, pivot_currency, exchanged_currencies, valuation_date):
+        """ Requests the rates of a date to the providers, which store them, and checks all of them were stored
+
+        :return: the error, or None if every rate was stored
+        :rtype: str
+        """
+        try:
+            get_exchange_rates_data_providers(pivot_currency, exchanged_currencies, valuation_date, on_request=False)
+        except Exception as e:
+            return repr(e)
+        stored_rates = get_stored_exchange_rates(pivot_currency, exchanged_currencies, valuation_date)
+        missing_symbols = [currency.symbol for currency in exchanged_currencies if currency.symbol not in stored_rates]
+        if missing_symbols:
+            return 'No provider returned the rates into %s' % ', '.join(missing_symbols)
+        return None
@@ -0,0 +1,29 @@
+import threading
+
+from collections import defaultdict
+
+
+class Metrics(object):
+    """ Process wide counters, exposed by the api metrics endpoint """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name):
+        return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Metrics()
@@ -2,15 +2,15 @@
 from django.conf import settings
 from django.db import migrations
 
-from exchange_rate.models import Currency, Provider
-
 
 def load_currencies(apps, schema_editor):
+    Currency = apps.get_model('exchange_rate', 'Currency')
     for currency in settings.CURRENCIES:
         Currency.objects.create(**currency)
 
 
 def load_providers(apps, schema_editor):
+    Provider = apps.get_model('exchange_rate', 'Provider')
     Provider.objects.create(**{'name': 'Fixer', 'priority': 1, 'adapter': 'exchange_rate.adapters.FixerAdapter'})
     Provider.objects.create(**{'name': 'Mock', 'priority': 2, 'adapter': 'exchange_rate.adapters.MockAdapter'})
 
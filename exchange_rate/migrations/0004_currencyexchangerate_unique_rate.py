@@ -0,0 +1,52 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:02
+
+from datetime import timedelta
+
+from django.db import migrations, models, transaction
+from django.db.models import Max, Min
+
+
+def delete_duplicated_rates(apps, schema_editor):
+    # Deleted in chunks of 30 valuation dates, each one in its own transaction, as the dedupe_rates command does
+    CurrencyExchangeRate = apps.get_model('exchange_rate', 'CurrencyExchangeRate')
+    dates = CurrencyExchangeRate.objects.aggregate(start_date=Min('valuation_date'), end_date=Max('valuation_date'))
+    chunk_start = dates['start_date']
+    while chunk_start is not None and chunk_start <= dates['end_date']:
+        chunk_end = chunk_start + timedelta(days=29)
+        rates = CurrencyExchangeRate.objects.filter(valuation_date__range=(chunk_start, chunk_end))
+        kept_rates = rates.values('source_currency', 'exchanged_currency', 'valuation_date') \
+            .annotate(kept_id=Min('id')).values('kept_id')
+        with transaction.atomic():
+            rates.exclude(id__in=kept_rates).delete()
+        chunk_start = chunk_end + timedelta(days=1)
+
+
+class Migration(migrations.Migration):
+    # The duplicated rates are deleted in several transactions instead of a single one over the whole table
+    atomic = False
+
+    dependencies = [
+        ('exchange_rate', '0003_alter_provider_adapter'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicated_rates, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='currencyexchangerate',
+            name='rate_value',
+            field=models.DecimalField(decimal_places=6, max_digits=18),
+        ),
+        migrations.AlterField(
+            model_name='provider',
+            name='adapter',
+            field=models.CharField(choices=[('exchange_rate.adapters.FixerAdapter', 'Fixer'), ('exchange_rate.adapters.MockAdapter', 'Mock')], max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='currencyexchangerate',
+            index=models.Index(fields=['source_currency', 'valuation_date', 'exchanged_currency', 'rate_value'], name='currency_exchange_rate_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='currencyexchangerate',
+            constraint=models.UniqueConstraint(fields=('source_currency', 'exchanged_currency', 'valuation_date'), name='unique_currency_exchange_rate'),
+        ),
+    ]
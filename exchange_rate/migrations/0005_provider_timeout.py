@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange_rate', '0004_currencyexchangerate_unique_rate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provider',
+            name='timeout',
+            field=models.FloatField(default=10, help_text='Seconds to wait for the provider on async requests'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange_rate', '0005_provider_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provider',
+            name='failure_threshold',
+            field=models.PositiveIntegerField(default=5, help_text='Consecutive failures that open its breaker'),
+        ),
+        migrations.AddField(
+            model_name='provider',
+            name='hedge_delay',
+            field=models.FloatField(blank=True, help_text='Seconds to wait for the provider on async requests before requesting the next one too, empty to wait for it until its timeout', null=True),
+        ),
+        migrations.AddField(
+            model_name='provider',
+            name='reset_timeout',
+            field=models.FloatField(default=30, help_text='Seconds its breaker stays open before probing again'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange_rate', '0006_provider_breaker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_success_date', models.DateField(blank=True, help_text='Last valuation date fully ingested', null=True)),
+                ('last_success_at', models.DateTimeField(blank=True, null=True)),
+                ('failures', models.PositiveIntegerField(default=0, help_text='Consecutive failed attempts')),
+                ('last_error', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange_rate', '0007_ingestion_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provider',
+            name='monthly_quota',
+            field=models.PositiveIntegerField(blank=True, help_text='Requests allowed per calendar month, empty for no quota. Requests over it go to the next provider', null=True),
+        ),
+        migrations.AddField(
+            model_name='provider',
+            name='rate_burst',
+            field=models.PositiveIntegerField(default=1, help_text='Requests allowed at once within the rate limit'),
+        ),
+        migrations.AddField(
+            model_name='provider',
+            name='rate_limit',
+            field=models.FloatField(blank=True, help_text='Requests per second allowed on average, empty for no limit', null=True),
+        ),
+    ]
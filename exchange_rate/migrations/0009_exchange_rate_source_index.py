@@ -0,0 +1,19 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange_rate', '0008_provider_quota'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='currencyexchangerate',
+            name='source_currency',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='exchanges', to='exchange_rate.currency'),
+        ),
+    ]
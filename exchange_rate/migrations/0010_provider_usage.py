@@ -0,0 +1,34 @@
+# Generated by Django 3.2.3 on 2026-10-18 08:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange_rate', '0009_exchange_rate_source_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProviderRateLimit',
+            fields=[
+                ('provider', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rate_limit_state', serialize=False, to='exchange_rate.provider')),
+                ('tat', models.FloatField(help_text='Theoretical arrival time of the next request, as a Unix timestamp')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProviderUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(help_text='Calendar month, as YYYY-MM', max_length=7)),
+                ('requests', models.PositiveIntegerField(default=0, help_text='Requests taken from the monthly quota')),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usages', to='exchange_rate.provider')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='providerusage',
+            constraint=models.UniqueConstraint(fields=('provider', 'month'), name='unique_provider_usage'),
+        ),
+    ]
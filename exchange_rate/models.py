@@ -15,6 +15,18 @@ class Provider(models.Model):
     name = models.CharField(max_length=50)
     priority = models.IntegerField()
     adapter = models.CharField(max_length=50, choices=settings.PROVIDER_ADAPTERS)
+    timeout = models.FloatField(default=10, help_text='Seconds to wait for the provider on async requests')
+    hedge_delay = models.FloatField(null=True, blank=True,
+                                    help_text='Seconds to wait for the provider on async requests before requesting '
+                                              'the next one too, empty to wait for it until its timeout')
+    failure_threshold = models.PositiveIntegerField(default=5, help_text='Consecutive failures that open its breaker')
+    reset_timeout = models.FloatField(default=30, help_text='Seconds its breaker stays open before probing again')
+    rate_limit = models.FloatField(null=True, blank=True,
+                                   help_text='Requests per second allowed on average, empty for no limit')
+    rate_burst = models.PositiveIntegerField(default=1, help_text='Requests allowed at once within the rate limit')
+    monthly_quota = models.PositiveIntegerField(null=True, blank=True,
+                                                help_text='Requests allowed per calendar month, empty for no quota. '
+                                                          'Requests over it go to the next provider')
 
     def get_adapter(self):
         # grab the classname off of the backend string
@@ -40,11 +52,58 @@ class Currency(models.Model):
 
 
 class CurrencyExchangeRate(models.Model):
-    source_currency = models.ForeignKey(Currency, related_name='exchanges', on_delete=models.CASCADE)
+    # Source lookups use the composite indexes, which start with it
+    source_currency = models.ForeignKey(Currency, related_name='exchanges', on_delete=models.CASCADE, db_index=False)
     exchanged_currency = models.ForeignKey(Currency, on_delete=models.CASCADE)
     valuation_date = models.DateField(db_index=True)
-    rate_value = models.DecimalField(db_index=True, decimal_places=6, max_digits=18)
+    rate_value = models.DecimalField(decimal_places=6, max_digits=18)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source_currency', 'exchanged_currency', 'valuation_date'],
+                                    name='unique_currency_exchange_rate'),
+        ]
+        indexes = [
+            # Covers both single rate and date range lookups without reading the table
+            models.Index(fields=['source_currency', 'valuation_date', 'exchanged_currency', 'rate_value'],
+                         name='currency_exchange_rate_idx'),
+        ]
 
     def __str__(self):
         return self.source_currency.symbol + '->' + self.exchanged_currency.symbol + ': ' + str(self.rate_value) + \
                ' (' + self.valuation_date.strftime('%Y-%m-%d') + ')'
+
+
+class IngestionState(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    last_success_date = models.DateField(null=True, blank=True, help_text='Last valuation date fully ingested')
+    last_success_at = models.DateTimeField(null=True, blank=True)
+    failures = models.PositiveIntegerField(default=0, help_text='Consecutive failed attempts')
+    last_error = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ProviderUsage(models.Model):
+    provider = models.ForeignKey(Provider, related_name='usages', on_delete=models.CASCADE)
+    month = models.CharField(max_length=7, help_text='Calendar month, as YYYY-MM')
+    requests = models.PositiveIntegerField(default=0, help_text='Requests taken from the monthly quota')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'month'], name='unique_provider_usage'),
+        ]
+
+    def __str__(self):
+        return '%s (%s)' % (self.provider, self.month)
+
+
+class ProviderRateLimit(models.Model):
+    provider = models.OneToOneField(Provider, primary_key=True, related_name='rate_limit_state',
+                                    on_delete=models.CASCADE)
+    tat = models.FloatField(help_text='Theoretical arrival time of the next request, as a Unix timestamp')
+
+    def __str__(self):
+        return str(self.provider)
@@ -0,0 +1,31 @@
+import threading
+
+
+class AdapterRegistry(object):
+    """ Process wide registry of adapter instances by provider.
+    The adapter class of each provider is resolved once and its instance is reused by every request, so adapters have
+    to be thread safe. The registry is invalidated every time a Provider is saved or deleted (see
+    exchange_rate.signals).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._adapters = {}
+
+    def get_adapter(self, provider):
+        """ Gets the adapter instance of a provider, creating it on first use """
+        adapter_path, adapter = self._adapters.get(provider.pk, (None, None))
+        if adapter_path != provider.adapter:
+            with self._lock:
+                adapter_path, adapter = self._adapters.get(provider.pk, (None, None))
+                if adapter_path != provider.adapter:
+                    adapter = provider.get_adapter()()
+                    self._adapters[provider.pk] = (provider.adapter, adapter)
+        return adapter
+
+    def invalidate(self):
+        with self._lock:
+            self._adapters = {}
+
+
+adapter_registry = AdapterRegistry()
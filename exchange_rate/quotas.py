@@ -0,0 +1,79 @@
+import time
+
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from exchange_rate.metrics import metrics
+from exchange_rate.models import ProviderRateLimit, ProviderUsage
+
+
+class ProviderQuotas(object):
+    """ Request budgets of each provider, kept in the database so they hold across workers and are never evicted.
+    The rate limit is a generic cell rate algorithm (GCRA): the theoretical arrival time (TAT) of the next request
+    advances 1 / rate_limit seconds per request, and a request is allowed while the TAT is at most rate_burst - 1
+    intervals ahead of now.
+    The quota counts the requests of each calendar month. Both budgets are taken with a single conditional UPDATE,
+    so no lock is needed. Requests rejected by the quota are given back to the rate limit.
+    """
+
+    @classmethod
+    def get_month(cls):
+        return timezone.now().strftime('%Y-%m')
+
+    @classmethod
+    def get_rate_limit(cls, provider):
+        """ Gets the seconds between requests of a provider, and how many of them a request can be ahead of its rate """
+        return 1 / provider.rate_limit, (max(provider.rate_burst, 1) - 1) / provider.rate_limit
+
+    @classmethod
+    def acquire_rate(cls, provider):
+        """ Takes a request from the rate limit of a provider, advancing its TAT if it is allowed """
+        interval, tolerance = cls.get_rate_limit(provider)
+        now = time.time()
+        ProviderRateLimit.objects.bulk_create([ProviderRateLimit(provider_id=provider.pk, tat=now)],
+                                              ignore_conflicts=True)
+        return bool(ProviderRateLimit.objects.filter(provider_id=provider.pk, tat__lte=now + tolerance)
+                    .update(tat=Greatest(F('tat'), now) + interval))
+
+    @classmethod
+    def give_back_rate(cls, provider):
+        """ Gives back a request taken from the rate limit of a provider, moving its TAT back """
+        interval, _ = cls.get_rate_limit(provider)
+        # A TAT left in the past counts as now on the next request
+        ProviderRateLimit.objects.filter(provider_id=provider.pk).update(tat=F('tat') - interval)
+
+    @classmethod
+    def acquire_quota(cls, provider):
+        """ Takes a request from the monthly quota of a provider, if any is left """
+        month = cls.get_month()
+        ProviderUsage.objects.bulk_create([ProviderUsage(provider_id=provider.pk, month=month)], ignore_conflicts=True)
+        return bool(ProviderUsage.objects.filter(provider_id=provider.pk, month=month,
+                                                 requests__lt=provider.monthly_quota)
+                    .update(requests=F('requests') + 1))
+
+    def acquire(self, provider):
+        """ Takes a request from the budgets of a provider
+
+        :param provider: provider about to be requested.
+        :type provider: Provider
+        :return: whether the provider can be requested
+        :rtype: bool
+        """
+        if provider.rate_limit and not self.acquire_rate(provider):
+            metrics.increment('quota.%s.limited' % provider.name)
+            return False
+        if provider.monthly_quota is not None and not self.acquire_quota(provider):
+            if provider.rate_limit:
+                self.give_back_rate(provider)
+            metrics.increment('quota.%s.exhausted' % provider.name)
+            return False
+        return True
+
+    def get_usage(self, provider):
+        """ Gets the requests taken from the quota of a provider in the current month """
+        return ProviderUsage.objects.filter(provider_id=provider.pk, month=self.get_month()) \
+            .values_list('requests', flat=True).first() or 0
+
+
+provider_quotas = ProviderQuotas()
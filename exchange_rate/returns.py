@@ -0,0 +1,123 @@
+import math
+import threading
+
+import numpy as np
+
+from datetime import date, datetime
+
+from django.conf import settings
+
+from exchange_rate.cache import LRUCache
+from exchange_rate.metrics import metrics
+
+
+class PairReturnIndex(object):
+    """ Log rates of a currency pair for consecutive days since start_date, NaN where the rate is not known.
+    The cumulative log return between two dates is the difference of their log rates, so the return of any period is
+    read in constant time. Only stored rates of past dates are indexed, as rates of today may still change.
+    """
+
+    def __init__(self, start_date, log_rates):
+        self.start_date = start_date
+        self.log_rates = log_rates
+
+    @classmethod
+    def get_date(cls, valuation_date):
+        if isinstance(valuation_date, datetime):
+            return valuation_date.date()
+        return valuation_date
+
+    def get(self, valuation_date):
+        """ Gets the log rate of a date, or None if it is not known """
+        index = (self.get_date(valuation_date) - self.start_date).days
+        if 0 <= index < len(self.log_rates) and not math.isnan(self.log_rates[index]):
+            return float(self.log_rates[index])
+        return None
+
+    @classmethod
+    def to_log_rate(cls, rate):
+        """ Gets the log of a rate, or None if the rate is not valid """
+        if not rate or rate <= 0:
+            return None
+        return math.log(rate)
+
+    def set(self, valuation_date, rate):
+        """ Sets the stored rate of a date, growing the index if the date is outside it. Rates of today or later are
+        not indexed.
+
+        :return: the log rate, or None if the rate is not valid
+        :rtype: float
+        """
+        log_rate = self.to_log_rate(rate)
+        valuation_date = self.get_date(valuation_date)
+        if log_rate is None or valuation_date >= date.today():
+            return log_rate
+        index = (valuation_date - self.start_date).days
+        if index < 0:
+            self.log_rates = np.concatenate((np.full(-index, np.nan), self.log_rates))
+            self.start_date, index = valuation_date, 0
+        elif index >= len(self.log_rates):
+            # Grow by doubling, so adding the days one by one is amortized constant time
+            grown_log_rates = np.full(max(index + 1, 2 * len(self.log_rates)), np.nan)
+            grown_log_rates[:len(self.log_rates)] = self.log_rates
+            self.log_rates = grown_log_rates
+        self.log_rates[index] = log_rate
+        return log_rate
+
+
+class ReturnIndex(object):
+    """ Bounded, thread safe, per process cache of the PairReturnIndex of the most recently requested pairs, keyed by
+    (source symbol, exchanged symbol). Indexes are loaded once per pair, and then updated as new rates are stored.
+    """
+
+    def __init__(self, max_pairs):
+        self.pairs = LRUCache(max_pairs)
+        self._lock = threading.Lock()
+
+    def get_pair(self, source_currency, exchanged_currency):
+        """ Gets the index of a pair, or None if it is not loaded """
+        pair_index = self.pairs.get((source_currency.symbol, exchanged_currency.symbol))
+        metrics.increment('return_index.hits' if pair_index is not None else 'return_index.misses')
+        return pair_index
+
+    def set_pair(self, source_currency, exchanged_currency, start_date, rates):
+        """ Loads the index of a pair
+
+        :param start_date: date of the first rate, rates are consecutive days.
+        :type start_date: date
+        :param rates: rates of the pair, NaN where they are not known.
+        :type rates: numpy.ndarray
+        :return: the loaded index
+        :rtype: PairReturnIndex
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_rates = np.log(np.where(rates > 0, rates, np.nan))
+        pair_index = PairReturnIndex(start_date, log_rates)
+        self.pairs.set((source_currency.symbol, exchanged_currency.symbol), pair_index)
+        return pair_index
+
+    def get_log_rate(self, pair_index, valuation_date):
+        with self._lock:
+            return pair_index.get(valuation_date)
+
+    def set_rate(self, pair_index, valuation_date, rate):
+        with self._lock:
+            return pair_index.set(valuation_date, rate)
+
+    def update_matrix(self, symbols, exchange_matrix, valuation_date):
+        """ Adds the rates of an exchange matrix to the loaded indexes of their pairs, looking up the loaded pairs
+        instead of every pair in the matrix """
+        indexes = {symbol: index for index, symbol in enumerate(symbols)}
+        with self._lock:
+            for source_symbol, exchanged_symbol in self.pairs.keys():
+                if source_symbol in indexes and exchanged_symbol in indexes:
+                    pair_index = self.pairs.get((source_symbol, exchanged_symbol))
+                    if pair_index is not None:
+                        pair_index.set(valuation_date, round(
+                            float(exchange_matrix[indexes[source_symbol], indexes[exchanged_symbol]]), 6))
+
+    def clear(self):
+        self.pairs.clear()
+
+
+return_index = ReturnIndex(settings.RATES_RETURN_INDEX_MAX_PAIRS)
@@ -0,0 +1,16 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from exchange_rate.currencies import currency_registry
+from exchange_rate.models import Currency, Provider
+from exchange_rate.providers import adapter_registry
+
+
+@receiver([post_save, post_delete], sender=Currency)
+def invalidate_currency_registry(sender, **kwargs):
+    currency_registry.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Provider)
+def invalidate_adapter_registry(sender, **kwargs):
+    adapter_registry.invalidate()
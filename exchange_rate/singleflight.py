@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from exchange_rate.metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Leases are not shared between processes where file locks are not available
+    fcntl = None
+
+
+class Call(object):
+    """ A call in flight, whose result is shared with the callers waiting for it """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls with the same key, so only one of them runs and the others get its result.
+    Calls are coalesced between threads with do() and between tasks of an event loop with ado(). The running call
+    also holds a file lock lease on its key, so the same key is not run at the same time by other worker processes.
+    Each key has its own lease file, so calls with different keys never wait for each other.
+    """
+    LEASE_POLL_INTERVAL = 0.05
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._futures = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """ Runs fn, unless a call with the same key is already in flight, in which case its result is awaited
+
+        :return: the result of the call, and whether it was shared from another caller
+        :rtype: tuple
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._calls[key] = Call()
+
+        if shared:
+            metrics.increment('singleflight.%s.shared' % self.name)
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            with self.lease(key):
+                call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    async def ado(self, key, fn, *args, **kwargs):
+        """ Awaits fn, unless a call with the same key is already in flight in the event loop, in which case its result
+        is awaited
+
+        :return: the result of the call, and whether it was shared from another caller
+        :rtype: tuple
+        """
+        loop = asyncio.get_running_loop()
+        future = self._futures.get((loop, key))
+        if future is not None:
+            metrics.increment('singleflight.%s.shared' % self.name)
+            return await asyncio.shield(future), True
+
+        future = self._futures[(loop, key)] = loop.create_future()
+        # Avoid warnings about exceptions never retrieved when nobody was waiting for them
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            # Polled in the event loop, as waiting in executor threads would starve the calls holding the leases
+            lease_file = await self.aacquire_lease(key)
+            try:
+                result = await fn(*args, **kwargs)
+            finally:
+                self.release_lease(lease_file)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._futures[(loop, key)]
+        return result, False
+
+    def get_lease_path(self, key):
+        key_hash = hashlib.md5(repr(key).encode()).hexdigest()
+        return os.path.join(settings.RATES_LOCK_DIR, '%s-%s.lock' % (self.name, key_hash))
+
+    def open_lease(self, key):
+        os.makedirs(settings.RATES_LOCK_DIR, exist_ok=True)
+        return open(self.get_lease_path(key), 'a')
+
+    @classmethod
+    def try_lock(cls, lease_file):
+        try:
+            fcntl.flock(lease_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def lease_timeout(self, lease_file):
+        # Go on without the lease rather than failing the request
+        metrics.increment('singleflight.%s.lease_timeouts' % self.name)
+        lease_file.close()
+
+    def acquire_lease(self, key):
+        """ Locks the lease file of a key, waiting up to settings.RATES_FETCH_LEASE_TIMEOUT seconds for it
+
+        :return: the open lease file, or None if the lease was not acquired
+        """
+        if fcntl is None:
+            return None
+        lease_file = self.open_lease(key)
+        deadline = time.monotonic() + settings.RATES_FETCH_LEASE_TIMEOUT
+        while not self.try_lock(lease_file):
+            if time.monotonic() >= deadline:
+                return self.lease_timeout(lease_file)
+            time.sleep(self.LEASE_POLL_INTERVAL)
+        return lease_file
+
+    async def aacquire_lease(self, key):
+        """ Async version of acquire_lease, polling the lease without blocking the event loop or an executor thread
+
+        :return: the open lease file, or None if the lease was not acquired
+        """
+        if fcntl is None:
+            return None
+        lease_file = self.open_lease(key)
+        deadline = time.monotonic() + settings.RATES_FETCH_LEASE_TIMEOUT
+        while not self.try_lock(lease_file):
+            if time.monotonic() >= deadline:
+                return self.lease_timeout(lease_file)
+            await asyncio.sleep(self.LEASE_POLL_INTERVAL)
+        return lease_file
+
+    @classmethod
+    def release_lease(cls, lease_file):
+        if lease_file is not None:
+            fcntl.flock(lease_file, fcntl.LOCK_UN)
+            lease_file.close()
+
+    @contextmanager
+    def lease(self, key):
+        lease_file = self.acquire_lease(key)
+        try:
+            yield
+        finally:
+            self.release_lease(lease_file)
+
+
+provider_flights = SingleFlight('provider')
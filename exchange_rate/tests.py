@@ -1 +1,819 @@
-# Check tests in the api app
\ No newline at end of file
+import asyncio
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+from datetime import date, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.admin.sites import AdminSite
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from api.tests import FakeFixer, FailingFixer, SlowFixer, TrendFixer, fixer_backend
+from exchange_rate.adapters import BaseAdapter, FixerAdapter, FixerClient
+from exchange_rate.admin import ProviderAdmin
+from exchange_rate.breakers import CircuitBreaker, provider_breakers
+from exchange_rate.cache import LRUCache, RateCache, negative_cache, rate_cache
+from exchange_rate.cube import rate_cube
+from exchange_rate.currencies import currency_registry
+from exchange_rate.management.commands.benchmark import Command as BenchmarkCommand
+from exchange_rate.management.commands.benchmark_rebase import legacy_convert_exchange_base, \
+    legacy_parse_exchange_rates
+from exchange_rate.metrics import metrics
+from exchange_rate.models import Currency, CurrencyExchangeRate, IngestionState, Provider
+from exchange_rate.providers import adapter_registry
+from exchange_rate.quotas import provider_quotas
+from exchange_rate.returns import return_index
+from exchange_rate.singleflight import SingleFlight
+from exchange_rate.writebehind import write_behind
+from exchange_rate.utils import get_currency_rates, get_exchange_rate_data_db_providers, \
+    get_exchange_rates_data_providers, get_stored_currency_rates, get_stored_exchange_rate, get_stored_exchange_rates, \
+    get_time_weighted_rate_return, aget_exchange_rates_data_providers
+
+# Check API tests in the api app
+
+
+class StoreValuesTestCase(TestCase):
+    def test_store_values_idempotent(self):
+        """
+        Ensure fetching the same date twice does not duplicate the stored rates
+        """
+        source_currency = Currency.objects.get(symbol='EUR')
+        exchanged_currencies = list(Currency.objects.exclude(symbol='EUR'))
+        with fixer_backend(FakeFixer()):
+            adapter = FixerAdapter()
+            adapter.get_exchange_rates_data(source_currency, exchanged_currencies, date(2021, 1, 4))
+            adapter.get_exchange_rates_data(source_currency, exchanged_currencies, date(2021, 1, 4))
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 12)
+
+    def test_dedupe_rates(self):
+        """
+        Ensure the dedupe command goes through all the stored dates
+        """
+        with fixer_backend(FakeFixer()):
+            adapter = FixerAdapter()
+            for valuation_date in (date(2021, 1, 4), date(2021, 3, 4)):
+                adapter.get_exchange_rates_data(Currency.objects.get(symbol='EUR'), [], valuation_date)
+        out = StringIO()
+        call_command('dedupe_rates', chunk_days=7, stdout=out)
+        self.assertIn('Deleted 0 duplicated exchange rates.', out.getvalue())
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 24)
+
+
+class DedupeRatesTestCase(TransactionTestCase):
+    # The currencies and providers created by the migrations are restored after the table is flushed
+    serialized_rollback = True
+
+    def setUp(self):
+        rate_cache.clear()
+        # Duplicated rates can only be stored without the unique constraint, as before it was added
+        self.constraint = CurrencyExchangeRate._meta.constraints[0]
+        # SQLite rebuilds the table from the model constraints
+        with connection.schema_editor() as editor, mock.patch.object(CurrencyExchangeRate._meta, 'constraints', []):
+            editor.remove_constraint(CurrencyExchangeRate, self.constraint)
+
+    def tearDown(self):
+        CurrencyExchangeRate.objects.all().delete()
+        with connection.schema_editor() as editor:
+            editor.add_constraint(CurrencyExchangeRate, self.constraint)
+
+    def test_dedupe_rates_deletes_duplicates(self):
+        """
+        Ensure the dedupe command deletes the duplicated rates of every chunk, keeping the first stored ones
+        """
+        eur, usd, gbp = (Currency.objects.get(symbol=symbol) for symbol in ('EUR', 'USD', 'GBP'))
+        rates = [CurrencyExchangeRate(source_currency=eur, exchanged_currency=exchanged_currency,
+                                      valuation_date=valuation_date, rate_value=rate_value)
+                 for rate_value in (1.2, 1.3) for valuation_date in (date(2021, 1, 4), date(2021, 3, 4))
+                 for exchanged_currency in (usd, gbp)]
+        CurrencyExchangeRate.objects.bulk_create(rates)
+        out = StringIO()
+        call_command('dedupe_rates', chunk_days=7, stdout=out)
+        self.assertIn('Deleted 4 duplicated exchange rates.', out.getvalue())
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 4)
+        self.assertEqual(set(CurrencyExchangeRate.objects.values_list('rate_value', flat=True)), {Decimal('1.2')})
+
+
+class WriteBehindTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        write_behind.clear()
+        self.addCleanup(write_behind.clear)
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        # Flushes are made by the tests, not by the background thread
+        settings_override = override_settings(RATES_WRITE_BEHIND=True, RATES_WRITE_BEHIND_INTERVAL=3600,
+                                              RATES_WRITE_BEHIND_MAX_ROWS=100000,
+                                              RATES_WRITE_BEHIND_SPILL_PATH=os.path.join(spill_dir.name, 'spill'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def fetch_rates(self):
+        eur, usd = Currency.objects.get(symbol='EUR'), Currency.objects.get(symbol='USD')
+        with fixer_backend(FakeFixer()):
+            self.assertEqual(FixerAdapter().get_exchange_rates_data(eur, [usd], date(2021, 1, 4)), {'USD': 1.2})
+        return eur, usd
+
+    def test_write_behind(self):
+        """
+        Ensure provider rates are read before they are stored, and stored in a single flush
+        """
+        eur, usd = self.fetch_rates()
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 0)
+        self.assertEqual(get_stored_exchange_rates(eur, [usd], date(2021, 1, 4)), {'USD': 1.2})
+        self.assertEqual(write_behind.flush(), 12)
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 12)
+        self.assertEqual(write_behind.flush(), 0)
+
+    def test_write_behind_lookups(self):
+        """
+        Ensure pending rates are read by the single rate and time period lookups, in both storage modes
+        """
+        for storage_mode in ('full', 'pivot'):
+            with self.subTest(storage_mode=storage_mode), override_settings(RATES_STORAGE_MODE=storage_mode):
+                write_behind.clear()
+                eur, usd = self.fetch_rates()
+                rate_cache.clear()
+                self.assertEqual(get_stored_exchange_rate(eur, usd, date(2021, 1, 4)), 1.2)
+                gbp, chf = Currency.objects.get(symbol='GBP'), Currency.objects.get(symbol='CHF')
+                self.assertEqual(get_stored_currency_rates(usd, date(2021, 1, 3), date(2021, 1, 5)),
+                                 {(date(2021, 1, 4), eur.id): 0.833333, (date(2021, 1, 4), gbp.id): 0.75,
+                                  (date(2021, 1, 4), chf.id): 0.916667})
+                self.assertEqual(CurrencyExchangeRate.objects.count(), 0)
+
+    def test_write_behind_spill(self):
+        """
+        Ensure rates spilled on shutdown are stored by the next process
+        """
+        self.fetch_rates()
+        write_behind.spill()
+        self.assertEqual(write_behind.flush(), 0)
+        write_behind.load_spill()
+        self.assertFalse(os.path.exists(settings.RATES_WRITE_BEHIND_SPILL_PATH))
+        self.assertEqual(write_behind.flush(), 12)
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 12)
+
+
+class IngestRatesTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        Provider.objects.exclude(name='Fixer').delete()
+
+    def test_ingest_rates(self):
+        """
+        Ensure the ingestion stores the finished days since the last ingested one, and resumes from it
+        """
+        yesterday = date.today() - timedelta(days=1)
+        with fixer_backend(FakeFixer()) as fixer:
+            call_command('ingest_rates', once=True, start_date=yesterday - timedelta(days=2), stdout=StringIO())
+            self.assertEqual(len(fixer.requests), 3)
+            call_command('ingest_rates', once=True, stdout=StringIO())
+            self.assertEqual(len(fixer.requests), 3)
+        state = IngestionState.objects.get(name='EUR')
+        self.assertEqual(state.last_success_date, yesterday)
+        self.assertEqual(state.failures, 0)
+        self.assertEqual(CurrencyExchangeRate.objects.filter(source_currency__symbol='EUR').count(), 9)
+
+    def test_ingest_rates_failure(self):
+        """
+        Ensure a failed date is recorded and not marked as ingested, and the retry requests the provider again even
+        if it recently failed to return the rates
+        """
+        with fixer_backend(FailingFixer()):
+            call_command('ingest_rates', once=True, stdout=StringIO(), stderr=StringIO())
+        state = IngestionState.objects.get(name='EUR')
+        self.assertIsNone(state.last_success_date)
+        self.assertEqual(state.failures, 1)
+        self.assertIn('USD', state.last_error)
+
+        with fixer_backend(FakeFixer()) as fixer:
+            call_command('ingest_rates', once=True, stdout=StringIO(), stderr=StringIO())
+            self.assertEqual(len(fixer.requests), settings.RATES_INGEST_INITIAL_DAYS)
+        state.refresh_from_db()
+        self.assertEqual(state.last_success_date, date.today() - timedelta(days=1))
+        self.assertEqual(state.failures, 0)
+
+    @override_settings(RATES_REQUEST_PROVIDERS=False)
+    def test_request_providers_disabled(self):
+        """
+        Ensure providers are not called while serving requests when the rates are ingested in the background
+        """
+        source_currency = Currency.objects.get(symbol='EUR')
+        with fixer_backend(FakeFixer()) as fixer:
+            rates = get_exchange_rates_data_providers(source_currency, [Currency.objects.get(symbol='USD')],
+                                                      date(2021, 1, 4))
+        self.assertEqual(rates, {'USD': None})
+        self.assertEqual(fixer.requests, [])
+
+
+class BackfillRatesTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        Provider.objects.exclude(name='Fixer').delete()
+
+    def test_backfill_rates(self):
+        """
+        Ensure only the missing dates are fetched, and a second run finds no gaps
+        """
+        with fixer_backend(FakeFixer()) as fixer:
+            FixerAdapter().get_exchange_rates_data(Currency.objects.get(symbol='EUR'), [], date(2021, 1, 3))
+            out = StringIO()
+            call_command('backfill_rates', start_date=date(2021, 1, 1), end_date=date(2021, 1, 10), workers=3,
+                         chunk_days=4, stdout=out)
+            self.assertEqual(sorted(fixer.requests), ['2021-01-%02d' % day for day in range(1, 11)])
+            self.assertIn('Stored 9/9 dates', out.getvalue())
+            out = StringIO()
+            call_command('backfill_rates', start_date=date(2021, 1, 1), end_date=date(2021, 1, 10), stdout=out)
+            self.assertIn('No missing dates', out.getvalue())
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 120)
+
+    def test_backfill_rates_resume(self):
+        """
+        Ensure the dates no provider returned are fetched again on the next run
+        """
+        with fixer_backend(FailingFixer()):
+            err = StringIO()
+            call_command('backfill_rates', start_date=date(2021, 1, 1), end_date=date(2021, 1, 2), stdout=StringIO(),
+                         stderr=err)
+            self.assertIn('No provider returned the rates of 2 dates', err.getvalue())
+        with fixer_backend(FakeFixer()) as fixer:
+            call_command('backfill_rates', start_date=date(2021, 1, 1), end_date=date(2021, 1, 2), stdout=StringIO())
+            self.assertEqual(len(fixer.requests), 2)
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 24)
+
+    def test_backfill_rates_partial(self):
+        """
+        Ensure the rates of a partially stored date are completed, counting only the ones inserted
+        """
+        with fixer_backend(FakeFixer()):
+            FixerAdapter().get_exchange_rates_data(Currency.objects.get(symbol='EUR'), [], date(2021, 1, 1))
+            CurrencyExchangeRate.objects.filter(source_currency__symbol='EUR',
+                                                exchanged_currency__symbol='USD').delete()
+            out = StringIO()
+            call_command('backfill_rates', start_date=date(2021, 1, 1), end_date=date(2021, 1, 2), stdout=out)
+        self.assertIn('Stored 2 dates and 13 exchange rates', out.getvalue())
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 24)
+
+
+@override_settings(RATES_STORAGE_MODE='pivot', RATES_PIVOT_CURRENCY='EUR')
+class PivotStorageTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+
+    def test_pivot_storage(self):
+        """
+        Ensure only the pivot rates are stored, and the rest are derived from them when read
+        """
+        gbp, usd = currency_registry.get('GBP'), currency_registry.get('USD')
+        with fixer_backend(FakeFixer()) as fixer:
+            FixerAdapter().get_exchange_rates_data(currency_registry.get('EUR'), [], date(2021, 1, 4))
+            self.assertEqual(set(CurrencyExchangeRate.objects.values_list('source_currency__symbol', flat=True)),
+                             {'EUR'})
+            self.assertEqual(CurrencyExchangeRate.objects.count(), 3)
+            rate_cache.clear()
+            self.assertEqual(get_exchange_rate_data_db_providers(gbp, usd, date(2021, 1, 4)), round(1.2 / 0.9, 6))
+            rates = get_currency_rates(gbp, date(2021, 1, 4), date(2021, 1, 4))
+        self.assertEqual(len(fixer.requests), 1)
+        self.assertEqual(rates[0]['rates'], {'EUR': round(1 / 0.9, 6), 'USD': round(1.2 / 0.9, 6), 'GBP': 1.,
+                                             'CHF': round(1.1 / 0.9, 6)})
+
+    def test_compact_rates(self):
+        """
+        Ensure the compact command keeps only the pivot rates, creating them from the inverse rates when missing
+        """
+        with override_settings(RATES_STORAGE_MODE='full'), fixer_backend(FakeFixer()):
+            FixerAdapter().get_exchange_rates_data(currency_registry.get('EUR'), [], date(2021, 1, 4))
+        CurrencyExchangeRate.objects.filter(source_currency__symbol='EUR', exchanged_currency__symbol='GBP').delete()
+        out = StringIO()
+        call_command('compact_rates', stdout=out)
+        self.assertIn('Created 1 pivot exchange rates and deleted 9 derivable ones.', out.getvalue())
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 3)
+        rate_cache.clear()
+        gbp, usd = currency_registry.get('GBP'), currency_registry.get('USD')
+        self.assertAlmostEqual(get_exchange_rate_data_db_providers(gbp, usd, date(2021, 1, 4)), 1.2 / 0.9, places=5)
+
+
+class RateCubeTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        currency_registry.load()
+        cube_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cube_dir.cleanup)
+        self.cube_path = os.path.join(cube_dir.name, 'rates.cube')
+        cube_settings = override_settings(RATES_CUBE_PATH=self.cube_path, RATES_CUBE_CHECK_INTERVAL=0)
+        cube_settings.enable()
+        self.addCleanup(cube_settings.disable)
+
+    def test_rate_cube(self):
+        """
+        Ensure historical rates are read from the exported cube without queries, and the rest from the database
+        """
+        eur, gbp, usd = currency_registry.get('EUR'), currency_registry.get('GBP'), currency_registry.get('USD')
+        with fixer_backend(FakeFixer()):
+            for valuation_date in (date(2021, 1, 4), date(2021, 1, 5), date(2021, 1, 6)):
+                FixerAdapter().get_exchange_rates_data(eur, [], valuation_date)
+        out = StringIO()
+        call_command('export_rate_cube', end_date=date(2021, 1, 5), stdout=out)
+        self.assertIn('Exported 2 days x 4 currencies', out.getvalue())
+        rate_cache.clear()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_exchange_rate_data_db_providers(gbp, usd, date(2021, 1, 4)), round(1.2 / 0.9, 6))
+            rates = get_currency_rates(gbp, date(2021, 1, 4), date(2021, 1, 5))
+        self.assertEqual(rates[1]['rates'], {'EUR': round(1 / 0.9, 6), 'USD': round(1.2 / 0.9, 6), 'GBP': 1.,
+                                             'CHF': round(1.1 / 0.9, 6)})
+        with self.assertNumQueries(1):
+            rates = get_currency_rates(gbp, date(2021, 1, 4), date(2021, 1, 6))
+        self.assertEqual(rates[2]['rates']['USD'], round(1.2 / 0.9, 6))
+
+    def test_rate_cube_swap(self):
+        """
+        Ensure a newly exported cube replaces the mapped one, and rates outside it are read from the database
+        """
+        eur, usd = currency_registry.get('EUR'), currency_registry.get('USD')
+        with fixer_backend(FakeFixer()):
+            FixerAdapter().get_exchange_rates_data(eur, [], date(2021, 1, 4))
+        call_command('export_rate_cube', end_date=date(2021, 1, 3), start_date=date(2021, 1, 1), stdout=StringIO())
+        rate_cache.clear()
+        self.assertIsNone(rate_cube.get_rate(eur, usd, date(2021, 1, 4)))
+        self.assertEqual(get_exchange_rate_data_db_providers(eur, usd, date(2021, 1, 4)), 1.2)
+        call_command('export_rate_cube', end_date=date(2021, 1, 4), stdout=StringIO())
+        self.assertEqual(rate_cube.get_rate(eur, usd, date(2021, 1, 4)), 1.2)
+        self.assertEqual(os.listdir(os.path.dirname(self.cube_path)), ['rates.cube'])
+
+
+class ReturnIndexTestCase(TestCase):
+    def test_return_index(self):
+        """
+        Ensure the rates of a pair are loaded once, and the rates stored later are added to its index
+        """
+        return_index.clear()
+        currency_registry.load()
+        eur, usd = currency_registry.get('EUR'), currency_registry.get('USD')
+        with fixer_backend(TrendFixer()):
+            for day in (4, 5, 6):
+                FixerAdapter().get_exchange_rates_data(eur, [], date(2021, 1, day))
+
+            with self.assertNumQueries(1):
+                twr = get_time_weighted_rate_return(usd, eur, date(2021, 1, 4), 100, date(2021, 1, 6))['twr']
+            self.assertAlmostEqual(twr, 1.01 ** -2 - 1, places=5)
+            with self.assertNumQueries(0):
+                get_time_weighted_rate_return(usd, eur, date(2021, 1, 5), 100, date(2021, 1, 6))
+
+            FixerAdapter().get_exchange_rates_data(eur, [], date(2021, 1, 7))
+            with self.assertNumQueries(0):
+                twr = get_time_weighted_rate_return(usd, eur, date(2021, 1, 4), 100, date(2021, 1, 7))['twr']
+        self.assertAlmostEqual(twr, 1.01 ** -3 - 1, places=5)
+
+    def test_return_index_stored_rates_only(self):
+        """
+        Ensure rates not stored and rates of today are not added to the index
+        """
+        return_index.clear()
+        rate_cache.clear()
+        currency_registry.load()
+        eur, usd = currency_registry.get('EUR'), currency_registry.get('USD')
+        Provider.objects.filter(name='Mock').update(priority=1)
+        Provider.objects.filter(name='Fixer').update(priority=2)
+        adapter_registry.invalidate()
+        self.assertIsNotNone(get_time_weighted_rate_return(eur, usd, date(2021, 1, 4), 100, date(2021, 1, 5)))
+        pair_index = return_index.get_pair(eur, usd)
+        self.assertIsNone(pair_index.get(date(2021, 1, 4)))
+        self.assertIsNone(pair_index.get(date(2021, 1, 5)))
+
+        yesterday = date.today() - timedelta(days=1)
+        for valuation_date, rate_value in ((yesterday, 1.2), (date.today(), 1.5)):
+            CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd,
+                                                valuation_date=valuation_date, rate_value=rate_value)
+        twr = get_time_weighted_rate_return(eur, usd, yesterday, 100)['twr']
+        self.assertAlmostEqual(twr, 1.5 / 1.2 - 1)
+        self.assertAlmostEqual(pair_index.get(yesterday), math.log(1.2))
+        self.assertIsNone(pair_index.get(date.today()))
+
+
+class CurrencyRegistryTestCase(TestCase):
+    def test_currency_registry_single_load(self):
+        """
+        Ensure currencies are looked up in memory once loaded
+        """
+        currency_registry.load()
+        with self.assertNumQueries(0):
+            self.assertEqual(currency_registry.get_currency('GBP').name, 'Pound sterling')
+            self.assertIsNone(currency_registry.get('JPY'))
+            self.assertEqual(len(currency_registry.all()), 4)
+
+    def test_currency_registry_invalidation(self):
+        """
+        Ensure saving or deleting a currency refreshes the registry
+        """
+        currency_registry.load()
+        Currency.objects.create(symbol='JPY', code='JPY', name='Japanese Yen')
+        self.assertEqual(currency_registry.get_currency('JPY').name, 'Japanese Yen')
+        Currency.objects.filter(symbol='JPY').get().delete()
+        with self.assertRaises(Currency.DoesNotExist):
+            currency_registry.get_currency('JPY')
+
+
+class RateCacheTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        currency_registry.load()
+
+    def test_rate_cache_db_lookup(self):
+        """
+        Ensure a rate read from db is served from the cache afterwards
+        """
+        eur, gbp = currency_registry.get('EUR'), currency_registry.get('GBP')
+        CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=gbp,
+                                            valuation_date=date(2021, 1, 4), rate_value=0.9)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_exchange_rate_data_db_providers(eur, gbp, date(2021, 1, 4)), 0.9)
+        hits = metrics.get('rate_cache.local.hits')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_exchange_rate_data_db_providers(eur, gbp, date(2021, 1, 4)), 0.9)
+        self.assertEqual(metrics.get('rate_cache.local.hits'), hits + 1)
+
+        # The shared level still has the rate when the local one is lost
+        rate_cache.local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_exchange_rate_data_db_providers(eur, gbp, date(2021, 1, 4)), 0.9)
+
+    def test_rate_cache_store_values(self):
+        """
+        Ensure rates stored from a provider are cached
+        """
+        with fixer_backend(FakeFixer()):
+            FixerAdapter().get_exchange_rates_data(currency_registry.get('EUR'), [], date(2021, 1, 4))
+        self.assertEqual(rate_cache.get(currency_registry.get('GBP'), currency_registry.get('USD'), date(2021, 1, 4)),
+                         round(1.2 / 0.9, 6))
+
+    @override_settings(RATES_CACHE_TODAY_TTL=60)
+    def test_rate_cache_timeout(self):
+        """
+        Ensure only rates of today or later expire
+        """
+        self.assertIsNone(RateCache.get_timeout(date.today() - timedelta(days=1)))
+        self.assertEqual(RateCache.get_timeout(date.today()), 60)
+
+    def test_lru_cache(self):
+        """
+        Ensure the least recently used entries are evicted first, and expired entries are not returned
+        """
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        cache.set('d', 4, timeout=0)
+        self.assertIsNone(cache.get('d'))
+
+
+class NegativeCacheTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        Provider.objects.filter(name='Fixer').update(priority=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+
+    def test_negative_cache_provider_miss(self):
+        """
+        Ensure a provider is not asked again for a rate it just failed to return
+        """
+        eur, gbp = currency_registry.get('EUR'), currency_registry.get('GBP')
+        failing_fixer = FailingFixer()
+        misses = metrics.get('provider.Fixer.misses')
+        with fixer_backend(failing_fixer):
+            # Mock provider is used when fixer fails
+            self.assertIsNotNone(get_exchange_rate_data_db_providers(eur, gbp, date(2021, 1, 9)))
+            self.assertIsNotNone(get_exchange_rate_data_db_providers(eur, gbp, date(2021, 1, 9)))
+        self.assertEqual(failing_fixer.requests, ['2021-01-09'])
+        self.assertEqual(metrics.get('provider.Fixer.misses'), misses + 1)
+
+    @override_settings(RATES_NEGATIVE_CACHE_TTL=0)
+    def test_negative_cache_expiration(self):
+        """
+        Ensure a provider is asked again once its miss expires
+        """
+        eur, currencies = currency_registry.get('EUR'), currency_registry.all()
+        failing_fixer = FailingFixer()
+        with fixer_backend(failing_fixer):
+            get_exchange_rates_data_providers(eur, currencies, date(2021, 1, 9))
+            get_exchange_rates_data_providers(eur, currencies, date(2021, 1, 9))
+        self.assertEqual(failing_fixer.requests, ['2021-01-09', '2021-01-09'])
+
+
+class SingleFlightTestCase(TestCase):
+    def test_single_flight_threads(self):
+        """
+        Ensure concurrent calls with the same key run once and share the result
+        """
+        single_flight = SingleFlight('test')
+        calls, results = [], []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'rates'
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do('key', fetch)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('rates', False)] + [('rates', True)] * 4)
+
+    def test_single_flight_asyncio(self):
+        """
+        Ensure concurrent tasks with the same key run once and share the result
+        """
+        single_flight = SingleFlight('test')
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 'rates'
+
+        async def run():
+            return await asyncio.gather(*[single_flight.ado('key', fetch) for _ in range(5)])
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('rates', False)] + [('rates', True)] * 4)
+
+    @override_settings(RATES_FETCH_LEASE_TIMEOUT=0)
+    def test_single_flight_lease(self):
+        """
+        Ensure a key lease can not be acquired twice at the same time, and does not block other keys
+        """
+        single_flight = SingleFlight('test')
+        with single_flight.lease('key'):
+            self.assertIsNone(single_flight.acquire_lease('key'))
+            self.assertIsNone(async_to_sync(single_flight.aacquire_lease)('key'))
+            other_lease_file = single_flight.acquire_lease('other key')
+            self.assertIsNotNone(other_lease_file)
+            single_flight.release_lease(other_lease_file)
+        lease_file = single_flight.acquire_lease('key')
+        self.assertIsNotNone(lease_file)
+        single_flight.release_lease(lease_file)
+
+
+class FixerRequestHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for the Fixer HTTP API, counting the connections opened """
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        FixerRequestHandler.connections += 1
+
+    def do_GET(self):
+        body = json.dumps({'success': True, 'date': self.path[1:11], 'base': 'EUR',
+                           'rates': FakeFixer.rates}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AdapterRegistryTestCase(TestCase):
+    def tearDown(self):
+        adapter_registry.invalidate()
+
+    def test_adapter_registry_reuse(self):
+        """
+        Ensure provider adapters are created once and reused
+        """
+        fixer = Provider.objects.get(name='Fixer')
+        adapter = adapter_registry.get_adapter(fixer)
+        self.assertIsInstance(adapter, FixerAdapter)
+        self.assertIs(adapter_registry.get_adapter(Provider.objects.get(name='Fixer')), adapter)
+
+        # Saving the provider, as the admin does, creates a new adapter
+        fixer.save()
+        self.assertIsNot(adapter_registry.get_adapter(fixer), adapter)
+
+    def test_fixer_client_keep_alive(self):
+        """
+        Ensure fixer requests reuse the same connection
+        """
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FixerRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            FixerRequestHandler.connections = 0
+            client = FixerClient('key', timeout=5)
+            client.base_url = 'http://127.0.0.1:%d/' % server.server_port
+            for valuation_date in ('2021-01-04', '2021-01-05', '2021-01-06'):
+                self.assertEqual(client.historical_rates(valuation_date)['date'], valuation_date)
+            self.assertEqual(FixerRequestHandler.connections, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class CircuitBreakerTestCase(TestCase):
+    def test_circuit_breaker(self):
+        """
+        Ensure the breaker opens after the failure threshold and lets a single probe through after the reset timeout
+        """
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.1)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        time.sleep(0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        # A failed probe opens it again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_skips_provider(self):
+        """
+        Ensure a provider is not requested while its breaker is open
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1, failure_threshold=2)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        rate_cache.clear()
+        eur, gbp = currency_registry.get('EUR'), currency_registry.get('GBP')
+        with fixer_backend(FailingFixer()) as failing_fixer:
+            for day in range(4, 8):
+                self.assertIsNotNone(get_exchange_rate_data_db_providers(eur, gbp, date(2021, 1, day)))
+            self.assertEqual(failing_fixer.requests, ['2021-01-04', '2021-01-05'])
+            fixer = Provider.objects.get(name='Fixer')
+            self.assertEqual(ProviderAdmin(Provider, AdminSite()).breaker_state(fixer), CircuitBreaker.OPEN)
+
+    def test_hedged_provider(self):
+        """
+        Ensure the next provider is requested when the first one takes longer than its hedge delay
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1, hedge_delay=0.05)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        rate_cache.clear()
+        eur, gbp = currency_registry.get('EUR'), currency_registry.get('GBP')
+        hedged = metrics.get('provider.Fixer.hedged')
+
+        async def get_rates():
+            started_at = time.monotonic()
+            rates = await aget_exchange_rates_data_providers(eur, [gbp], date(2021, 1, 4))
+            return rates, time.monotonic() - started_at
+
+        with fixer_backend(SlowFixer(1)):
+            rates, elapsed = async_to_sync(get_rates)()
+        self.assertLess(elapsed, 1)
+        self.assertIsNotNone(rates['GBP'])
+        self.assertEqual(metrics.get('provider.Fixer.hedged'), hedged + 1)
+
+
+class ProviderQuotaTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        self.eur, self.usd = Currency.objects.get(symbol='EUR'), Currency.objects.get(symbol='USD')
+
+    def test_monthly_quota(self):
+        """
+        Ensure a provider over its monthly quota is skipped for the next one, and its usage is shown in the admin
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1, monthly_quota=1)
+        Provider.objects.filter(name='Mock').update(priority=2)
+        fixer = Provider.objects.get(name='Fixer')
+        with fixer_backend(FakeFixer()) as backend:
+            rates = get_exchange_rates_data_providers(self.eur, [self.usd], date(2021, 1, 4))
+            self.assertEqual(rates, {'USD': 1.2})
+            rates = get_exchange_rates_data_providers(self.eur, [self.usd], date(2021, 1, 5))
+            self.assertIsNotNone(rates['USD'])
+            self.assertEqual(len(backend.requests), 1)
+        self.assertEqual(ProviderAdmin(Provider, AdminSite()).quota_usage(fixer), '1 / 1')
+
+    def test_rate_limit(self):
+        """
+        Ensure a provider is not requested over its rate limit
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1, rate_limit=0.001, rate_burst=2)
+        Provider.objects.exclude(name='Fixer').delete()
+        with fixer_backend(FakeFixer()) as backend:
+            for day in (4, 5, 6):
+                get_exchange_rates_data_providers(self.eur, [self.usd], date(2021, 1, day))
+            self.assertEqual(len(backend.requests), 2)
+
+    def test_skipped_provider_not_missing(self):
+        """
+        Ensure the rates of a provider skipped for its budget are not recorded as missing in it, synchronously and
+        asynchronously
+        """
+        Provider.objects.filter(name='Fixer').update(priority=1, monthly_quota=0)
+        Provider.objects.exclude(name='Fixer').delete()
+        fixer = Provider.objects.get(name='Fixer')
+        misses = metrics.get('provider.Fixer.misses')
+        with fixer_backend(FakeFixer()) as backend:
+            self.assertEqual(get_exchange_rates_data_providers(self.eur, [self.usd], date(2021, 1, 4)), {'USD': None})
+            self.assertEqual(async_to_sync(aget_exchange_rates_data_providers)(self.eur, [self.usd], date(2021, 1, 5)),
+                             {'USD': None})
+            self.assertEqual(backend.requests, [])
+            self.assertEqual(metrics.get('provider.Fixer.misses'), misses)
+            for day in (4, 5):
+                self.assertEqual(negative_cache.get_missing(fixer, self.eur, [self.usd], date(2021, 1, day)), set())
+
+            Provider.objects.filter(name='Fixer').update(monthly_quota=None)
+            self.assertEqual(get_exchange_rates_data_providers(self.eur, [self.usd], date(2021, 1, 4)), {'USD': 1.2})
+
+    def test_rate_limit_given_back(self):
+        """
+        Ensure a request rejected by the monthly quota is given back to the rate limit
+        """
+        fixer = Provider.objects.get(name='Fixer')
+        fixer.rate_limit, fixer.rate_burst, fixer.monthly_quota = 0.001, 2, 1
+        self.assertTrue(provider_quotas.acquire(fixer))
+        self.assertFalse(provider_quotas.acquire(fixer))
+        fixer.monthly_quota = None
+        self.assertTrue(provider_quotas.acquire(fixer))
+        self.assertFalse(provider_quotas.acquire(fixer))
+
+    def test_budgets_survive_rate_cache(self):
+        """
+        Ensure the budgets of a provider are not lost when the rates cache is flooded or cleared
+        """
+        fixer = Provider.objects.get(name='Fixer')
+        fixer.rate_limit, fixer.rate_burst, fixer.monthly_quota = 0.001, 2, 3
+        self.assertTrue(provider_quotas.acquire(fixer))
+        self.assertTrue(provider_quotas.acquire(fixer))
+        shared = caches[settings.RATES_CACHE]
+        shared.set_many({'flood:%d' % key: key for key in range(settings.CACHES[settings.RATES_CACHE]['OPTIONS']
+                                                                ['MAX_ENTRIES'] + 1)})
+        rate_cache.clear()
+        self.assertEqual(provider_quotas.get_usage(fixer), 2)
+        self.assertFalse(provider_quotas.acquire(fixer))
+        fixer.rate_limit = None
+        self.assertTrue(provider_quotas.acquire(fixer))
+        self.assertFalse(provider_quotas.acquire(fixer))
+        self.assertEqual(provider_quotas.get_usage(fixer), 3)
+
+
+class ExchangeMatrixTestCase(TestCase):
+    exchange_values = {'date': '2021-01-04', 'base': 'EUR', 'rates': {'USD': 1.2, 'GBP': 0.9, 'CHF': 1.1, 'EUR': 1.}}
+
+    def test_parse_exchange_matrix(self):
+        """
+        Ensure the rates created from an exchange matrix are the same as the former ones
+        """
+        currencies = currency_registry.get_currencies()
+        symbols, exchange_matrix = BaseAdapter.get_exchange_matrix(self.exchange_values)
+        rates = BaseAdapter.parse_exchange_matrix(symbols, exchange_matrix, self.exchange_values['date'])
+        legacy_rates = legacy_parse_exchange_rates(legacy_convert_exchange_base(self.exchange_values), currencies)
+        self.assertEqual(
+            sorted((rate.source_currency_id, rate.exchanged_currency_id, rate.rate_value) for rate in rates),
+            sorted((rate.source_currency_id, rate.exchanged_currency_id, rate.rate_value) for rate in legacy_rates))
+        self.assertEqual({rate.valuation_date for rate in rates}, {date(2021, 1, 4)})
+
+    def test_benchmark_rebase(self):
+        """
+        Ensure the rebasing benchmark runs
+        """
+        out = StringIO()
+        call_command('benchmark_rebase', currencies=10, repeat=1, stdout=out)
+        self.assertIn('Rates per day: 90', out.getvalue())
+
+
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        self.addCleanup(currency_registry.invalidate)
+        self.addCleanup(adapter_registry.invalidate)
+
+    def test_benchmark(self):
+        """
+        Ensure the benchmark seeds its dataset, runs every scenario with the faked providers and meets the budgets
+        """
+        command = BenchmarkCommand(stdout=StringIO())
+        report = command.run_benchmarks(currencies=6, days=5, seed=7, repeat=2, ingest_days=2)
+        self.assertEqual(report['dataset']['days'], 38)
+        self.assertEqual(report['dataset']['rates'], 38 * 30)
+        self.assertEqual(set(report['results']), set(BenchmarkCommand.QUERY_BUDGETS))
+        self.assertEqual(report['results']['ingestion']['rates_per_date'], 30)
+        self.assertEqual(command.get_exceeded_budgets(report), [])
+        json.dumps(report)
@@ -1,8 +1,25 @@
+import asyncio
+import numpy as np
 import pandas as pd
 
-from datetime import date
+from asgiref.sync import sync_to_async
+from collections import defaultdict
+from datetime import date, timedelta
 
-from exchange_rate.models import CurrencyExchangeRate, Provider, Currency
+from django.conf import settings
+from django.db.models import Count, Max, Q
+
+from exchange_rate.breakers import provider_breakers
+from exchange_rate.cache import negative_cache, rate_cache
+from exchange_rate.cube import rate_cube
+from exchange_rate.currencies import currency_registry, get_pivot_currency
+from exchange_rate.metrics import metrics
+from exchange_rate.models import CurrencyExchangeRate, Provider
+from exchange_rate.providers import adapter_registry
+from exchange_rate.quotas import provider_quotas
+from exchange_rate.returns import PairReturnIndex, return_index
+from exchange_rate.singleflight import provider_flights
+from exchange_rate.writebehind import write_behind
 
 
 def get_exchange_rate_data(source_currency, exchanged_currency, valuation_date, provider):
@@ -10,83 +27,827 @@ def get_exchange_rate_data(source_currency, exchanged_currency, valuation_date,
     Parameters: source_currency / exchanged_currency / valuation_date / provider
     Response: dict with the exchange rate info
     """
-    adapter = provider.get_adapter()
-    return adapter().get_exchange_rate_data(source_currency, exchanged_currency, valuation_date)
+    adapter = adapter_registry.get_adapter(provider)
+    return adapter.get_exchange_rate_data(source_currency, exchanged_currency, valuation_date)
 
 
 def get_exchange_rate_data_db_providers(source_currency, exchanged_currency, valuation_date):
-    """Get the exchange rate data looking for it first in the database, if not present there, get it from providers
-    iterating over them in priority order
+    """Get the exchange rate data looking for it first in the cache and the database, if not present there, get it from
+    providers iterating over them in priority order
     Parameters: source_currency: source currency symbol/ valuation_date / provider
     Response: dict with the exchange rate info
     """
     if source_currency == exchanged_currency:
         return 1.
-    rate = CurrencyExchangeRate.objects.filter(source_currency=source_currency,
-                                               exchanged_currency=exchanged_currency,
-                                               valuation_date=valuation_date).first()
-    if rate:
-        return float(rate.rate_value)
+    rate_value = get_stored_exchange_rate(source_currency, exchanged_currency, valuation_date)
+    if rate_value is not None:
+        return rate_value
     # Rate is not in db, look for it in providers ordered by priority
-    providers = Provider.objects.all().order_by('priority')
-    for provider in providers:
-        rate_data = get_exchange_rate_data(source_currency, exchanged_currency, valuation_date, provider)
-        if rate_data:
-            return rate_data['rate_value']
-    return None
+    return get_exchange_rate_data_providers(source_currency, exchanged_currency, valuation_date)
+
+
+def get_stored_exchange_rate(source_currency, exchanged_currency, valuation_date):
+    """Get the exchange rate stored in the rate cube or the cache or, if not present there, in the database
+    Parameters: source_currency / exchanged_currency / valuation_date
+    Response: the rate value, or None if it is not stored
+    """
+    rate_value = rate_cube.get_rate(source_currency, exchanged_currency, valuation_date)
+    if rate_value is not None:
+        return rate_value
+    rate_value = rate_cache.get(source_currency, exchanged_currency, valuation_date)
+    if rate_value is not None:
+        return rate_value
+    rate_value = get_stored_exchange_rates(source_currency, [exchanged_currency],
+                                           valuation_date).get(exchanged_currency.symbol)
+    if rate_value is not None:
+        rate_cache.set(source_currency, exchanged_currency, valuation_date, rate_value)
+    return rate_value
+
+
+def get_exchange_rate_data_providers(source_currency, exchanged_currency, valuation_date):
+    """Get the exchange rate data from providers iterating over them in priority order
+    Parameters: source_currency / exchanged_currency / valuation_date
+    Response: the rate value, or None if no provider has it
+    """
+    rates = get_exchange_rates_data_providers(source_currency, [exchanged_currency], valuation_date)
+    return rates[exchanged_currency.symbol]
+
+
+def get_exchange_rates_data_providers(source_currency, exchanged_currencies, valuation_date, on_request=True):
+    """Get the exchange rates of a date for several currencies from providers iterating over them in priority order.
+    Each provider is called once with the rates still missing, skipping the ones it recently failed to return, and
+    providers whose circuit breaker is open or that are over their budget are skipped. Rates of a provider skipped for
+    its budget are not recorded as missing in it.
+    Providers are not called while serving requests if settings.RATES_REQUEST_PROVIDERS is False, and the ingestion,
+    which retries on its own schedule, requests them even the rates they recently failed to return.
+    Parameters: source_currency / exchanged_currencies / valuation_date / on_request: whether a request is being served
+    Response: dict with the rate values keyed by exchanged currency symbol, None if no provider has it
+    """
+    rates = {exchanged_currency.symbol: None for exchanged_currency in exchanged_currencies}
+    if on_request and not settings.RATES_REQUEST_PROVIDERS:
+        metrics.increment('providers.skipped')
+        return rates
+    missing_currencies = list(exchanged_currencies)
+    for provider in Provider.objects.all().order_by('priority'):
+        if not missing_currencies:
+            break
+        provider_misses = negative_cache.get_missing(provider, source_currency, missing_currencies, valuation_date) \
+            if on_request else set()
+        requested_currencies = [currency for currency in missing_currencies if currency.symbol not in provider_misses]
+        if requested_currencies and provider_breakers.get_breaker(provider).allow_request():
+            provider_rates, skipped = get_provider_exchange_rates(provider, source_currency, requested_currencies,
+                                                                  valuation_date)
+            rates.update(provider_rates)
+            if not skipped:
+                provider_misses = [currency for currency in requested_currencies if rates[currency.symbol] is None]
+                negative_cache.set_missing(provider, source_currency, provider_misses, valuation_date)
+        missing_currencies = [currency for currency in missing_currencies if rates[currency.symbol] is None]
+    return rates
+
+
+def get_provider_exchange_rates(provider, source_currency, exchanged_currencies, valuation_date):
+    """Get the exchange rates of a date for several currencies from a provider.
+    Concurrent requests to the same provider and date are coalesced into a single provider call, whose result is shared
+    with the waiting requests. Rates it stored for other source or exchanged currencies are read from the cache.
+    Parameters: provider / source_currency / exchanged_currencies / valuation_date
+    Response: dict with the rate values found, keyed by exchanged currency symbol, and whether the provider was not
+              requested for being over its budget
+    """
+    def fetch(requested_currencies):
+        # Rates may have been stored by another process while waiting for the lease
+        fetched_rates = get_stored_exchange_rates(source_currency, requested_currencies, valuation_date)
+        missing_currencies = [currency for currency in requested_currencies if currency.symbol not in fetched_rates]
+        # Providers over their budget are not requested, so the rates are taken from the next one
+        skipped = bool(missing_currencies) and not provider_quotas.acquire(provider)
+        if missing_currencies and not skipped:
+            adapter = adapter_registry.get_adapter(provider)
+            breaker = provider_breakers.get_breaker(provider)
+            try:
+                provider_rates = adapter.get_exchange_rates_data(source_currency, missing_currencies, valuation_date)
+            except Exception:
+                breaker.record_failure()
+                raise
+            record_provider_outcome(breaker, provider_rates)
+            fetched_rates.update(provider_rates)
+        return source_currency, {currency.symbol for currency in requested_currencies}, fetched_rates, skipped
+
+    rates = {}
+    skipped = False
+    missing_currencies = list(exchanged_currencies)
+    while missing_currencies:
+        flight, shared = provider_flights.do((provider.pk, valuation_date), fetch, missing_currencies)
+        skipped = skipped or is_flight_skipped(source_currency, flight)
+        missing_currencies = get_flight_rates(source_currency, missing_currencies, valuation_date, flight, shared,
+                                              rates)
+    return rates, skipped
+
+
+def record_provider_outcome(breaker, provider_rates):
+    """Record in the provider breaker whether it returned any of the requested rates"""
+    if provider_rates:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+def get_flight_rates(source_currency, exchanged_currencies, valuation_date, flight, shared, rates):
+    """Get the requested rates from the result of a provider call, which may have been shared by another request
+    Parameters: source_currency / exchanged_currencies / valuation_date / flight: the call result / shared / rates:
+                dict where the rates found are added
+    Response: the exchanged currencies that have to be requested again
+    """
+    flight_source, flight_symbols, flight_rates, flight_skipped = flight
+    if flight_source == source_currency:
+        rates.update({symbol: flight_rates[symbol] for symbol in flight_symbols if symbol in flight_rates})
+        exchanged_currencies = [currency for currency in exchanged_currencies if currency.symbol not in flight_symbols]
+    if not shared:
+        return []
+    for currency in exchanged_currencies:
+        rate_value = rate_cache.get(source_currency, currency, valuation_date)
+        if rate_value is not None:
+            rates[currency.symbol] = rate_value
+    # Rates the shared call did not request are requested again
+    return [currency for currency in exchanged_currencies if currency.symbol not in rates]
+
+
+def is_flight_skipped(source_currency, flight):
+    """Whether a provider call for the same source currency was not made for the provider being over its budget"""
+    flight_source, flight_symbols, flight_rates, flight_skipped = flight
+    return flight_skipped and flight_source == source_currency
+
+
+def get_stored_exchange_rates(source_currency, exchanged_currencies, valuation_date):
+    """Get the rates stored in the database for a source currency into several currencies in a date, using a single
+    query
+    Parameters: source_currency / exchanged_currencies / valuation_date
+    Response: dict with the rate values keyed by exchanged currency symbol
+    """
+    pivot_currency = get_pivot_currency()
+    if pivot_currency is not None and source_currency != pivot_currency:
+        return get_stored_pivot_exchange_rates(pivot_currency, source_currency, exchanged_currencies, valuation_date)
+    stored_rates = CurrencyExchangeRate.objects.filter(source_currency=source_currency,
+                                                       exchanged_currency__in=exchanged_currencies,
+                                                       valuation_date=valuation_date)
+    rates = write_behind.get_pending_rates(source_currency, exchanged_currencies, valuation_date)
+    rates.update((exchanged_currency_symbol, float(rate_value)) for exchanged_currency_symbol, rate_value
+                 in stored_rates.values_list('exchanged_currency__symbol', 'rate_value'))
+    return rates
+
+
+def get_stored_pivot_exchange_rates(pivot_currency, source_currency, exchanged_currencies, valuation_date):
+    """Get the rates for a source currency into several currencies in a date, derived from the rates of the pivot
+    currency stored in the database, using a single query
+    Parameters: pivot_currency / source_currency / exchanged_currencies / valuation_date
+    Response: dict with the rate values keyed by exchanged currency symbol
+    """
+    stored_rates = CurrencyExchangeRate.objects.filter(source_currency=pivot_currency,
+                                                       exchanged_currency__in=[source_currency, *exchanged_currencies],
+                                                       valuation_date=valuation_date)
+    pivot_rates = write_behind.get_pending_rates(pivot_currency, [source_currency, *exchanged_currencies],
+                                                 valuation_date)
+    pivot_rates.update((exchanged_currency_symbol, float(rate_value)) for exchanged_currency_symbol, rate_value
+                       in stored_rates.values_list('exchanged_currency__symbol', 'rate_value'))
+    pivot_rates[pivot_currency.symbol] = 1.
+    if source_currency.symbol not in pivot_rates:
+        return {}
+    symbols = [currency.symbol for currency in exchanged_currencies if currency.symbol in pivot_rates]
+    rates = np.array([pivot_rates[symbol] for symbol in symbols]) / pivot_rates[source_currency.symbol]
+    return dict(zip(symbols, rates.round(6).tolist()))
+
+
+def get_stored_currency_rates(source_currency, start_date, end_date):
+    """Get all the rates stored in the database for a source currency in a time period, using a single query
+    Parameters: source_currency / start_date / end_date
+    Response: dict with the rate values keyed by (valuation_date, exchanged_currency_id)
+    """
+    pivot_currency = get_pivot_currency()
+    if pivot_currency is not None and source_currency != pivot_currency:
+        return get_stored_pivot_currency_rates(pivot_currency, source_currency, start_date, end_date)
+    stored_rates = CurrencyExchangeRate.objects.filter(source_currency=source_currency,
+                                                       valuation_date__range=(start_date, end_date))
+    rates = write_behind.get_pending_period_rates(source_currency, start_date, end_date)
+    rates.update(((valuation_date, exchanged_currency_id), float(rate_value))
+                 for valuation_date, exchanged_currency_id, rate_value
+                 in stored_rates.values_list('valuation_date', 'exchanged_currency_id', 'rate_value'))
+    return rates
+
+
+def get_stored_pivot_currency_rates(pivot_currency, source_currency, start_date, end_date):
+    """Get the rates for a source currency in a time period, derived from the rates of the pivot currency stored in
+    the database, using a single query. Every date is rebased at once dividing the date x currency matrix of pivot
+    rates by its source currency column.
+    Parameters: pivot_currency / source_currency / start_date / end_date
+    Response: dict with the rate values keyed by (valuation_date, exchanged_currency_id)
+    """
+    stored_rates = CurrencyExchangeRate.objects.filter(source_currency=pivot_currency,
+                                                       valuation_date__range=(start_date, end_date))
+    pivot_rows = write_behind.get_pending_period_rates(pivot_currency, start_date, end_date)
+    pivot_rows.update(((valuation_date, exchanged_currency_id), rate_value) for valuation_date, exchanged_currency_id,
+                      rate_value in stored_rates.values_list('valuation_date', 'exchanged_currency_id', 'rate_value'))
+    pivot_rates = pd.DataFrame([(*key, rate_value) for key, rate_value in pivot_rows.items()],
+                               columns=['valuation_date', 'exchanged_currency_id', 'rate_value'])
+    if pivot_rates.empty:
+        return {}
+    pivot_matrix = pivot_rates.pivot(index='valuation_date', columns='exchanged_currency_id',
+                                     values='rate_value').astype(float)
+    pivot_matrix[pivot_currency.id] = 1.
+    if source_currency.id not in pivot_matrix:
+        return {}
+    rates_matrix = pivot_matrix.div(pivot_matrix[source_currency.id], axis=0).round(6)
+    rates = rates_matrix.drop(columns=source_currency.id).stack().dropna()
+    return dict(zip(rates.index, rates.tolist()))
+
+
+def get_stored_rates_version(source_currency, *date_ranges):
+    """Get the version of the rates stored for a source currency in several time periods, which changes whenever rates
+    are stored or deleted in them, with a single query
+    Parameters: source_currency / date_ranges: (start_date, end_date) tuples
+    Response: the number of stored rates and their highest id, and whether every rate of those dates is stored, so
+              nothing has to be requested to the providers
+    """
+    pivot_currency = get_pivot_currency()
+    dates_filter = Q()
+    valuation_dates = set()
+    for start_date, end_date in date_ranges:
+        dates_filter |= Q(valuation_date__range=(start_date, end_date))
+        valuation_dates.update(start_date + timedelta(days=offset)
+                               for offset in range((end_date - start_date).days + 1))
+    version = CurrencyExchangeRate.objects.filter(dates_filter, source_currency=pivot_currency or source_currency) \
+        .aggregate(count=Count('id'), max_id=Max('id'))
+    complete = version['count'] >= len(valuation_dates) * (len(currency_registry.all()) - 1)
+    return (version['count'], version['max_id']), complete
+
+
+def get_currency_rates_matrix(source_currency, start_date, end_date):
+    """ Currency rates stored for a specific time period
+    The dates in the rate cube are read from it, the rest of the period is loaded from the database at once, and the
+    date x currency matrix is built in memory.
+    Parameters: source_currency / date_from / date_to
+    Response: the list of dates, the matrix of rate values as a dict of dicts keyed by date and currency symbol, and
+              the currencies missing in each date as a dict of lists
+    """
+    dates = [valuation_date.date() for valuation_date in pd.date_range(start_date, end_date)]
+    currencies = currency_registry.all()
+    rates_matrix = rate_cube.get_currency_rates(source_currency, dates, currencies)
+    stored_dates = [valuation_date for valuation_date in dates if valuation_date not in rates_matrix]
+    if not stored_dates:
+        return dates, rates_matrix, defaultdict(list)
+    stored_rates = get_stored_currency_rates(source_currency, stored_dates[0], stored_dates[-1])
+
+    missing_rates = defaultdict(list)
+    for valuation_date in stored_dates:
+        rates_matrix[valuation_date] = {}
+        for exchanged_currency in currencies:
+            if exchanged_currency == source_currency:
+                rate = 1.
+            else:
+                rate = stored_rates.get((valuation_date, exchanged_currency.id))
+                if rate is None:
+                    missing_rates[valuation_date].append(exchanged_currency)
+            rates_matrix[valuation_date][exchanged_currency.symbol] = rate
+    return dates, rates_matrix, missing_rates
 
 
 def get_currency_rates(source_currency, start_date, end_date):
     """ Currency rates for a specific time period
+    The whole period is loaded from the database at once, and only the missing rates are requested to the providers.
     Parameters: source_currency / date_from / date_to
     Response: a time series list of rate values for each available Currency
     """
-    currency_rates = []
-    dates = pd.date_range(start_date, end_date)
+    dates, rates_matrix = get_provider_currency_rates_matrix(source_currency, start_date, end_date)
+    return format_currency_rates(source_currency, dates, rates_matrix)
 
-    for valuation_date in dates:
-        daily_currency_rate = {'source_currency': source_currency.symbol,
-                               'valuation_date': valuation_date.strftime('%Y-%m-%d')}
-        rates = {}
-        for exchanged_currency in Currency.objects.all():
-            rate = get_exchange_rate_data_db_providers(source_currency, exchanged_currency, valuation_date)
-            rates[exchanged_currency.symbol] = rate
-        daily_currency_rate['rates'] = rates
-        currency_rates.append(daily_currency_rate)
 
-    return currency_rates
+def get_columnar_currency_rates(source_currency, start_date, end_date):
+    """ Currency rates for a specific time period, as columns instead of a time series
+    Parameters: source_currency / date_from / date_to
+    Response: dict with the list of dates, the list of currencies and the dates x currencies matrix of rate values
+    """
+    dates, rates_matrix = get_provider_currency_rates_matrix(source_currency, start_date, end_date)
+    return format_columnar_currency_rates(source_currency, dates, rates_matrix)
+
+
+def get_provider_currency_rates_matrix(source_currency, start_date, end_date):
+    """ Currency rates for a specific time period, requesting the rates not stored to the providers
+    Parameters: source_currency / date_from / date_to
+    Response: the list of dates and the matrix of rate values as a dict of dicts keyed by date and currency symbol
+    """
+    dates, rates_matrix, missing_rates = get_currency_rates_matrix(source_currency, start_date, end_date)
+
+    # Rates not in db, look for them in providers, with a single request per date
+    for valuation_date, exchanged_currencies in missing_rates.items():
+        rates_matrix[valuation_date].update(
+            get_exchange_rates_data_providers(source_currency, exchanged_currencies, valuation_date))
+    return dates, rates_matrix
+
+
+def iter_currency_rates(source_currency, start_date, end_date):
+    """ Currency rates for a specific time period, yielded date by date
+    The period is read in chunks of settings.RATES_STREAM_CHUNK_DAYS days, so memory does not grow with its length.
+    Parameters: source_currency / date_from / date_to
+    Response: a generator of the rate values for each available Currency in each date
+    """
+    chunk_days = timedelta(days=settings.RATES_STREAM_CHUNK_DAYS)
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + chunk_days - timedelta(days=1), end_date)
+        yield from get_currency_rates(source_currency, chunk_start, chunk_end)
+        chunk_start = chunk_end + timedelta(days=1)
+
+
+def format_currency_rates(source_currency, dates, rates_matrix):
+    return [{'source_currency': source_currency.symbol, 'valuation_date': valuation_date.strftime('%Y-%m-%d'),
+             'rates': rates_matrix[valuation_date]} for valuation_date in dates]
+
+
+def format_columnar_currency_rates(source_currency, dates, rates_matrix):
+    # Rates missing in every provider are NaN
+    symbols = [currency.symbol for currency in currency_registry.all()]
+    rates = np.array([[rates_matrix[valuation_date].get(symbol) for symbol in symbols] for valuation_date in dates],
+                     dtype=float).reshape(len(dates), len(symbols))
+    return {'source_currency': source_currency.symbol,
+            'dates': [valuation_date.strftime('%Y-%m-%d') for valuation_date in dates],
+            'currencies': symbols, 'rates': rates}
 
 
 def get_exchanged_currency_amount(source_currency, exchanged_currency, amount):
     """ Calculates (latest) amount in a currency exchanged into a different currency.
+    The latest rate stored in the last settings.RATES_LATEST_MAX_STALENESS_DAYS days is used, and only if there is
+    none today's rate is requested to the providers.
     Parameters: source_currency, exchanged_currency, amount.
-    Response: an dict containing the exchanged amount along with the currencies and exchange rate.
+    Response: an dict containing the exchanged amount along with the currencies, exchange rate and its date, or None
+              if the rate is not available
+    """
+    valuation_date, rate = get_latest_stored_exchange_rate(source_currency, exchanged_currency,
+                                                           settings.RATES_LATEST_MAX_STALENESS_DAYS)
+    if rate is None:
+        valuation_date = date.today()
+        rate = get_exchange_rate_data_db_providers(source_currency, exchanged_currency, valuation_date)
+    if rate is None:
+        return None
+    return format_exchanged_currency_amount(source_currency, exchanged_currency, amount, rate, valuation_date)
+
+
+def get_latest_stored_exchange_rate(source_currency, exchanged_currency, max_staleness_days):
+    """Get the latest rate of a pair stored in the last days, from the pointer to it cached for the pair or, if not
+    present there, with a single query ordered by the unique (source, exchanged, date) index
+    Parameters: source_currency / exchanged_currency / max_staleness_days: days the rate can be older than today
+    Response: the date and value of the rate, or (None, None) if there is no rate stored in those days
+    """
+    if source_currency == exchanged_currency:
+        return date.today(), 1.
+    if max_staleness_days <= 0:
+        return None, None
+    oldest_date = date.today() - timedelta(days=max_staleness_days)
+    latest = rate_cache.get_latest(source_currency, exchanged_currency)
+    if latest is not None and latest[0] >= oldest_date:
+        return latest
+
+    pivot_currency = get_pivot_currency()
+    if pivot_currency is None or source_currency == pivot_currency:
+        latest = CurrencyExchangeRate.objects.filter(source_currency=source_currency,
+                                                     exchanged_currency=exchanged_currency,
+                                                     valuation_date__range=(oldest_date, date.today())) \
+            .order_by('-valuation_date').values_list('valuation_date', 'rate_value').first()
+    else:
+        stored_rates = CurrencyExchangeRate.objects.filter(source_currency=pivot_currency,
+                                                           exchanged_currency__in=[source_currency, exchanged_currency],
+                                                           valuation_date__range=(oldest_date, date.today()))
+        pivot_rates = defaultdict(lambda: {pivot_currency.id: 1.})
+        for valuation_date, exchanged_currency_id, rate_value in stored_rates.values_list(
+                'valuation_date', 'exchanged_currency_id', 'rate_value'):
+            pivot_rates[valuation_date][exchanged_currency_id] = float(rate_value)
+        latest = next(((valuation_date, round(day_rates[exchanged_currency.id] / day_rates[source_currency.id], 6))
+                       for valuation_date, day_rates in sorted(pivot_rates.items(), reverse=True)
+                       if day_rates.get(source_currency.id) and exchanged_currency.id in day_rates), None)
+    if latest is None:
+        return None, None
+    valuation_date, rate = latest[0], float(latest[1])
+    rate_cache.set_latest(source_currency, exchanged_currency, valuation_date, rate)
+    return valuation_date, rate
+
+
+def format_exchanged_currency_amount(source_currency, exchanged_currency, amount, rate, valuation_date):
+    return {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
+            'valuation_date': valuation_date.strftime('%Y-%m-%d'), 'rate': rate, 'exchanged_amount': amount * rate}
+
+
+def get_exchanged_currency_amounts(conversions):
+    """ Calculates several amounts in a currency exchanged into a different currency in a date.
+    The rates not in the rate cube or the cache are loaded from the database with a single query, the ones not stored
+    are requested to the providers with a single request per source currency and date, and all the amounts are
+    exchanged at once.
+    Parameters: conversions: list of (source_currency, exchanged_currency, amount, valuation_date) tuples
+    Response: a list with a dict containing the exchanged amount along with the currencies, date and exchange rate for
+              each conversion, or None if its rate is not available
     """
-    rate = get_exchange_rate_data_db_providers(source_currency, exchanged_currency, date.today())
+    rate_keys = {(source_currency, exchanged_currency, valuation_date)
+                 for source_currency, exchanged_currency, amount, valuation_date in conversions}
+    rates = {}
+    for source_currency, exchanged_currency, valuation_date in rate_keys:
+        if source_currency == exchanged_currency:
+            rates[source_currency, exchanged_currency, valuation_date] = 1.
+            continue
+        rate_value = rate_cube.get_rate(source_currency, exchanged_currency, valuation_date)
+        if rate_value is None:
+            rate_value = rate_cache.get(source_currency, exchanged_currency, valuation_date)
+        if rate_value is not None:
+            rates[source_currency, exchanged_currency, valuation_date] = rate_value
+    stored_rates = get_stored_exchange_rates_batch(rate_keys - rates.keys())
+    rate_cache.set_many((source_currency.symbol, exchanged_currency.symbol, valuation_date, rate_value)
+                        for (source_currency, exchanged_currency, valuation_date), rate_value in stored_rates.items())
+    rates.update(stored_rates)
+
+    # Rates not in db, look for them in providers, with a single request per source currency and date
+    missing_rates = defaultdict(list)
+    for source_currency, exchanged_currency, valuation_date in rate_keys - rates.keys():
+        missing_rates[source_currency, valuation_date].append(exchanged_currency)
+    for (source_currency, valuation_date), exchanged_currencies in missing_rates.items():
+        provider_rates = get_exchange_rates_data_providers(source_currency, exchanged_currencies, valuation_date)
+        for exchanged_currency in exchanged_currencies:
+            rates[source_currency, exchanged_currency, valuation_date] = provider_rates.get(exchanged_currency.symbol)
+
+    conversion_rates = np.array([rates[source_currency, exchanged_currency, valuation_date]
+                                 for source_currency, exchanged_currency, amount, valuation_date in conversions],
+                                dtype=float)
+    amounts = np.array([amount for source_currency, exchanged_currency, amount, valuation_date in conversions],
+                       dtype=float)
+    exchanged_amounts = amounts * conversion_rates
+    return [format_exchanged_currency_amounts(source_currency, exchanged_currency, amount, valuation_date, rate,
+                                              exchanged_amount)
+            for (source_currency, exchanged_currency, amount, valuation_date), rate, exchanged_amount
+            in zip(conversions, conversion_rates.tolist(), exchanged_amounts.tolist())]
+
+
+def get_stored_exchange_rates_batch(rate_keys):
+    """Get the rates stored in the database for several source currencies, exchanged currencies and dates, filtering
+    each (source currency, date) for its exchanged currencies only, or each date for the currencies needed in pivot
+    storage mode, so no other rates are read. A single query reads up to settings.RATES_BATCH_QUERY_GROUPS of them.
+    Parameters: rate_keys: set of (source_currency, exchanged_currency, valuation_date) tuples
+    Response: dict with the rate values keyed by (source_currency, exchanged_currency, valuation_date)
+    """
+    if not rate_keys:
+        return {}
+    currencies = {currency.id: currency for key in rate_keys for currency in key[:2]}
+    pivot_currency = get_pivot_currency()
+    if pivot_currency is None:
+        exchanged_currencies = defaultdict(set)
+        for source_currency, exchanged_currency, valuation_date in rate_keys:
+            exchanged_currencies[source_currency.id, valuation_date].add(exchanged_currency.id)
+        stored_rates = filter_grouped_rates(
+            [Q(source_currency=source_currency_id, valuation_date=valuation_date,
+               exchanged_currency__in=exchanged_currency_ids)
+             for (source_currency_id, valuation_date), exchanged_currency_ids in exchanged_currencies.items()],
+            'source_currency_id', 'exchanged_currency_id', 'valuation_date', 'rate_value')
+        rates = {(currencies[source_currency_id], currencies[exchanged_currency_id], valuation_date): float(rate_value)
+                 for source_currency_id, exchanged_currency_id, valuation_date, rate_value in stored_rates}
+        return {rate_key: rates[rate_key] for rate_key in rate_keys if rate_key in rates}
+
+    date_currencies = defaultdict(set)
+    for source_currency, exchanged_currency, valuation_date in rate_keys:
+        date_currencies[valuation_date].update(currency.id for currency in (source_currency, exchanged_currency)
+                                               if currency != pivot_currency)
+    stored_rates = filter_grouped_rates(
+        [Q(source_currency=pivot_currency, valuation_date=valuation_date, exchanged_currency__in=currency_ids)
+         for valuation_date, currency_ids in date_currencies.items()],
+        'exchanged_currency_id', 'valuation_date', 'rate_value')
+    pivot_rates = {(exchanged_currency_id, valuation_date): float(rate_value)
+                   for exchanged_currency_id, valuation_date, rate_value in stored_rates}
+    rates = {}
+    for source_currency, exchanged_currency, valuation_date in rate_keys:
+        source_rate = 1. if source_currency == pivot_currency else pivot_rates.get((source_currency.id, valuation_date))
+        exchanged_rate = 1. if exchanged_currency == pivot_currency else \
+            pivot_rates.get((exchanged_currency.id, valuation_date))
+        if source_rate and exchanged_rate is not None:
+            rates[source_currency, exchanged_currency, valuation_date] = round(exchanged_rate / source_rate, 6)
+    return rates
+
+
+def filter_grouped_rates(group_filters, *fields):
+    """Get the stored rates matching any of several filters, OR-ing up to settings.RATES_BATCH_QUERY_GROUPS of them in
+    each query
+    Parameters: group_filters: list of Q / fields: fields of the values read
+    Response: a generator of the values of each rate as a tuple
+    """
+    for start in range(0, len(group_filters), settings.RATES_BATCH_QUERY_GROUPS):
+        rates_filter = Q()
+        for group_filter in group_filters[start:start + settings.RATES_BATCH_QUERY_GROUPS]:
+            rates_filter |= group_filter
+        yield from CurrencyExchangeRate.objects.filter(rates_filter).values_list(*fields)
+
+
+def format_exchanged_currency_amounts(source_currency, exchanged_currency, amount, valuation_date, rate,
+                                      exchanged_amount):
+    if np.isnan(rate):
+        return None
     return {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
-            'rate': rate, 'exchanged_amount': amount * rate}
+            'valuation_date': valuation_date.strftime('%Y-%m-%d'), 'amount': amount, 'rate': rate,
+            'exchanged_amount': exchanged_amount}
 
 
-def get_time_weighted_rate_return(source_currency, exchanged_currency, start_date, amount):
+def get_time_weighted_rate_return(source_currency, exchanged_currency, start_date, amount, end_date=None,
+                                  cash_flows=None):
     """ time-weighted rate of return for any given amount invested from a currency into another one from given date
-    until today:
-    Parameters: source_currency, exchanged_currency, start_date, amount
+    until today, or a given end date, with optional cash flows splitting the period.
+    The log rates of the pair are read from its return index, loaded once per process, so periods without cash flows
+    are computed in constant time, and only the rates missing there are looked up. Only stored rates are added to it.
+    Parameters: source_currency, exchanged_currency, start_date, amount, end_date, cash_flows: dict with the amount in
+                the source currency added, or withdrawn if negative, at the end of each date
     Response: an dict containing the rate value between source and exchanges currencies along with the currencies and
               start_date
     """
+    end_date = end_date or date.today()
+    cash_flows = dict(sorted((cash_flows or {}).items()))
+    valuation_dates = [start_date, *cash_flows, end_date]
+    if source_currency == exchanged_currency:
+        log_rates = [0.] * len(valuation_dates)
+    else:
+        pair_index = get_pair_return_index(source_currency, exchanged_currency)
+        log_rates = [return_index.get_log_rate(pair_index, valuation_date) for valuation_date in valuation_dates]
+        for index, valuation_date in enumerate(valuation_dates):
+            if log_rates[index] is None:
+                log_rates[index] = get_return_index_log_rate(pair_index, source_currency, exchanged_currency,
+                                                             valuation_date)
+    return format_time_weighted_rate_return(source_currency, exchanged_currency, start_date, end_date, amount,
+                                            cash_flows, log_rates)
+
+
+def get_return_index_log_rate(pair_index, source_currency, exchanged_currency, valuation_date):
+    """ Log rate of a date missing in the return index of a pair, adding it to the index if it is stored. Rates
+    requested to the providers are only added when the adapters store them.
+    Parameters: pair_index, source_currency, exchanged_currency, valuation_date
+    Response: the log rate, or None if the rate is not available
+    """
+    rate = get_stored_exchange_rate(source_currency, exchanged_currency, valuation_date)
+    if rate is not None:
+        return return_index.set_rate(pair_index, valuation_date, rate)
+    rate = get_exchange_rate_data_providers(source_currency, exchanged_currency, valuation_date)
+    return PairReturnIndex.to_log_rate(rate)
 
+
+def get_pair_return_index(source_currency, exchanged_currency):
+    """ Return index of a currency pair, loading all its stored rates with a single query the first time
+    Parameters: source_currency, exchanged_currency
+    Response: the PairReturnIndex of the pair
+    """
+    pair_index = return_index.get_pair(source_currency, exchanged_currency)
+    if pair_index is not None:
+        return pair_index
+    # Rates of today may still change, so they are not indexed
+    stored_rates = {valuation_date: rate_value for valuation_date, rate_value
+                    in get_stored_pair_rates(source_currency, exchanged_currency).items()
+                    if valuation_date < date.today()}
+    start_date = min(stored_rates, default=date.today())
+    rates = np.full((max(stored_rates, default=start_date) - start_date).days + 1, np.nan)
+    for valuation_date, rate_value in stored_rates.items():
+        rates[(valuation_date - start_date).days] = rate_value
+    return return_index.set_pair(source_currency, exchanged_currency, start_date, rates)
+
+
+def get_stored_pair_rates(source_currency, exchanged_currency):
+    """Get all the rates stored in the database for a currency pair, using a single query
+    Parameters: source_currency / exchanged_currency
+    Response: dict with the rate values keyed by valuation_date
+    """
+    pivot_currency = get_pivot_currency()
+    if pivot_currency is None or source_currency == pivot_currency:
+        stored_rates = CurrencyExchangeRate.objects.filter(source_currency=source_currency,
+                                                           exchanged_currency=exchanged_currency)
+        return {valuation_date: float(rate_value)
+                for valuation_date, rate_value in stored_rates.values_list('valuation_date', 'rate_value')}
+
+    stored_rates = CurrencyExchangeRate.objects.filter(source_currency=pivot_currency,
+                                                       exchanged_currency__in=[source_currency, exchanged_currency])
+    pivot_rates = defaultdict(dict)
+    for valuation_date, exchanged_currency_id, rate_value in stored_rates.values_list(
+            'valuation_date', 'exchanged_currency_id', 'rate_value'):
+        pivot_rates[valuation_date][exchanged_currency_id] = float(rate_value)
+    rates = {}
+    for valuation_date, day_rates in pivot_rates.items():
+        day_rates[pivot_currency.id] = 1.
+        if day_rates.get(source_currency.id) and exchanged_currency.id in day_rates:
+            rates[valuation_date] = round(day_rates[exchanged_currency.id] / day_rates[source_currency.id], 6)
+    return rates
+
+
+def format_time_weighted_rate_return(source_currency, exchanged_currency, start_date, end_date, amount, cash_flows,
+                                     log_rates):
     # TWR = [(1+HP1​)x(1+HP2​)x···x(1+HPn​)]−1 = Time-weighted return
-    # n = Number of sub-periods
-    # HP = (end_value - initial_value + cash_flow) / (initial_value + cash_flow)
-    cash_flow = 0
-    initial_rate = get_exchange_rate_data_db_providers(source_currency, exchanged_currency, start_date)
-    end_rate = get_exchange_rate_data_db_providers(source_currency, exchanged_currency, date.today())
-    if not initial_rate or not end_rate:
+    # n = Number of sub-periods, split by the cash flows
+    # HP = end_value / (initial_value + cash_flow) - 1, the cash flow happening at the end of the previous sub-period
+    if any(log_rate is None for log_rate in log_rates):
         return None
-    initial_value = amount * initial_rate
-    end_value = amount * end_rate
-    twr = (end_value - initial_value + cash_flow) / (initial_value + cash_flow)
+    rates = np.exp(log_rates)
+    # Amount held in each sub-period
+    amounts = amount + np.concatenate(([0.], np.cumsum(list(cash_flows.values()))))
+    initial_values = amounts * rates[:-1]
+    end_values = amounts * rates[1:]
+    twr = float(np.prod(end_values / initial_values) - 1)
     data = {'source_currency': source_currency.symbol, 'exchanged_currency': exchanged_currency.symbol,
-            'date_from': start_date.strftime('%Y-%m-%d'), 'amount': amount, 'twr': twr}
+            'date_from': start_date.strftime('%Y-%m-%d'), 'date_to': end_date.strftime('%Y-%m-%d'),
+            'amount': amount, 'end_value': float(end_values[-1]), 'twr': twr}
 
     return data
+
+
+async def aget_exchange_rate_data_db_providers(source_currency, exchanged_currency, valuation_date, semaphore=None):
+    """Async version of get_exchange_rate_data_db_providers
+    Parameters: source_currency / exchanged_currency / valuation_date / semaphore: bounds the concurrent provider calls
+    Response: the rate value
+    """
+    if source_currency == exchanged_currency:
+        return 1.
+    rate_value = await sync_to_async(get_stored_exchange_rate)(source_currency, exchanged_currency, valuation_date)
+    if rate_value is not None:
+        return rate_value
+    rates = await aget_exchange_rates_data_providers(source_currency, [exchanged_currency], valuation_date, semaphore)
+    return rates[exchanged_currency.symbol]
+
+
+async def aget_exchange_rates_data_providers(source_currency, exchanged_currencies, valuation_date, semaphore=None):
+    """Async version of get_exchange_rates_data_providers
+    When a provider has a hedge delay and has not answered after it, the next provider is also requested, and the
+    rates of whichever answers first are taken.
+    Parameters: source_currency / exchanged_currencies / valuation_date / semaphore: bounds the concurrent provider
+                calls
+    Response: dict with the rate values keyed by exchanged currency symbol, None if no provider has it
+    """
+    rates = {exchanged_currency.symbol: None for exchanged_currency in exchanged_currencies}
+    if not settings.RATES_REQUEST_PROVIDERS:
+        metrics.increment('providers.skipped')
+        return rates
+    missing_currencies = list(exchanged_currencies)
+    providers = await sync_to_async(list)(Provider.objects.all().order_by('priority'))
+    while providers and missing_currencies:
+        provider = providers.pop(0)
+        provider_misses = negative_cache.get_missing(provider, source_currency, missing_currencies, valuation_date)
+        requested_currencies = [currency for currency in missing_currencies if currency.symbol not in provider_misses]
+        if not requested_currencies or not provider_breakers.get_breaker(provider).allow_request():
+            continue
+        calls = {start_provider_call(provider, source_currency, requested_currencies, valuation_date, semaphore):
+                 provider}
+        if provider.hedge_delay is not None and providers:
+            done, _ = await asyncio.wait(list(calls), timeout=provider.hedge_delay)
+            if not done and provider_breakers.get_breaker(providers[0]).allow_request():
+                metrics.increment('provider.%s.hedged' % provider.name)
+                hedge_provider = providers.pop(0)
+                calls[start_provider_call(hedge_provider, source_currency, requested_currencies, valuation_date,
+                                          semaphore)] = hedge_provider
+
+        rates.update(await afirst_provider_rates(calls))
+        for call, call_provider in calls.items():
+            if call.done():
+                call_rates, skipped = call.result()
+                if skipped:
+                    continue
+                provider_misses = [currency for currency in requested_currencies if currency.symbol not in call_rates]
+                negative_cache.set_missing(call_provider, source_currency, provider_misses, valuation_date)
+        missing_currencies = [currency for currency in missing_currencies if rates[currency.symbol] is None]
+    return rates
+
+
+# Provider calls still running after their request got the rates from a faster one
+running_provider_calls = set()
+
+
+def start_provider_call(provider, source_currency, exchanged_currencies, valuation_date, semaphore):
+    """Start a task getting the exchange rates of a date from a provider
+    Parameters: provider / source_currency / exchanged_currencies / valuation_date / semaphore
+    Response: the task
+    """
+    call = asyncio.ensure_future(aget_provider_exchange_rates(provider, source_currency, exchanged_currencies,
+                                                              valuation_date, semaphore))
+    running_provider_calls.add(call)
+    call.add_done_callback(running_provider_calls.discard)
+    return call
+
+
+async def afirst_provider_rates(calls):
+    """Wait for provider calls until one of them returns any rate, leaving the others running
+    Parameters: calls: provider call tasks
+    Response: dict with the rate values returned by the first provider, empty if none returned any
+    """
+    pending = set(calls)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for call in done:
+            call_rates, skipped = call.result()
+            if call_rates:
+                return call_rates
+    return {}
+
+
+async def aget_provider_exchange_rates(provider, source_currency, exchanged_currencies, valuation_date,
+                                       semaphore=None):
+    """Async version of get_provider_exchange_rates, giving up on the provider after its timeout
+    Parameters: provider / source_currency / exchanged_currencies / valuation_date / semaphore: bounds the concurrent
+                provider calls
+    Response: dict with the rate values found, keyed by exchanged currency symbol, and whether the provider was not
+              requested for being over its budget
+    """
+    semaphore = semaphore or asyncio.Semaphore(settings.PROVIDER_MAX_CONCURRENCY)
+
+    async def fetch(requested_currencies):
+        # Rates may have been stored by another process while waiting for the lease
+        fetched_rates = await sync_to_async(get_stored_exchange_rates)(source_currency, requested_currencies,
+                                                                       valuation_date)
+        missing_currencies = [currency for currency in requested_currencies if currency.symbol not in fetched_rates]
+        skipped = bool(missing_currencies) and not await sync_to_async(provider_quotas.acquire)(provider)
+        if missing_currencies and not skipped:
+            adapter = adapter_registry.get_adapter(provider)
+            breaker = provider_breakers.get_breaker(provider)
+            provider_rates = {}
+            try:
+                async with semaphore:
+                    provider_rates = await asyncio.wait_for(
+                        adapter.aget_exchange_rates_data(source_currency, missing_currencies, valuation_date),
+                        provider.timeout)
+            except asyncio.TimeoutError:
+                metrics.increment('provider.%s.timeouts' % provider.name)
+            except Exception:
+                breaker.record_failure()
+                raise
+            record_provider_outcome(breaker, provider_rates)
+            fetched_rates.update(provider_rates)
+        return source_currency, {currency.symbol for currency in requested_currencies}, fetched_rates, skipped
+
+    rates = {}
+    skipped = False
+    missing_currencies = list(exchanged_currencies)
+    while missing_currencies:
+        flight, shared = await provider_flights.ado((provider.pk, valuation_date), fetch, missing_currencies)
+        skipped = skipped or is_flight_skipped(source_currency, flight)
+        missing_currencies = get_flight_rates(source_currency, missing_currencies, valuation_date, flight, shared,
+                                              rates)
+    return rates, skipped
+
+
+async def aget_currency_rates(source_currency, start_date, end_date):
+    """ Async version of get_currency_rates, requesting the missing dates to the providers concurrently
+    Parameters: source_currency / date_from / date_to
+    Response: a time series list of rate values for each available Currency
+    """
+    dates, rates_matrix, missing_rates = await sync_to_async(get_currency_rates_matrix)(source_currency, start_date,
+                                                                                        end_date)
+    semaphore = asyncio.Semaphore(settings.PROVIDER_MAX_CONCURRENCY)
+    missing_dates = list(missing_rates)
+    missing_dates_rates = await asyncio.gather(*[
+        aget_exchange_rates_data_providers(source_currency, missing_rates[valuation_date], valuation_date, semaphore)
+        for valuation_date in missing_dates])
+    for valuation_date, rates in zip(missing_dates, missing_dates_rates):
+        rates_matrix[valuation_date].update(rates)
+
+    return format_currency_rates(source_currency, dates, rates_matrix)
+
+
+async def aget_exchanged_currency_amount(source_currency, exchanged_currency, amount):
+    """ Async version of get_exchanged_currency_amount
+    Parameters: source_currency, exchanged_currency, amount.
+    Response: an dict containing the exchanged amount along with the currencies and exchange rate, or None if the rate
+              is not available
+    """
+    valuation_date, rate = await sync_to_async(get_latest_stored_exchange_rate)(
+        source_currency, exchanged_currency, settings.RATES_LATEST_MAX_STALENESS_DAYS)
+    if rate is None:
+        valuation_date = date.today()
+        rate = await aget_exchange_rate_data_db_providers(source_currency, exchanged_currency, valuation_date)
+    if rate is None:
+        return None
+    return format_exchanged_currency_amount(source_currency, exchanged_currency, amount, rate, valuation_date)
+
+
+async def aget_time_weighted_rate_return(source_currency, exchanged_currency, start_date, amount, end_date=None,
+                                         cash_flows=None):
+    """ Async version of get_time_weighted_rate_return, getting the rates missing in the return index concurrently
+    Parameters: source_currency, exchanged_currency, start_date, amount, end_date, cash_flows
+    Response: an dict containing the rate value between source and exchanges currencies along with the currencies and
+              start_date
+    """
+    end_date = end_date or date.today()
+    cash_flows = dict(sorted((cash_flows or {}).items()))
+    valuation_dates = [start_date, *cash_flows, end_date]
+    if source_currency == exchanged_currency:
+        log_rates = [0.] * len(valuation_dates)
+    else:
+        pair_index = await sync_to_async(get_pair_return_index)(source_currency, exchanged_currency)
+        log_rates = [return_index.get_log_rate(pair_index, valuation_date) for valuation_date in valuation_dates]
+        missing_indexes = [index for index, log_rate in enumerate(log_rates) if log_rate is None]
+        missing_log_rates = await asyncio.gather(*[
+            aget_return_index_log_rate(pair_index, source_currency, exchanged_currency, valuation_dates[index])
+            for index in missing_indexes])
+        for index, log_rate in zip(missing_indexes, missing_log_rates):
+            log_rates[index] = log_rate
+    return format_time_weighted_rate_return(source_currency, exchanged_currency, start_date, end_date, amount,
+                                            cash_flows, log_rates)
+
+
+async def aget_return_index_log_rate(pair_index, source_currency, exchanged_currency, valuation_date):
+    """ Async version of get_return_index_log_rate
+    Parameters: pair_index, source_currency, exchanged_currency, valuation_date
+    Response: the log rate, or None if the rate is not available
+    """
+    rate = await sync_to_async(get_stored_exchange_rate)(source_currency, exchanged_currency, valuation_date)
+    if rate is not None:
+        return return_index.set_rate(pair_index, valuation_date, rate)
+    rates = await aget_exchange_rates_data_providers(source_currency, [exchanged_currency], valuation_date)
+    return PairReturnIndex.to_log_rate(rates[exchanged_currency.symbol])
@@ -5,14 +5,19 @@ from datetime import date
 
 from django.shortcuts import render
 
-from exchange_rate.models import Currency
+from exchange_rate.currencies import currency_registry
 from exchange_rate.utils import get_currency_rates
 
 
+# Period shown in the dashboard
+DASHBOARD_START_DATE = date(2021, 4, 20)
+DASHBOARD_END_DATE = date(2021, 5, 22)
+
+
 # Create your views here.
 def dashboard(request, base_currency):
-    source = Currency.objects.get(symbol__iexact=base_currency)
-    rates = get_currency_rates(source, date(2021, 4, 20), date(2021, 5, 22))
+    source = currency_registry.get_currency(base_currency.upper())
+    rates = get_currency_rates(source, DASHBOARD_START_DATE, DASHBOARD_END_DATE)
     exchange_rates = pd.DataFrame([r['rates'] for r in rates])
     exchange_rates['timestamp'] = pd.DatetimeIndex([r['valuation_date'] for r in rates]).astype(np.int64) / 1000000
 
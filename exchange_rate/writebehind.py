@@ -0,0 +1,186 @@
+import atexit
+import json
+import logging
+import os
+import threading
+
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db import connection
+
+from exchange_rate.metrics import metrics
+from exchange_rate.models import CurrencyExchangeRate
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    """ Process wide queue of the exchange rates returned by the providers, stored in the database in coalesced batches
+    by a background thread instead of in the request that fetched them.
+    A batch is flushed when settings.RATES_WRITE_BEHIND_MAX_ROWS rates are pending, or
+    settings.RATES_WRITE_BEHIND_INTERVAL seconds after the previous flush. Rates pending when the process exits are
+    flushed, or spilled to settings.RATES_WRITE_BEHIND_SPILL_PATH if the database is not available, and enqueued
+    again by the next process using the buffer.
+    Adapters add the rates to the rates cache when they enqueue them, and get_pending_rates returns them to the
+    database lookups, so they are read before they are stored.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pending = {}
+
+    @classmethod
+    def get_date(cls, valuation_date):
+        if isinstance(valuation_date, datetime):
+            return valuation_date.date()
+        return valuation_date
+
+    @classmethod
+    def get_value(cls, rate_value):
+        # Rounded as the database stores it, so pending and stored rates read the same
+        return round(float(rate_value), CurrencyExchangeRate._meta.get_field('rate_value').decimal_places)
+
+    def add(self, currency_exchange_rates):
+        """ Enqueues rates to be stored, starting the background thread on first use
+
+        :param currency_exchange_rates: rates to store.
+        :type currency_exchange_rates: list of CurrencyExchangeRate
+        """
+        self.start()
+        with self._lock:
+            for rate in currency_exchange_rates:
+                key = (rate.source_currency_id, rate.exchanged_currency_id, self.get_date(rate.valuation_date))
+                self._pending[key] = rate.rate_value
+            pending_rows = len(self._pending)
+        metrics.increment('write_behind.enqueued', len(currency_exchange_rates))
+        if pending_rows >= settings.RATES_WRITE_BEHIND_MAX_ROWS:
+            self._wake.set()
+
+    def get_pending_rates(self, source_currency, exchanged_currencies, valuation_date):
+        """ Gets the rates not stored yet from a source currency into several currencies in a date
+
+        :return: the pending rate values keyed by exchanged currency symbol
+        :rtype: dict
+        """
+        if not self._pending:
+            return {}
+        valuation_date = self.get_date(valuation_date)
+        with self._lock:
+            return {currency.symbol: self.get_value(self._pending[key]) for currency in exchanged_currencies
+                    for key in [(source_currency.id, currency.id, valuation_date)] if key in self._pending}
+
+    def get_pending_period_rates(self, source_currency, start_date, end_date):
+        """ Gets the rates not stored yet from a source currency in a time period
+
+        :return: the pending rate values keyed by (valuation_date, exchanged_currency_id)
+        :rtype: dict
+        """
+        if not self._pending:
+            return {}
+        start_date, end_date = self.get_date(start_date), self.get_date(end_date)
+        with self._lock:
+            return {(valuation_date, exchanged_id): self.get_value(rate_value)
+                    for (source_id, exchanged_id, valuation_date), rate_value in self._pending.items()
+                    if source_id == source_currency.id and start_date <= valuation_date <= end_date}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.load_spill()
+            self._thread = threading.Thread(target=self.run, name='rates-write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def run(self):
+        try:
+            while True:
+                self._wake.wait(settings.RATES_WRITE_BEHIND_INTERVAL)
+                self._wake.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    # Rates stay pending and are retried in the next flush
+                    logger.exception('Error storing the pending exchange rates')
+        finally:
+            connection.close()
+
+    def flush(self):
+        """ Stores the pending rates in a single bulk insert, skipping the ones already stored
+
+        :return: number of rates flushed
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = dict(self._pending)
+            if not pending:
+                return 0
+            CurrencyExchangeRate.objects.bulk_create(
+                [CurrencyExchangeRate(None, source_id, exchanged_id, valuation_date, rate_value)
+                 for (source_id, exchanged_id, valuation_date), rate_value in pending.items()],
+                batch_size=1000, ignore_conflicts=True)
+            with self._lock:
+                # Rates enqueued again while flushing are kept
+                for key, rate_value in pending.items():
+                    if self._pending.get(key) == rate_value:
+                        del self._pending[key]
+            metrics.increment('write_behind.flushed', len(pending))
+            return len(pending)
+
+    def shutdown(self):
+        """ Flushes the pending rates, spilling them to a file if they cannot be stored """
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Error storing the pending exchange rates, spilling them')
+            self.spill()
+
+    def spill(self):
+        """ Appends the pending rates to the spill file, one JSON array per line """
+        path = settings.RATES_WRITE_BEHIND_SPILL_PATH
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        if not path:
+            logger.error('%d pending exchange rates lost, RATES_WRITE_BEHIND_SPILL_PATH is not set', len(pending))
+            return
+        with open(path, 'a') as spill_file:
+            for (source_id, exchanged_id, valuation_date), rate_value in pending.items():
+                spill_file.write(json.dumps([source_id, exchanged_id, valuation_date.isoformat(), str(rate_value)])
+                                 + '\n')
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+        metrics.increment('write_behind.spilled', len(pending))
+
+    def load_spill(self):
+        """ Enqueues the rates spilled by a previous process, removing the spill file. Called holding the lock """
+        path = settings.RATES_WRITE_BEHIND_SPILL_PATH
+        if not path or not os.path.exists(path):
+            return
+        # The file is renamed first, so the rates are loaded by a single process
+        loading_path = '%s.%d' % (path, os.getpid())
+        try:
+            os.replace(path, loading_path)
+        except FileNotFoundError:
+            return
+        with open(loading_path) as spill_file:
+            for line in spill_file:
+                if line.strip():
+                    source_id, exchanged_id, valuation_date, rate_value = json.loads(line)
+                    self._pending[(source_id, exchanged_id, date.fromisoformat(valuation_date))] = rate_value
+        os.remove(loading_path)
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+
+
+write_behind = WriteBehindBuffer()
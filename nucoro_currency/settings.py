@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -138,9 +139,87 @@ PROVIDER_ADAPTERS = (
     ('exchange_rate.adapters.MockAdapter', 'Mock')
 )
 
+PROVIDER_MAX_CONCURRENCY = 8  # Provider requests run at the same time by an async request
+PROVIDER_HTTP_POOL_SIZE = 10  # Connections kept alive by each provider HTTP session
+PROVIDER_HTTP_TIMEOUT = (3.05, 10)  # Seconds to connect and read provider HTTP requests
+
 FIXER_KEY = '50dd4db76369ff38826398525959b2a6'
 AVAILABLE_CURRENCIES = ['USD', 'GBP', 'CHF', 'EUR']
 CURRENCIES = [{'symbol': 'USD', 'code': 'USD', 'name': 'United States Dollar'},
               {'symbol': 'GBP', 'code': 'GBP', 'name': 'Pound sterling'},
               {'symbol': 'CHF', 'code': 'CHF', 'name': 'Swiss Franc'},
               {'symbol': 'EUR', 'code': 'EUR', 'name': 'Euro'}]
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# The rates cache is shared between processes when using a cross-process backend, like file based or memcached:
+# 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/var/tmp/nucoro_currency_rates'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'rates': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'rates',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Storage of the rates fetched from providers:
+#  - 'full': the rates between every pair of currencies are stored
+#  - 'pivot': only the rates from RATES_PIVOT_CURRENCY are stored, the rest are derived from them when read
+RATES_STORAGE_MODE = 'full'
+RATES_PIVOT_CURRENCY = 'EUR'
+
+# File with the historical rates of RATES_PIVOT_CURRENCY memory mapped by every process, written by the
+# export_rate_cube command. Reads fall back to the cache and the database when it is not set or a rate is not there
+RATES_CUBE_PATH = None  # e.g. os.path.join(BASE_DIR, 'rates.cube')
+RATES_CUBE_CHECK_INTERVAL = 5  # Seconds between checks for a newly exported cube
+
+RATES_HTTP_MAX_AGE = 30 * 24 * 3600  # Seconds responses about past dates only can be cached by clients and proxies
+RATES_HTTP_TODAY_MAX_AGE = 60  # Seconds responses including rates of today can be cached
+
+# Days the latest stored rate of a pair can be older than today to be used for exchanged currency amounts, instead of
+# requesting today's rate to the providers. 0 always uses today's rate
+RATES_LATEST_MAX_STALENESS_DAYS = 3
+
+RATES_RETURN_INDEX_MAX_PAIRS = 1000  # Currency pairs whose return index is kept in each process
+
+RATES_BATCH_MAX_ITEMS = 10000  # Conversions accepted in a single exchanged currency amounts request
+# Key groups OR-ed in each query of a batch, as databases bound the depth of expressions (1000 in SQLite)
+RATES_BATCH_QUERY_GROUPS = 250
+
+# Whether rates not stored are requested to the providers while serving requests. Set it to False when the
+# ingest_rates command keeps the database up to date, so requests never wait for the providers
+RATES_REQUEST_PROVIDERS = True
+
+# ingest_rates command
+RATES_INGEST_INTERVAL = 3600  # Seconds between checks for new days to ingest
+RATES_INGEST_INITIAL_DAYS = 7  # Days ingested the first time, before yesterday included
+RATES_INGEST_RETRY_DELAY = 30  # Seconds before retrying a failed day, doubled after each consecutive failure
+RATES_INGEST_RETRY_MAX_DELAY = 3600  # Seconds
+
+RATES_STREAM_CHUNK_DAYS = 31  # Days read at once when streaming currency rates
+
+# Provider rates are stored by a background thread in coalesced batches instead of in the request fetching them.
+# Pending rates are flushed on exit, or spilled to RATES_WRITE_BEHIND_SPILL_PATH and loaded by the next process
+RATES_WRITE_BEHIND = False
+RATES_WRITE_BEHIND_MAX_ROWS = 5000  # Pending rates that trigger a flush
+RATES_WRITE_BEHIND_INTERVAL = 1.0  # Seconds between flushes
+RATES_WRITE_BEHIND_SPILL_PATH = os.path.join(tempfile.gettempdir(), 'nucoro_currency_rates.spill')
+
+# With a seed, the Mock provider generates a reproducible random walk of daily rates without database access,
+# instead of storing the last random rate of each pair of currencies
+RANDOM_EXCHANGE_SEED = None
+RANDOM_EXCHANGE_VOLATILITY = 0.005  # Standard deviation of the daily log change of each currency
+
+RATES_CACHE = 'rates'
+RATES_CACHE_MAX_SIZE = 10000  # Entries in the per process cache
+RATES_CACHE_TODAY_TTL = 300  # Seconds, rates of past dates never expire
+RATES_NEGATIVE_CACHE_TTL = 60  # Seconds a provider is not asked again for a rate it failed to return
+
+# Concurrent fetches of the same provider and date are coalesced, holding a file lock lease shared between processes
+RATES_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'nucoro_currency_locks')
+RATES_FETCH_LEASE_TIMEOUT = 30  # Seconds
@@ -1,9 +1,96 @@
 import random
+import threading
+import zlib
+
+import numpy as np
+
+from datetime import date, datetime, timedelta
 
 from random_exchange.models import CurrencyLastExchange
 
 
+class RandomWalk(object):
+    """ Reproducible random walk of the log value of each currency, one step per day since ORIGIN.
+    Steps are drawn in blocks of BLOCK_DAYS days from a generator seeded with the seed, the currency symbol and the
+    block, so the value of a currency in a date does not depend on the dates or currencies requested before. Rates
+    between two currencies are the exponential of the difference of their log values, so cross rates are consistent.
+    """
+    ORIGIN = date(1999, 1, 1)
+    BLOCK_DAYS = 1024
+
+    def __init__(self, seed, volatility):
+        self.seed = seed
+        self.volatility = volatility
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    @classmethod
+    def get_symbol_seed(cls, symbol):
+        return zlib.crc32(symbol.encode())
+
+    def get_block(self, symbol, block):
+        """ Gets the log values of a currency in the days of a block, computing the blocks before it on first use """
+        with self._lock:
+            first_block = max([cached_block for cached_symbol, cached_block in self._blocks
+                               if cached_symbol == symbol and cached_block <= block], default=None)
+            if first_block is None:
+                # Starting value of each currency, between 1/4 and 4 units of the numeraire
+                initial_value = np.random.default_rng([self.seed, self.get_symbol_seed(symbol)]).uniform(-1.4, 1.4)
+                log_values = np.array([initial_value])
+                first_block = -1
+            else:
+                log_values = self._blocks[(symbol, first_block)]
+            for next_block in range(first_block + 1, block + 1):
+                steps = np.random.default_rng([self.seed, self.get_symbol_seed(symbol), next_block]).normal(
+                    0., self.volatility, self.BLOCK_DAYS)
+                log_values = log_values[-1] + np.cumsum(steps)
+                self._blocks[(symbol, next_block)] = log_values
+            return log_values
+
+    @classmethod
+    def get_date(cls, valuation_date):
+        if isinstance(valuation_date, datetime):
+            return valuation_date.date()
+        return valuation_date
+
+    def get_log_values(self, symbols, start_date, end_date):
+        """ Gets the log values of several currencies in a time period
+
+        :param symbols: currency symbols of the matrix columns.
+        :type symbols: list
+        :param start_date: first date of the period, not before ORIGIN.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: the dates x symbols matrix of log values
+        :rtype: numpy.ndarray
+        """
+        start_day = (self.get_date(start_date) - self.ORIGIN).days
+        end_day = (self.get_date(end_date) - self.ORIGIN).days
+        if start_day < 0:
+            raise ValueError('Random rates start on %s' % self.ORIGIN)
+        first_block, last_block = start_day // self.BLOCK_DAYS, end_day // self.BLOCK_DAYS
+        log_values = np.empty((max(end_day - start_day + 1, 0), len(symbols)))
+        for column, symbol in enumerate(symbols):
+            blocks = np.concatenate([self.get_block(symbol, block) for block in range(first_block, last_block + 1)])
+            offset = start_day - first_block * self.BLOCK_DAYS
+            log_values[:, column] = blocks[offset:offset + log_values.shape[0]]
+        return log_values
+
+
 class RandomClient(object):
+    """ Client generating random exchange rates.
+    By default each rate is a small random change of the last one generated for the same currencies, stored in the
+    database. If a seed is given, rates are read from a RandomWalk instead, without database access, so the same seed
+    always gives the same rates and whole dates or periods are generated in a single vectorized call.
+    """
+
+    def __init__(self, seed=None, volatility=0.005):
+        self.random_walk = RandomWalk(seed, volatility) if seed is not None else None
+
+    @property
+    def seeded(self):
+        return self.random_walk is not None
 
     @classmethod
     def get_random_exchange(cls, source_currency, exchanged_currency):
@@ -23,3 +110,33 @@ class RandomClient(object):
                                                 exchanged_currency=exchanged_currency,
                                                 rate=rate)
         return rate
+
+    def get_rates(self, source_symbol, symbols, start_date, end_date):
+        """ Gets the seeded rates from a source currency into several currencies in a time period
+
+        :param source_symbol: symbol of the currency the rates are from.
+        :type source_symbol: str
+        :param symbols: symbols of the currencies the rates are into.
+        :type symbols: list
+        :param start_date: first date of the period.
+        :type start_date: date
+        :param end_date: last date of the period.
+        :type end_date: date
+        :return: the dates of the period, and the dates x symbols matrix of rates rounded to 6 decimals
+        :rtype: tuple of list and numpy.ndarray
+        """
+        start_date = self.random_walk.get_date(start_date)
+        log_values = self.random_walk.get_log_values([source_symbol, *symbols], start_date, end_date)
+        rates = np.exp(log_values[:, 1:] - log_values[:, :1]).round(6)
+        dates = [start_date + timedelta(days=offset) for offset in range(rates.shape[0])]
+        return dates, rates
+
+    def get_exchange_values(self, base_symbol, symbols, valuation_date):
+        """ Gets the seeded rates of a date from a base currency into several currencies, in the format Fixer returns
+
+        :return: the exchange rates as {'date', 'base', 'rates'}
+        :rtype: dict
+        """
+        symbols = [base_symbol, *(symbol for symbol in symbols if symbol != base_symbol)]
+        dates, rates = self.get_rates(base_symbol, symbols, valuation_date, valuation_date)
+        return {'date': dates[0].isoformat(), 'base': base_symbol, 'rates': dict(zip(symbols, rates[0].tolist()))}
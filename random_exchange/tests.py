@@ -1,3 +1,72 @@
-from django.test import TestCase
+from datetime import date
 
-# Create your tests here.
+import numpy as np
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+from exchange_rate.adapters import MockAdapter
+from exchange_rate.cache import rate_cache
+from exchange_rate.models import Currency, CurrencyExchangeRate
+from random_exchange.client import RandomClient
+from random_exchange.models import CurrencyLastExchange
+
+
+class SeededRandomClientTestCase(TestCase):
+    def test_seeded_rates(self):
+        """
+        Ensure seeded rates are reproducible, do not depend on the period requested and need no database access
+        """
+        with self.assertNumQueries(0):
+            dates, rates = RandomClient(seed=7).get_rates('EUR', ['USD', 'GBP'], date(2020, 12, 1), date(2021, 2, 1))
+            _, day_rates = RandomClient(seed=7).get_rates('EUR', ['GBP', 'USD'], date(2021, 1, 4), date(2021, 1, 4))
+            _, other_rates = RandomClient(seed=8).get_rates('EUR', ['USD', 'GBP'], date(2021, 1, 4), date(2021, 1, 4))
+        self.assertEqual(rates.shape, (63, 2))
+        self.assertEqual(dates[34], date(2021, 1, 4))
+        self.assertEqual(rates[34].tolist(), day_rates[0, ::-1].tolist())
+        self.assertNotEqual(rates[34].tolist(), other_rates[0].tolist())
+        self.assertTrue((rates > 0).all())
+
+    def test_seeded_cross_rates(self):
+        """
+        Ensure the seeded rates between two currencies are consistent with their rates from a third one
+        """
+        client = RandomClient(seed=7)
+        exchange_values = client.get_exchange_values('EUR', ['USD', 'GBP', 'EUR'], date(2021, 1, 4))
+        self.assertEqual(list(exchange_values['rates']), ['EUR', 'USD', 'GBP'])
+        self.assertEqual(exchange_values['rates']['EUR'], 1.)
+        _, usd_rates = client.get_rates('USD', ['GBP'], date(2021, 1, 4), date(2021, 1, 4))
+        self.assertAlmostEqual(usd_rates[0, 0], exchange_values['rates']['GBP'] / exchange_values['rates']['USD'],
+                               places=5)
+
+
+@override_settings(RANDOM_EXCHANGE_SEED=7)
+class SeededMockAdapterTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+
+    def test_mock_adapter_seeded(self):
+        """
+        Ensure the seeded mock adapter stores whole days as Fixer does, without random exchange records
+        """
+        eur, usd = Currency.objects.get(symbol='EUR'), Currency.objects.get(symbol='USD')
+        adapter = MockAdapter()
+        rates = adapter.get_exchange_rates_data(eur, [usd], date(2021, 1, 4))
+        _, client_rates = RandomClient(seed=7).get_rates('EUR', ['USD'], date(2021, 1, 4), date(2021, 1, 4))
+        self.assertAlmostEqual(rates['USD'], client_rates[0, 0], places=6)
+        self.assertEqual(adapter.get_exchange_rate_data(eur, usd, date(2021, 1, 4))['rate_value'], client_rates[0, 0])
+        self.assertEqual(CurrencyExchangeRate.objects.filter(valuation_date=date(2021, 1, 4)).count(), 12)
+        self.assertEqual(CurrencyLastExchange.objects.count(), 0)
+
+        dates, period_rates = adapter.get_currency_rates(eur, [usd], date(2021, 1, 1), date(2021, 1, 31))
+        self.assertEqual(len(dates), 31)
+        self.assertTrue(np.isfinite(period_rates).all())
+
+    @override_settings(RANDOM_EXCHANGE_SEED=None)
+    def test_mock_adapter_unseeded_period(self):
+        """
+        Ensure periods of rates are not generated without a seed
+        """
+        eur, usd = Currency.objects.get(symbol='EUR'), Currency.objects.get(symbol='USD')
+        with self.assertRaises(ImproperlyConfigured):
+            MockAdapter().get_currency_rates(eur, [usd], date(2021, 1, 1), date(2021, 1, 31))